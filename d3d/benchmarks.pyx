@@ -1,25 +1,26 @@
 # cython: language_level=3, boundscheck=False, wraparound=False, cdivision=True
 
+import io
+from multiprocessing import Pool
+
 import numpy as np
 cimport numpy as np
-import scipy.stats as sps
 import torch
 from addict import Dict as edict
+from scipy.spatial.transform import Rotation
 
 from numpy.math cimport NAN, isnan, PI
+from libc.math cimport sqrt, floor, fabs, cos, INFINITY
 from libcpp.vector cimport vector
-from libcpp.unordered_map cimport unordered_map
-from libcpp.unordered_set cimport unordered_set
 
 from d3d.abstraction import ObjectTarget3DArray
-from d3d.box import box2d_iou
+from d3d.box import box2d_from_flu, box2d_iou, box2d_iou_paired
+from d3d.math import i0e
+from d3d.profiler import profile, scope
 
 ctypedef float scalar_t
 
-cdef inline scalar_t weighted_mean(scalar_t a, int wa, scalar_t b, int wb) nogil:
-    if wa == 0: return b
-    elif wb == 0: return a
-    else: return (a * wa + b * wb) / (wa + wb)
+_trapezoid = getattr(np, "trapezoid", None) or np.trapz # np.trapz is removed in numpy 2
 
 cdef inline int bisect(scalar_t[:] arr, scalar_t x) nogil:
     '''Cython version of bisect.bisect_left'''
@@ -39,46 +40,360 @@ cdef inline scalar_t calc_recall(int tp, int fn) nogil:
 cdef inline scalar_t calc_fscore(int tp, int fp, int fn, scalar_t b2) nogil:
     return (1+b2) * tp / ((1+b2)*tp + b2*fn + fp)
 
+cdef Py_ssize_t _MaxGridCells = 1 << 20 # maximum number of cells in the grid of distance matching
+
+def _target_columns(targets):
+    '''
+    Convert the objects into columnar arrays, which are used in the matching functions
+    '''
+    cdef Py_ssize_t n = len(targets)
+    orientation = np.array([t.orientation.as_quat() for t in targets], dtype=np.float64).reshape(n, 4)
+    yaw = Rotation.from_quat(orientation).as_euler("ZYX")[:, 0] if n > 0 else np.empty(0)
+    return edict(
+        position=np.array([t.position for t in targets], dtype=np.float64).reshape(n, 3),
+        dimension=np.array([t.dimension for t in targets], dtype=np.float64).reshape(n, 3),
+        orientation=orientation,
+        yaw=yaw,
+        label=np.array([t.tag_top.value for t in targets], dtype=np.int32),
+        score=np.array([t.tag_score for t in targets], dtype=np.float64),
+        position_var=np.array([t.position_var for t in targets], dtype=np.float64).reshape(n, 3, 3),
+        dimension_var=np.array([t.dimension_var for t in targets], dtype=np.float64).reshape(n, 3, 3),
+        orientation_var=np.array([t.orientation_var for t in targets], dtype=np.float64)
+    )
+
+def _bev_boxes(cols):
+    '''Return the BEV boxes of the columnar targets as the input of box2d functions'''
+    return box2d_from_flu(np.stack([cols.position[:, 0], cols.position[:, 1], cols.dimension[:, 0],
+        cols.dimension[:, 1], cols.yaw], axis=1))
+
+cdef void _match_by_iou(const float[:, :] iou, const int[:] gt_labels, const int[:] dt_labels,
+                        const Py_ssize_t[:] dt_order, const float[:, :] min_overlap, int[:, :] dt_assignment) noexcept nogil:
+    '''
+    Each ground truth (in index order) picks the detection of the same class with the highest score whose
+    IoU is larger than the threshold, and they are matched if the detection is not picked by previous ground
+    truths. The thresholds are given per ground truth, and each row of min_overlap is matched independently
+    in the same pass over the sorted detections.
+
+    :param dt_assignment: output matched ground truth index for each threshold and detection, -1 if not matched
+    '''
+    cdef Py_ssize_t ngt = iou.shape[0], ndt = iou.shape[1], nthres = min_overlap.shape[0]
+    cdef Py_ssize_t g, k, d, t, remaining
+    cdef vector[char] picked, taken
+    taken.assign(nthres * ndt, 0)
+    for g in range(ngt):
+        picked.assign(nthres, 0)
+        remaining = nthres
+        for k in range(ndt):
+            if remaining == 0:
+                break
+            d = dt_order[k]
+            if dt_labels[d] != gt_labels[g]:
+                continue
+            for t in range(nthres):
+                if picked[t] or iou[g, d] <= min_overlap[t, g]:
+                    continue
+                picked[t] = 1
+                remaining -= 1
+                if not taken[t * ndt + d]:
+                    taken[t * ndt + d] = 1
+                    dt_assignment[t, d] = g
+
+cdef void _match_by_distance(const double[:, :] gt_xy, const int[:] gt_labels,
+                             const double[:, :] dt_xy, const int[:] dt_labels, const Py_ssize_t[:] dt_order,
+                             const float[:, :] max_dist, int[:, :] dt_assignment) noexcept nogil:
+    '''
+    Match each detection (in the given order) to the closest unmatched ground truth of the same class whose
+    center distance is smaller than the threshold. The thresholds are given per ground truth, and each row of
+    max_dist is matched independently in the same pass. The ground truths are binned into a uniform grid with
+    the cell size equal to the largest threshold, so only the neighboring cells are searched.
+
+    :param dt_assignment: output matched ground truth index for each threshold and detection, -1 if not matched
+    '''
+    cdef Py_ssize_t ngt = gt_xy.shape[0], ndt = dt_xy.shape[0], nthres = max_dist.shape[0]
+    cdef Py_ssize_t i, j, k, g, t, ix, iy, cx, cy, cell, best
+    cdef Py_ssize_t nx, ny
+    cdef double cell_size = 0, fx, fy, dx, dy, best_dist
+    cdef double min_x = INFINITY, max_x = -INFINITY, min_y = INFINITY, max_y = -INFINITY
+
+    for t in range(nthres):
+        for g in range(ngt):
+            cell_size = max(cell_size, max_dist[t, g])
+    if ngt == 0 or ndt == 0 or cell_size <= 0:
+        return
+
+    # build the grid, the cells are enlarged if there are too many of them
+    for g in range(ngt):
+        min_x = min(min_x, gt_xy[g, 0]); max_x = max(max_x, gt_xy[g, 0])
+        min_y = min(min_y, gt_xy[g, 1]); max_y = max(max_y, gt_xy[g, 1])
+    nx = <Py_ssize_t>((max_x - min_x) / cell_size) + 1
+    ny = <Py_ssize_t>((max_y - min_y) / cell_size) + 1
+    if nx * ny > _MaxGridCells:
+        cell_size *= sqrt(<double>(nx * ny) / _MaxGridCells)
+        nx = <Py_ssize_t>((max_x - min_x) / cell_size) + 1
+        ny = <Py_ssize_t>((max_y - min_y) / cell_size) + 1
+
+    # bin the ground truths into the grid with counting sort
+    cdef vector[Py_ssize_t] cell_start, cell_fill, gt_cell, sorted_gt
+    cell_start.assign(nx * ny + 1, 0)
+    gt_cell.resize(ngt)
+    sorted_gt.resize(ngt)
+    for g in range(ngt):
+        gt_cell[g] = min(<Py_ssize_t>((gt_xy[g, 1] - min_y) / cell_size), ny - 1) * nx \
+                   + min(<Py_ssize_t>((gt_xy[g, 0] - min_x) / cell_size), nx - 1)
+        cell_start[gt_cell[g] + 1] += 1
+    for cell in range(nx * ny):
+        cell_start[cell + 1] += cell_start[cell]
+    cell_fill = cell_start
+    for g in range(ngt):
+        sorted_gt[cell_fill[gt_cell[g]]] = g
+        cell_fill[gt_cell[g]] += 1
+
+    # collect candidates of each detection once and assign them for every threshold
+    cdef vector[Py_ssize_t] candidates
+    cdef vector[double] distances
+    cdef vector[char] taken
+    taken.assign(nthres * ngt, 0)
+    for k in range(ndt):
+        i = dt_order[k]
+        fx = (dt_xy[i, 0] - min_x) / cell_size
+        fy = (dt_xy[i, 1] - min_y) / cell_size
+        if fx < -1 or fy < -1 or fx >= nx + 1 or fy >= ny + 1:
+            continue
+        cx = <Py_ssize_t>floor(fx)
+        cy = <Py_ssize_t>floor(fy)
+
+        candidates.clear()
+        distances.clear()
+        for iy in range(max(cy - 1, 0), min(cy + 2, ny)):
+            for ix in range(max(cx - 1, 0), min(cx + 2, nx)):
+                cell = iy * nx + ix
+                for j in range(cell_start[cell], cell_start[cell + 1]):
+                    g = sorted_gt[j]
+                    if gt_labels[g] != dt_labels[i]:
+                        continue
+                    dx = gt_xy[g, 0] - dt_xy[i, 0]
+                    dy = gt_xy[g, 1] - dt_xy[i, 1]
+                    candidates.push_back(g)
+                    distances.push_back(sqrt(dx * dx + dy * dy))
+
+        for t in range(nthres):
+            best, best_dist = -1, INFINITY
+            for j in range(candidates.size()):
+                g = candidates[j]
+                if taken[t * ngt + g] or distances[j] >= max_dist[t, g]:
+                    continue
+                if distances[j] < best_dist or (distances[j] == best_dist and g < best):
+                    best, best_dist = g, distances[j]
+            if best >= 0:
+                taken[t * ngt + best] = 1
+                dt_assignment[t, i] = best
+
+def _gaussian_logpdf(x, mean, cov):
+    '''
+    Log-likelihood of multivariate normal distributions in batch. The covariances are factorized with
+    Cholesky decomposition, and the result is -inf where the covariance is not positive definite.
+    '''
+    x, mean, cov = (torch.as_tensor(v, dtype=torch.float64) for v in (x, mean, cov))
+    tril, info = torch.linalg.cholesky_ex(cov)
+    invalid = info != 0
+    tril[invalid] = torch.eye(cov.shape[1], dtype=cov.dtype)
+
+    z = torch.linalg.solve_triangular(tril, (x - mean).unsqueeze(-1), upper=False).squeeze(-1)
+    logdet = 2 * torch.log(torch.diagonal(tril, dim1=-2, dim2=-1)).sum(-1)
+    logpdf = -0.5 * (x.shape[1] * np.log(2 * np.pi) + logdet + z.pow(2).sum(-1))
+    logpdf[invalid] = -np.inf
+    return logpdf.numpy()
+
+def _vonmises_logpdf(x, kappa):
+    '''
+    Log-likelihood of von Mises distributions centered at zero in batch. The normalizer is calculated
+    with exponentially scaled Bessel function, so that it's stable with large kappa.
+    '''
+    x, kappa = torch.as_tensor(x, dtype=torch.float64), torch.as_tensor(kappa, dtype=torch.float64)
+    return (kappa * (torch.cos(x) - 1) - torch.log(2 * np.pi * i0e(kappa))).numpy()
+
+def _pair_accuracies(gt_cols, dt_cols, pair_gt, pair_dt, iou=None):
+    '''
+    Calculate the accuracy values of the matched pairs in batch
+
+    :param iou: IoU of the pairs, it's calculated on the BEV boxes if not given
+    '''
+    cdef Py_ssize_t npairs = len(pair_gt)
+    if npairs == 0:
+        return edict({name: np.empty(0) for name in ["iou", "angular", "dist", "box", "var"]})
+
+    gt_position, dt_position = gt_cols.position[pair_gt], dt_cols.position[pair_dt]
+    gt_dimension, dt_dimension = gt_cols.dimension[pair_gt], dt_cols.dimension[pair_dt]
+    if iou is None:
+        iou = box2d_iou_paired(_bev_boxes(gt_cols)[pair_gt], _bev_boxes(dt_cols)[pair_dt]).numpy()
+
+    angular = (Rotation.from_quat(gt_cols.orientation[pair_gt]).inv() *
+        Rotation.from_quat(dt_cols.orientation[pair_dt])).magnitude()
+
+    # log-likelihood of the ground truth under the detection uncertainty, -inf if there's no uncertainty
+    var = np.full(npairs, -np.inf)
+    uncertain = np.flatnonzero(dt_cols.orientation_var[pair_dt] > 0)
+    if len(uncertain) > 0:
+        gidx, didx = pair_gt[uncertain], pair_dt[uncertain]
+        var[uncertain] = _gaussian_logpdf(gt_cols.position[gidx], dt_cols.position[didx], dt_cols.position_var[didx])
+        var[uncertain] += _gaussian_logpdf(gt_cols.dimension[gidx], dt_cols.dimension[didx], dt_cols.dimension_var[didx])
+        var[uncertain] += _vonmises_logpdf(angular[uncertain], 1 / dt_cols.orientation_var[didx])
+
+    return edict(
+        iou=np.asarray(iou, dtype=np.float64),
+        angular=angular / PI,
+        dist=np.linalg.norm(gt_position - dt_position, axis=1),
+        box=np.linalg.norm(gt_dimension - dt_dimension, axis=1),
+        var=var
+    )
+
+class BenchmarkStats:
+    '''
+    Statistics of the object detection benchmark stored in arrays. The arrays are indexed by overlap threshold,
+    distance range, difficulty level, class and PR sample point (except ngt). The accuracy values are stored as
+    sums over the true positives, so that the statistics can be merged by addition and serialized without
+    conversion.
+    '''
+    ACCURACIES = ("iou", "angular", "dist", "box", "var")
+
+    def __init__(self, classes, nsamples, shape=(1, 1, 1)):
+        '''
+        Create empty statistics
+
+        :param classes: class values
+        :param nsamples: number of PR sample points
+        :param shape: numbers of overlap thresholds, distance ranges and difficulty levels
+        '''
+        self.classes = np.asarray(classes, dtype=np.int64)
+        cells = tuple(shape) + (len(self.classes),)
+        self.ngt = np.zeros(cells, dtype=np.int64)
+        self.ndt = np.zeros(cells + (nsamples,), dtype=np.int64)
+        self.tp = np.zeros(cells + (nsamples,), dtype=np.int64)
+        self.fp = np.zeros(cells + (nsamples,), dtype=np.int64)
+        self.fn = np.zeros(cells + (nsamples,), dtype=np.int64)
+        self.acc_sums = {name: np.zeros(cells + (nsamples,)) for name in self.ACCURACIES}
+
+    def mean(self, name):
+        '''
+        Return the mean accuracy values of true positives, NaN if there's no true positive
+        '''
+        with np.errstate(invalid='ignore', divide='ignore'):
+            return np.where(self.tp > 0, self.acc_sums[name] / self.tp, NAN)
+
+    def __iadd__(self, other):
+        if not np.array_equal(self.classes, other.classes) or self.tp.shape != other.tp.shape:
+            raise ValueError("Statistics with different classes, thresholds, bins or PR samples cannot be merged!")
+        self.ngt += other.ngt
+        self.ndt += other.ndt
+        self.tp += other.tp
+        self.fp += other.fp
+        self.fn += other.fn
+        for name in self.ACCURACIES:
+            self.acc_sums[name] += other.acc_sums[name]
+        return self
+
+    def __add__(self, other):
+        result = BenchmarkStats(self.classes, self.tp.shape[4], self.tp.shape[:3])
+        result += self
+        result += other
+        return result
+
+    def save(self, file):
+        '''
+        Save the statistics into a npz file (path or file object)
+        '''
+        np.savez(file, classes=self.classes, ngt=self.ngt, ndt=self.ndt, tp=self.tp, fp=self.fp, fn=self.fn,
+            **{"acc_" + name: values for name, values in self.acc_sums.items()})
+
+    @classmethod
+    def load(cls, file):
+        '''
+        Load the statistics from a npz file (path or file object)
+        '''
+        with np.load(file) as data:
+            stats = cls(data['classes'], data['tp'].shape[4], data['tp'].shape[:3])
+            for name in ["ngt", "ndt", "tp", "fp", "fn"]:
+                setattr(stats, name, data[name])
+            for name in cls.ACCURACIES:
+                stats.acc_sums[name] = data["acc_" + name]
+        return stats
+
+    def to_bytes(self):
+        '''
+        Serialize the statistics in npz format, it can be used to gather the statistics across processes
+        '''
+        buffer = io.BytesIO()
+        self.save(buffer)
+        return buffer.getvalue()
+
+    @classmethod
+    def from_bytes(cls, data):
+        return cls.load(io.BytesIO(data))
+
+def _cumulative(locs, int nbins, weights=None):
+    '''Count (or sum) of the entries whose score location is larger than each score index'''
+    counts = np.bincount(locs, weights=weights, minlength=nbins)
+    return np.cumsum(counts[::-1])[::-1][1:]
+
 cdef class ObjectBenchmark:
     '''Benchmark for object detection'''
     # member declarations
     cdef int _pr_nsamples
     cdef scalar_t _min_score
-    cdef unordered_set[int] _classes
     cdef object _class_type
-    cdef unordered_map[int, scalar_t] _min_overlaps
+    cdef list _class_values
+    cdef list _min_overlaps
+    cdef list _distance_ranges
+    cdef list _difficulty_levels
     cdef np.ndarray _pr_thresholds
+    cdef str _criterion
+    cdef tuple _init_args
 
-    # aggregated statistics declarations
-    cdef unordered_map[int, int] _total_gt
-    cdef unordered_map[int, vector[int]] _total_dt, _tp, _fp, _fn
-    cdef unordered_map[int, vector[scalar_t]] _acc_angular, _acc_iou, _acc_box, _acc_dist, _acc_var
+    # aggregated statistics (BenchmarkStats)
+    cdef object _stats
 
-    def __init__(self, classes, min_overlaps, int pr_sample_count=40, scalar_t min_score=0, str pr_sample_scale="log10"):
+    def __init__(self, classes, min_overlaps, int pr_sample_count=40, scalar_t min_score=0, str pr_sample_scale="log10",
+        str criterion="iou", distance_ranges=None, difficulty_levels=None):
         '''
         Object detection benchmark. Targets association is done by score sorting.
 
         :param classes: Object classes to consider
         :param min_overlaps: Min overlaps per class for two boxes being considered as overlap.
-            If single value is provided, all class will use the same overlap threshold
+            If single value is provided, all class will use the same overlap threshold. If the criterion
+            is distance, these are the max center distances instead. To evaluate several thresholds at once,
+            provide a list of them, each one is a list of values per class or a list with a single value,
+            e.g. [[0.7, 0.5, 0.5], [0.5, 0.25, 0.25]] or [[0.5], [0.55], [0.6]]
         :param min_score: Min score for precision-recall samples
         :param pr_sample_count: Number of precision-recall sample points (expect for p=1,r=0 and p=0,r=1)
         :param pr_sample_scale: PR sample type, {lin: linspace, log: logspace 1~10, logX: logspace 1~X}
-
-        TODO: add support for other threshold (e.g. center distance)
+        :param criterion: Association criterion, {iou: BEV IoU larger than threshold, distance: BEV center
+            distance smaller than threshold (used in nuScenes)}
+        :param distance_ranges: List of (min, max) BEV distances to the frame origin. If provided, statistics are
+            calculated for objects in each range, and the targets out of the range are ignored.
+        :param difficulty_levels: List of max difficulty levels. If provided, statistics are calculated for each
+            level, and ground truths with higher difficulty (given in get_stats) are ignored like in KITTI.
         '''
         # parse parameters
+        self._init_args = (classes, min_overlaps, pr_sample_count, min_score, pr_sample_scale, criterion,
+            distance_ranges, difficulty_levels)
         if isinstance(classes, (list, tuple)):
             self._class_type = type(classes[0])
-            for c in classes:
-                self._classes.insert(c.value)
+            self._class_values = [c.value for c in classes]
         else:
             self._class_type = type(classes)
-            self._classes.insert(classes.value)
-        if isinstance(min_overlaps, (list, tuple)):
-            self._min_overlaps = {classes[i].value: v for i, v in enumerate(min_overlaps)}
+            self._class_values = [classes.value]
+
+        if isinstance(min_overlaps, (list, tuple)) and len(min_overlaps) > 0 \
+            and isinstance(min_overlaps[0], (list, tuple, np.ndarray)):
+            self._min_overlaps = [self._parse_thresholds(v) for v in min_overlaps]
         else:
-            self._min_overlaps = {c: min_overlaps for c in self._classes}
+            self._min_overlaps = [self._parse_thresholds(min_overlaps)]
+        self._distance_ranges = [tuple(r) for r in distance_ranges] if distance_ranges is not None else None
+        self._difficulty_levels = list(difficulty_levels) if difficulty_levels is not None else None
+
+        if criterion not in ["iou", "distance"]:
+            raise ValueError("Unrecognized association criterion: %s" % criterion)
+        self._criterion = criterion
 
         self._pr_nsamples = pr_sample_count
         self._min_score = min_score
@@ -94,283 +409,258 @@ cdef class ObjectBenchmark:
         else:
             raise ValueError("Unrecognized PR sample type")
 
-        # initialize maps
-        for k in self._classes:
-            self._total_gt[k] = 0
-            self._total_dt[k] = vector[int](self._pr_nsamples, 0)
-            self._tp[k] = vector[int](self._pr_nsamples, 0)
-            self._fp[k] = vector[int](self._pr_nsamples, 0)
-            self._fn[k] = vector[int](self._pr_nsamples, 0)
+        self._stats = self._empty_stats()
+
+    cdef dict _parse_thresholds(self, thresholds):
+        '''Convert thresholds (single value, values aligned with the classes or dict) into a dict of class values'''
+        if isinstance(thresholds, dict):
+            return {c: thresholds[c] for c in self._class_values}
+        elif isinstance(thresholds, (list, tuple, np.ndarray)):
+            if len(thresholds) == 1:
+                return {c: thresholds[0] for c in self._class_values}
+            if len(thresholds) != len(self._class_values):
+                raise ValueError("Number of thresholds is inconsistent with the number of classes!")
+            return {c: v for c, v in zip(self._class_values, thresholds)}
+        else:
+            return {c: thresholds for c in self._class_values}
 
-            self._acc_angular[k] = vector[scalar_t](self._pr_nsamples, NAN)
-            self._acc_iou[k] = vector[scalar_t](self._pr_nsamples, NAN)
-            self._acc_box[k] = vector[scalar_t](self._pr_nsamples, NAN)
-            self._acc_dist[k] = vector[scalar_t](self._pr_nsamples, NAN)
-            self._acc_var[k] = vector[scalar_t](self._pr_nsamples, NAN)
+    cdef object _empty_stats(self):
+        shape = (len(self._min_overlaps), len(self._distance_ranges or [None]), len(self._difficulty_levels or [None]))
+        return BenchmarkStats(self._class_values, self._pr_nsamples, shape)
 
     def reset(self):
-        for k in self._classes:
-            self._total_gt[k] = 0
-            self._total_dt[k].assign(self._pr_nsamples, 0)
-            self._tp[k].assign(self._pr_nsamples, 0)
-            self._fp[k].assign(self._pr_nsamples, 0)
-            self._fn[k].assign(self._pr_nsamples, 0)
-
-            self._acc_angular[k].assign(self._pr_nsamples, NAN)
-            self._acc_iou[k].assign(self._pr_nsamples, NAN)
-            self._acc_box[k].assign(self._pr_nsamples, NAN)
-            self._acc_dist[k].assign(self._pr_nsamples, NAN)
-            self._acc_var[k].assign(self._pr_nsamples, NAN)
-
-    cdef inline dict _aggregate_stats(self, vector[unordered_map[int, scalar_t]]& acc, vector[int]& gt_tags):
-        '''Help put accuracy values into categories'''
-        # init intermediate vars
-        cdef unordered_map[int, vector[scalar_t]] sorted_sum, aggregated
-        cdef unordered_map[int, vector[int]] sorted_count
-        for k in self._classes:
-            sorted_sum[k] = vector[scalar_t](self._pr_nsamples, 0)
-            sorted_count[k] = vector[int](self._pr_nsamples, 0)
-            aggregated[k] = vector[scalar_t](self._pr_nsamples, 0)
-
-        # sort accuracies into categories
-        for score_idx in range(self._pr_nsamples):
-            for iter in acc[score_idx]:
-                sorted_sum[gt_tags[iter.first]][score_idx] += iter.second
-                sorted_count[gt_tags[iter.first]][score_idx] += 1
-
-        # aggregate
-        for k in self._classes:
-            for score_idx in range(self._pr_nsamples):
-                # assert sorted_count[k][score_idx] == tp[k][score_idx]
-                if sorted_count[k][score_idx] > 0:
-                    aggregated[k][score_idx] = sorted_sum[k][score_idx] / sorted_count[k][score_idx]
-                else:
-                    aggregated[k][score_idx] = NAN
-        return aggregated
-
-    def get_stats(self, gt_boxes, dt_boxes): # TODO: add cython definition for abstraction classes
-        assert type(gt_boxes) == ObjectTarget3DArray
-        assert type(dt_boxes) == ObjectTarget3DArray
-        assert gt_boxes.frame == dt_boxes.frame        
-
-        # forward definitions
-        cdef int thres_loc, gt_tagv, dt_idx, dt_tagv
-
-        # initialize statistics
-        cdef unordered_map[int, int] ngt
-        cdef unordered_map[int, vector[int]] tp, fp, fn, ndt
-        cdef vector[unordered_map[int, int]] dt_assignment, gt_assignment
-        cdef vector[unordered_map[int, scalar_t]] iou_acc, angular_acc, dist_acc, box_acc, var_acc
-
-        for k in self._classes:
-            ngt[k] = 0
-            ndt[k] = vector[int](self._pr_nsamples, 0)
-            tp[k] = vector[int](self._pr_nsamples, 0)
-            fp[k] = vector[int](self._pr_nsamples, 0)
-            fn[k] = vector[int](self._pr_nsamples, 0)
-
-            dt_assignment.resize(self._pr_nsamples)
-            gt_assignment.resize(self._pr_nsamples)
-
-            iou_acc.resize(self._pr_nsamples)
-            angular_acc.resize(self._pr_nsamples)
-            dist_acc.resize(self._pr_nsamples)
-            box_acc.resize(self._pr_nsamples)
-            var_acc.resize(self._pr_nsamples)
-
-        # calculate iou and sort by score
-        gt_array = gt_boxes.to_torch().float()
-        dt_array = dt_boxes.to_torch().float()
-        cdef np.ndarray[ndim=2, dtype=float] iou = box2d_iou(gt_array[:, [0,1,3,4,6]], dt_array[:, [0,1,3,4,6]], method="rbox").numpy()
-        cdef np.ndarray[ndim=1, dtype=long] order = np.argsort([box.tag_score for box in dt_boxes])[::-1] # match from best score
-
-        for gt_idx in range(len(gt_boxes)):
-            # skip classes not required
-            gt_tag = gt_boxes[gt_idx].tag_top
-            gt_tagv = gt_tag.value
-            if self._classes.find(gt_tagv) == self._classes.end():
-                continue
-           
-            for order_idx in range(len(order)):
-                dt_idx = order[order_idx]
-                # compare class information
-                if dt_boxes[dt_idx].tag_top != gt_tag:
-                    continue
+        self._stats = self._empty_stats()
+
+    cdef _fill_stats(self, stats, tuple cell, gt_cols, dt_cols, dt_loc, pair_gt, pair_dt, dict acc,
+        gt_valid, dt_valid):
+        '''
+        Fill the statistics of a threshold and bin from the matched pairs. Pairs with ignored ground truth and
+        unmatched ignored detections are not counted. A pair is a true positive for all the score thresholds
+        below the detection score, so the statistics of every score threshold are derived from cumulative counts.
+        '''
+        cdef int nbins = self._pr_nsamples + 1
+        pair_loc = dt_loc[pair_dt]
+        pair_label = gt_cols.label[pair_gt]
+        pair_valid = gt_valid[pair_gt]
+        dt_unmatched = np.ones(len(dt_loc), dtype=bool)
+        dt_unmatched[pair_dt] = False
+        dt_unmatched &= dt_valid
 
-                # true positive if overlap is larger than threshold
-                if iou[gt_idx, dt_idx] > self._min_overlaps[gt_tagv]:
-                    thres_loc = bisect(self._pr_thresholds, dt_boxes[dt_idx].tag_score)
-                    assert thres_loc >= 0, "Box score should be larger than min_score!"
+        for c, k in enumerate(self._class_values):
+            ngt = np.sum(gt_valid & (gt_cols.label == k))
+            mask = pair_valid & (pair_label == k)
+            tp = _cumulative(pair_loc[mask], nbins)
+            fp = _cumulative(dt_loc[dt_unmatched & (dt_cols.label == k)], nbins)
 
-                    # assign box
-                    for score_idx in range(0, thres_loc):
-                        # skip already assigned box
-                        if dt_assignment[score_idx].find(dt_idx) != dt_assignment[score_idx].end():
-                            continue
+            index = cell + (c,)
+            stats.ngt[index] = ngt
+            stats.ndt[index] = tp + fp
+            stats.tp[index] = tp
+            stats.fp[index] = fp
+            stats.fn[index] = ngt - tp
+            for name, values in acc.items():
+                stats.acc_sums[name][index] = _cumulative(pair_loc[mask], nbins, values[mask])
 
-                        dt_assignment[score_idx][dt_idx] = gt_idx
-                        gt_assignment[score_idx][gt_idx] = dt_idx
-
-                        # caculate accuracy values for various criteria
-                        iou_acc[score_idx][gt_idx] = iou[gt_idx, dt_idx]
-                        dist_acc[score_idx][gt_idx] = np.linalg.norm(
-                            gt_boxes[gt_idx].position - dt_boxes[dt_idx].position)
-                        box_acc[score_idx][gt_idx] = np.linalg.norm(
-                            gt_boxes[gt_idx].dimension - dt_boxes[dt_idx].dimension)
-
-                        angular_acc_cur = (gt_boxes[gt_idx].orientation.inv() * dt_boxes[dt_idx].orientation).magnitude()
-                        angular_acc[score_idx][gt_idx] = angular_acc_cur / PI
-
-                        if dt_boxes[dt_idx].orientation_var > 0:
-                            var_acc_cur = sps.multivariate_normal.logpdf(gt_boxes[gt_idx].position,
-                                dt_boxes[dt_idx].position, cov=dt_boxes[dt_idx].position_var)
-                            var_acc_cur += sps.multivariate_normal.logpdf(gt_boxes[gt_idx].dimension,
-                                dt_boxes[dt_idx].dimension, cov=dt_boxes[dt_idx].dimension_var)
-                            var_acc_cur += sps.vonmises.logpdf(angular_acc_cur, kappa=1/dt_boxes[dt_idx].orientation_var)
-                            var_acc[score_idx][gt_idx] = var_acc_cur
-                        else:
-                            var_acc[score_idx][gt_idx] = -np.inf
-                    break
-
-            ngt[gt_tagv] += 1
-            for score_idx in range(self._pr_nsamples):
-                if gt_assignment[score_idx].find(gt_idx) != gt_assignment[score_idx].end():
-                    tp[gt_tagv][score_idx] += 1
-                else:
-                    fn[gt_tagv][score_idx] += 1
-
-        # compute false positives
-        for dt_idx in range(len(dt_boxes)):
-            dt_box = dt_boxes[dt_idx]
-            dt_tagv = dt_box.tag_top.value
-            if self._classes.find(dt_tagv) == self._classes.end():
-                continue
+    cdef object _stats_columns(self, gt_cols, dt_cols, gt_difficulty):
+        '''
+        Match the targets in columnar format once for all the thresholds, and build the statistics of all
+        the thresholds and bins
+        '''
+        cdef Py_ssize_t t, r, l, ngt = len(gt_cols.label), ndt = len(dt_cols.label)
+        cdef Py_ssize_t nthres = len(self._min_overlaps)
+        cdef bint use_iou = self._criterion == "iou"
 
-            thres_loc = bisect(self._pr_thresholds, dt_boxes[dt_idx].tag_score)
-            for score_idx in range(thres_loc):
-                ndt[dt_tagv][score_idx] += 1
-                if dt_assignment[score_idx].find(dt_idx) == dt_assignment[score_idx].end():
-                    fp[dt_tagv][score_idx] += 1
-
-        # compute accuracy metrics
-        cdef vector[int] gt_tags
-        gt_tags.reserve(len(gt_boxes))
-        for box in gt_boxes:
-            gt_tags.push_back(box.tag_top.value)
-
-        return edict(ngt=ngt, ndt=ndt,
-            tp=tp, fp=fp, fn=fn,
-            acc_iou=self._aggregate_stats(iou_acc, gt_tags),
-            acc_angular=self._aggregate_stats(angular_acc, gt_tags),
-            acc_dist=self._aggregate_stats(dist_acc, gt_tags),
-            acc_box=self._aggregate_stats(box_acc, gt_tags),
-            acc_var=self._aggregate_stats(var_acc, gt_tags)
-        )
+        # thresholds of each ground truth, those of unconsidered classes are never matched
+        limits = np.full((nthres, ngt), INFINITY if use_iou else -1, dtype=np.float32)
+        for t in range(nthres):
+            for k, v in self._min_overlaps[t].items():
+                limits[t, gt_cols.label == k] = v
+
+        dt_order = np.argsort(dt_cols.score)[::-1].astype(np.intp) # match from best score
+        dt_assignment = np.full((nthres, ndt), -1, dtype=np.int32)
+
+        # the matching runs without the GIL, so that frames can be matched in several threads
+        cdef const int[:] gt_label_view = gt_cols.label, dt_label_view = dt_cols.label
+        cdef const Py_ssize_t[:] dt_order_view = dt_order
+        cdef const float[:, :] limits_view = limits, iou_view
+        cdef const double[:, :] gt_xy_view, dt_xy_view
+        cdef int[:, :] assignment_view = dt_assignment
+        if use_iou:
+            if ngt > 0 and ndt > 0:
+                iou = box2d_iou(_bev_boxes(gt_cols), _bev_boxes(dt_cols), method="rbox").numpy()
+            else:
+                iou = np.zeros((ngt, ndt), dtype=np.float32)
+            iou_view = iou
+            with nogil:
+                _match_by_iou(iou_view, gt_label_view, dt_label_view, dt_order_view, limits_view, assignment_view)
+        else:
+            gt_xy_view, dt_xy_view = gt_cols.position[:, :2], dt_cols.position[:, :2]
+            with nogil:
+                _match_by_distance(gt_xy_view, gt_label_view, dt_xy_view, dt_label_view, dt_order_view,
+                    limits_view, assignment_view)
+
+        # accuracies are calculated once for the pairs matched with any of the thresholds
+        cdef Py_ssize_t key_base = max(ndt, 1)
+        pair_thres, pair_dt = np.nonzero(dt_assignment >= 0)
+        pair_gt = dt_assignment[pair_thres, pair_dt].astype(np.intp)
+        keys, inverse = np.unique(pair_gt * key_base + pair_dt, return_inverse=True)
+        key_gt, key_dt = keys // key_base, keys % key_base
+        acc = _pair_accuracies(gt_cols, dt_cols, key_gt, key_dt, iou=iou[key_gt, key_dt] if use_iou else None)
+
+        # valid targets in each bin
+        ranges = self._distance_ranges or [(0, INFINITY)]
+        gt_dist = np.linalg.norm(gt_cols.position[:, :2], axis=1)
+        dt_dist = np.linalg.norm(dt_cols.position[:, :2], axis=1)
+        gt_in_range = [(gt_dist >= lower) & (gt_dist < upper) for lower, upper in ranges]
+        dt_in_range = [(dt_dist >= lower) & (dt_dist < upper) for lower, upper in ranges]
+        if self._difficulty_levels is None:
+            gt_in_level = [np.ones(ngt, dtype=bool)]
+        else:
+            if gt_difficulty is None or len(gt_difficulty) != ngt:
+                raise ValueError("Difficulties of all ground truths should be provided with difficulty levels!")
+            gt_difficulty = np.asarray(gt_difficulty)
+            gt_in_level = [gt_difficulty <= level for level in self._difficulty_levels]
+
+        dt_loc = np.searchsorted(self._pr_thresholds, dt_cols.score.astype(np.float32), side='left')
+        stats = self._empty_stats()
+        for t in range(nthres):
+            mask = pair_thres == t
+            pair_acc = {name: values[inverse[mask]] for name, values in acc.items()}
+            for r in range(len(ranges)):
+                for l in range(len(gt_in_level)):
+                    self._fill_stats(stats, (t, r, l), gt_cols, dt_cols, dt_loc, pair_gt[mask], pair_dt[mask],
+                        pair_acc, gt_in_range[r] & gt_in_level[l], dt_in_range[r])
+        return stats
+
+    def get_stats(self, gt_boxes, dt_boxes, gt_difficulty=None):
+        '''
+        Calculate statistics of one frame for all the thresholds and bins, the result can be added to the
+        benchmark by add_stats
+
+        :param gt_difficulty: difficulty levels of the ground truths, required if difficulty_levels is set
+        '''
+        assert type(gt_boxes) == ObjectTarget3DArray
+        assert type(dt_boxes) == ObjectTarget3DArray
+        assert gt_boxes.frame == dt_boxes.frame
+        with scope("ObjectBenchmark.get_stats"): # methods of extension types cannot be wrapped by profile
+            return self._stats_columns(_target_columns(gt_boxes), _target_columns(dt_boxes), gt_difficulty)
 
     def add_stats(self, stats):
         '''
-        Add statistics from get_stats into database
-        '''
-        cdef int otp, ntp
-        for k in self._classes:
-            self._total_gt[k] += stats.ngt[k]
-            for i in range(self._pr_nsamples):
-                # aggregate accuracies
-                otp, ntp = self._tp[k][i], stats.tp[k][i]
-                self._acc_angular[k][i] = weighted_mean(
-                    self._acc_angular[k][i], otp, stats.acc_angular[k][i], ntp)
-                self._acc_box[k][i] = weighted_mean(
-                    self._acc_box[k][i], otp, stats.acc_box[k][i], ntp)
-                self._acc_iou[k][i] = weighted_mean(
-                    self._acc_iou[k][i], otp, stats.acc_iou[k][i], ntp)
-                self._acc_dist[k][i] = weighted_mean(
-                    self._acc_dist[k][i], otp, stats.acc_dist[k][i], ntp)
-                self._acc_var[k][i] = weighted_mean(
-                    self._acc_var[k][i], otp, stats.acc_var[k][i], ntp)
-
-                # aggregate common stats
-                self._total_dt[k][i] += stats.ndt[k][i]
-                self._tp[k][i] += stats.tp[k][i]
-                self._fp[k][i] += stats.fp[k][i]
-                self._fn[k][i] += stats.fn[k][i]
+        Add statistics (BenchmarkStats) from get_stats into database
+        '''
+        self._stats += stats
+
+    def total_stats(self):
+        '''
+        Return a copy of the statistics aggregated in the benchmark
+        '''
+        return self._stats + self._empty_stats()
+
+    def __reduce__(self):
+        # the benchmark is reconstructed from the parameters and the aggregated statistics
+        return (ObjectBenchmark, self._init_args, self._stats)
+
+    def __setstate__(self, stats):
+        self._stats = stats
 
     cdef inline int _get_score_idx(self, scalar_t score) nogil:
         if isnan(score):
             return self._pr_nsamples // 2
         else:
             return bisect(self._pr_thresholds, score)
-    def gt_count(self):
-        return self._total_gt
-    def dt_count(self, scalar_t score=NAN):
+    cdef inline tuple _cell(self, int overlap_idx, int range_idx, int difficulty_idx):
+        '''Index of the statistics of given overlap threshold, distance range and difficulty level'''
+        return (overlap_idx, range_idx, difficulty_idx)
+    cdef dict _class_values_at(self, values, int score_idx):
+        return {self._class_type(k): values[c, score_idx].item() for c, k in enumerate(self._class_values)}
+
+    def gt_count(self, int overlap_idx=0, int range_idx=0, int difficulty_idx=0):
+        ngt = self._stats.ngt[self._cell(overlap_idx, range_idx, difficulty_idx)]
+        return {k: int(ngt[c]) for c, k in enumerate(self._class_values)}
+    def dt_count(self, scalar_t score=NAN, int overlap_idx=0, int range_idx=0, int difficulty_idx=0):
         cdef int score_idx = self._get_score_idx(score)
-        return {self._class_type(iter.first): iter.second[score_idx] for iter in self._total_dt}
+        return self._class_values_at(self._stats.ndt[self._cell(overlap_idx, range_idx, difficulty_idx)], score_idx)
 
-    def tp(self, scalar_t score=NAN):
+    def tp(self, scalar_t score=NAN, int overlap_idx=0, int range_idx=0, int difficulty_idx=0):
         '''Return true positive count. If score is not specified, return the median value'''
         cdef int score_idx = self._get_score_idx(score)
-        return {self._class_type(iter.first): iter.second[score_idx] for iter in self._tp}
-    def fp(self, scalar_t score=NAN):
+        return self._class_values_at(self._stats.tp[self._cell(overlap_idx, range_idx, difficulty_idx)], score_idx)
+    def fp(self, scalar_t score=NAN, int overlap_idx=0, int range_idx=0, int difficulty_idx=0):
         '''Return false positive count. If score is not specified, return the median value'''
         cdef int score_idx = self._get_score_idx(score)
-        return {self._class_type(iter.first): iter.second[score_idx] for iter in self._fp}
-    def fn(self, scalar_t score=NAN):
+        return self._class_values_at(self._stats.fp[self._cell(overlap_idx, range_idx, difficulty_idx)], score_idx)
+    def fn(self, scalar_t score=NAN, int overlap_idx=0, int range_idx=0, int difficulty_idx=0):
         '''Return false negative count. If score is not specified, return the median value'''
         cdef int score_idx = self._get_score_idx(score)
-        return {self._class_type(iter.first): iter.second[score_idx] for iter in self._fn}
+        return self._class_values_at(self._stats.fn[self._cell(overlap_idx, range_idx, difficulty_idx)], score_idx)
 
-    def precision(self, scalar_t score=NAN):
+    def precision(self, scalar_t score=NAN, int overlap_idx=0, int range_idx=0, int difficulty_idx=0):
         cdef int score_idx = self._get_score_idx(score)
+        cell = self._cell(overlap_idx, range_idx, difficulty_idx)
+        tp, fp = self._stats.tp[cell], self._stats.fp[cell]
         if isnan(score):
-            p = {k: [None] * self._pr_nsamples for k in self._classes}
-            for k in self._classes:
-                for i in range(self._pr_nsamples):
-                    p[k][i] = calc_precision(self._tp[k][i], self._fp[k][i])
+            p = {k: [calc_precision(tp[c, i], fp[c, i]) for i in range(self._pr_nsamples)]
+                for c, k in enumerate(self._class_values)}
         else:
-            p = {k: calc_precision(self._tp[k][score_idx], self._fp[k][score_idx]) for k in self._classes}
+            p = {k: calc_precision(tp[c, score_idx], fp[c, score_idx]) for c, k in enumerate(self._class_values)}
         return p
-    def recall(self, scalar_t score=NAN):
+    def recall(self, scalar_t score=NAN, int overlap_idx=0, int range_idx=0, int difficulty_idx=0):
         cdef int score_idx = self._get_score_idx(score)
+        cell = self._cell(overlap_idx, range_idx, difficulty_idx)
+        tp, fn = self._stats.tp[cell], self._stats.fn[cell]
         if isnan(score):
-            r = {k: [None] * self._pr_nsamples for k in self._classes}
-            for k in self._classes:
-                for i in range(self._pr_nsamples):
-                    r[k][i] = calc_recall(self._tp[k][i], self._fn[k][i])
+            r = {k: [calc_recall(tp[c, i], fn[c, i]) for i in range(self._pr_nsamples)]
+                for c, k in enumerate(self._class_values)}
         else:
-            r = {k: calc_recall(self._tp[k][score_idx], self._fn[k][score_idx]) for k in self._classes}
+            r = {k: calc_recall(tp[c, score_idx], fn[c, score_idx]) for c, k in enumerate(self._class_values)}
         return r
-    def fscore(self, scalar_t score=NAN, scalar_t beta=1):
-        cdef scalar_t b2 = beta * beta        
+    def fscore(self, scalar_t score=NAN, scalar_t beta=1, int overlap_idx=0, int range_idx=0, int difficulty_idx=0):
+        cdef scalar_t b2 = beta * beta
         cdef int score_idx = self._get_score_idx(score)
+        cell = self._cell(overlap_idx, range_idx, difficulty_idx)
+        tp, fp, fn = self._stats.tp[cell], self._stats.fp[cell], self._stats.fn[cell]
         if isnan(score):
-            fs = {k: [None] * self._pr_nsamples for k in self._classes}
-            for k in self._classes:
-                for i in range(self._pr_nsamples):
-                    fs[k][i] = calc_fscore(self._tp[k][i], self._fp[k][i], self._fn[k][i], b2)
+            fs = {k: [calc_fscore(tp[c, i], fp[c, i], fn[c, i], b2) for i in range(self._pr_nsamples)]
+                for c, k in enumerate(self._class_values)}
         else:
-            fs = {k: calc_fscore(self._tp[k][score_idx], self._fp[k][score_idx], self._fn[k][score_idx], b2)
-                for k in self._classes}
+            fs = {k: calc_fscore(tp[c, score_idx], fp[c, score_idx], fn[c, score_idx], b2)
+                for c, k in enumerate(self._class_values)}
         return fs
 
-    def ap(self):
+    def ap(self, int overlap_idx=0, int range_idx=0, int difficulty_idx=0):
         '''Calculate (mean) average precision'''
-        p, r = self.precision(), self.recall()
+        p = self.precision(overlap_idx=overlap_idx, range_idx=range_idx, difficulty_idx=difficulty_idx)
+        r = self.recall(overlap_idx=overlap_idx, range_idx=range_idx, difficulty_idx=difficulty_idx)
         # usually pr curve grows from bottom right to top left as score threshold
         # increases, so the area can be negative
-        area = {k: -np.trapz(p[k], r[k]) for k in self._classes}
+        area = {k: -_trapezoid(p[k], r[k]) for k in self._class_values}
         return area
 
-    def acc_iou(self, scalar_t score=NAN):
+    def acc_iou(self, scalar_t score=NAN, int overlap_idx=0, int range_idx=0, int difficulty_idx=0):
         cdef int score_idx = self._get_score_idx(score)
-        return {self._class_type(iter.first): iter.second[score_idx] for iter in self._acc_iou}
-    def acc_box(self, scalar_t score=NAN):
+        return self._class_values_at(self._stats.mean("iou")[self._cell(overlap_idx, range_idx, difficulty_idx)], score_idx)
+    def acc_box(self, scalar_t score=NAN, int overlap_idx=0, int range_idx=0, int difficulty_idx=0):
         cdef int score_idx = self._get_score_idx(score)
-        return {self._class_type(iter.first): iter.second[score_idx] for iter in self._acc_box}
-    def acc_dist(self, scalar_t score=NAN):
+        return self._class_values_at(self._stats.mean("box")[self._cell(overlap_idx, range_idx, difficulty_idx)], score_idx)
+    def acc_dist(self, scalar_t score=NAN, int overlap_idx=0, int range_idx=0, int difficulty_idx=0):
         cdef int score_idx = self._get_score_idx(score)
-        return {self._class_type(iter.first): iter.second[score_idx] for iter in self._acc_dist}
-    def acc_angular(self, scalar_t score=NAN):
+        return self._class_values_at(self._stats.mean("dist")[self._cell(overlap_idx, range_idx, difficulty_idx)], score_idx)
+    def acc_angular(self, scalar_t score=NAN, int overlap_idx=0, int range_idx=0, int difficulty_idx=0):
         cdef int score_idx = self._get_score_idx(score)
-        return {self._class_type(iter.first): iter.second[score_idx] for iter in self._acc_angular}
+        return self._class_values_at(self._stats.mean("angular")[self._cell(overlap_idx, range_idx, difficulty_idx)], score_idx)
+
+    cdef str _cell_name(self, int k, int overlap_idx, int range_idx, int difficulty_idx):
+        '''Describe the threshold and bins of the statistics if there are multiple of them'''
+        cdef list names = []
+        if len(self._min_overlaps) > 1:
+            names.append("%s %g" % ("overlap" if self._criterion == "iou" else "distance",
+                self._min_overlaps[overlap_idx][k]))
+        if self._distance_ranges is not None:
+            names.append("range %g-%gm" % self._distance_ranges[range_idx])
+        if self._difficulty_levels is not None:
+            names.append("difficulty %s" % self._difficulty_levels[difficulty_idx])
+        return " (%s)" % ", ".join(names) if names else ""
 
     def summary(self):
         '''
@@ -380,25 +670,432 @@ cdef class ObjectBenchmark:
         cdef int score_idx = self._get_score_idx(score_thres)
 
         cdef list lines = [''] # prepend an empty line
-        precision, recall = self.precision(score_thres), self.recall(score_thres)
-        fscore, ap = self.fscore(), self.ap()
-
         lines.append("========== Benchmark Summary ==========")
-        for k in self._classes:
-            lines.append("Results for %s:" % self._class_type(k).name)
-            lines.append("\tTotal processed targets:\t%d gt boxes, %d dt boxes" % (
-                self._total_gt[k], max(self._total_dt[k])
-            ))
-            lines.append("\tPrecision (score > %.2f):\t%.3f" % (score_thres, precision[k]))
-            lines.append("\tRecall (score > %.2f):\t\t%.3f" % (score_thres, recall[k]))
-            lines.append("\tMax F1:\t\t\t\t%.3f" % max(fscore[k]))
-            lines.append("\tAP:\t\t\t\t%.3f" % ap[k])
-            lines.append("")
-            lines.append("\tMean IoU (score > %.2f):\t\t%.3f" % (score_thres, self._acc_iou[k][score_idx]))
-            lines.append("\tMean angular error (score > %.2f):\t%.3f" % (score_thres, self._acc_angular[k][score_idx]))
-            lines.append("\tMean distance (score > %.2f):\t\t%.3f" % (score_thres, self._acc_dist[k][score_idx]))
-            lines.append("\tMean box error (score > %.2f):\t\t%.3f" % (score_thres, self._acc_box[k][score_idx]))
-            lines.append("\tMean variance error (score > %.2f):\t%.3f" % (score_thres, self._acc_var[k][score_idx]))
+        for o, r, d in np.ndindex(self._stats.ngt.shape[:3]):
+            precision, recall = self.precision(score_thres, o, r, d), self.recall(score_thres, o, r, d)
+            fscore, ap = self.fscore(overlap_idx=o, range_idx=r, difficulty_idx=d), self.ap(o, r, d)
+            cell = self._cell(o, r, d)
+            acc = {name: self._stats.mean(name)[cell] for name in BenchmarkStats.ACCURACIES}
+            for c, k in enumerate(self._class_values):
+                lines.append("Results for %s%s:" % (self._class_type(k).name, self._cell_name(k, o, r, d)))
+                lines.append("\tTotal processed targets:\t%d gt boxes, %d dt boxes" % (
+                    self._stats.ngt[cell][c], max(self._stats.ndt[cell][c])
+                ))
+                lines.append("\tPrecision (score > %.2f):\t%.3f" % (score_thres, precision[k]))
+                lines.append("\tRecall (score > %.2f):\t\t%.3f" % (score_thres, recall[k]))
+                lines.append("\tMax F1:\t\t\t\t%.3f" % max(fscore[k]))
+                lines.append("\tAP:\t\t\t\t%.3f" % ap[k])
+                lines.append("")
+                lines.append("\tMean IoU (score > %.2f):\t\t%.3f" % (score_thres, acc["iou"][c, score_idx]))
+                lines.append("\tMean angular error (score > %.2f):\t%.3f" % (score_thres, acc["angular"][c, score_idx]))
+                lines.append("\tMean distance (score > %.2f):\t\t%.3f" % (score_thres, acc["dist"][c, score_idx]))
+                lines.append("\tMean box error (score > %.2f):\t\t%.3f" % (score_thres, acc["box"][c, score_idx]))
+                lines.append("\tMean variance error (score > %.2f):\t%.3f" % (score_thres, acc["var"][c, score_idx]))
+        lines.append("========== Summary End ==========")
+
+        return '\n'.join(lines)
+
+_worker_benchmark = None
+_worker_loader = None
+
+def _init_worker(benchmark, loader):
+    global _worker_benchmark, _worker_loader
+    _worker_benchmark = benchmark
+    _worker_loader = loader
+
+def _frame_stats(frame):
+    if _worker_loader is not None:
+        frame = _worker_loader(frame)
+    return _worker_benchmark.get_stats(*frame)
+
+@profile()
+def get_stats_parallel(ObjectBenchmark benchmark, frames, loader=None, int nworkers=8, int chunksize=4):
+    '''
+    Calculate the statistics of frames in a process pool and reduce them. The result is not added into
+    the benchmark, call add_stats to do that (or merge it with the statistics from other ranks first).
+
+    :param benchmark: the benchmark, it's sent to the workers once when they are created
+    :param frames: iterable of (gt_boxes, dt_boxes[, gt_difficulty]), or the arguments of the loader
+    :param loader: function that loads (gt_boxes, dt_boxes[, gt_difficulty]) of a frame from the element of frames. It's
+        called in the workers so that the objects don't need to be sent across processes
+    :param nworkers: number of worker processes
+    :return: BenchmarkStats reduced from all the frames
+    '''
+    total = benchmark._empty_stats()
+    with Pool(nworkers, initializer=_init_worker, initargs=(benchmark, loader)) as pool:
+        for stats in pool.imap_unordered(_frame_stats, frames, chunksize=chunksize):
+            total += stats
+    return total
+
+cdef int _KittiSamplePoints = 41
+cdef double _KittiNoDetection = -10000000
+_KittiDifficulties = ("easy", "moderate", "hard")
+_KittiMinHeight = (40, 25, 25)
+_KittiMaxOcclusion = (0, 1, 2)
+_KittiMaxTruncation = (0.15, 0.3, 0.5)
+_KittiNeighbors = {"Car": "Van", "Pedestrian": "Person_sitting"} # ground truths that are ignored instead of missed
+_KittiMinOverlaps = {"Car": 0.7, "Van": 0.7, "Truck": 0.7, "Tram": 0.7} # other classes use 0.5
+
+cdef struct _KittiCounts:
+    long long tp, fp, fn
+    double similarity
+
+cdef _KittiCounts _kitti_statistics(const float[:] overlap, const float[:] cover, const Py_ssize_t[:] pair_offset,
+    const Py_ssize_t[:] gt_offset, const Py_ssize_t[:] dt_offset, const signed char[:] ignored_gt,
+    const signed char[:] dontcare, const signed char[:] ignored_dt, const double[:] score,
+    const double[:] gt_alpha, const double[:] dt_alpha, double min_overlap, bint compute_fp, bint compute_aos,
+    double thres, vector[double]* tp_scores) noexcept nogil:
+    '''
+    Port of computeStatistics in the official KITTI devkit (evaluate_object.cpp), summed over all frames. The
+    overlaps of a frame are stored as a flattened gt x dt matrix starting at pair_offset. Ignored flags are
+    0 for evaluated targets, 1 for ignored targets and -1 for targets of other classes. If compute_fp is False,
+    the scores of the true positives are collected into tp_scores to generate the score thresholds.
+    '''
+    cdef _KittiCounts total
+    total.tp, total.fp, total.fn, total.similarity = 0, 0, 0, 0
+    cdef Py_ssize_t f, g, j, g0, d0, ngt, ndt, base, det_idx, ntp, nfp
+    cdef double valid_detection, max_iou, iou, similarity
+    cdef bint assigned_ignored
+    cdef vector[char] assigned
+
+    for f in range(gt_offset.shape[0] - 1):
+        g0, ngt = gt_offset[f], gt_offset[f+1] - gt_offset[f]
+        d0, ndt = dt_offset[f], dt_offset[f+1] - dt_offset[f]
+        base = pair_offset[f]
+        assigned.assign(ndt, 0)
+        ntp, nfp, similarity = 0, 0, 0
+
+        # assign detections to ground truths
+        for g in range(ngt):
+            if ignored_gt[g0+g] == -1:
+                continue
+            det_idx, valid_detection, max_iou, assigned_ignored = -1, _KittiNoDetection, 0, False
+            for j in range(ndt):
+                if ignored_dt[d0+j] == -1 or assigned[j]:
+                    continue
+                if compute_fp and score[d0+j] < thres:
+                    continue
+                iou = overlap[base + g*ndt + j]
+                if iou <= min_overlap:
+                    continue
+                if not compute_fp:
+                    if score[d0+j] > valid_detection:
+                        det_idx, valid_detection = j, score[d0+j]
+                elif ignored_dt[d0+j] == 0 and (iou > max_iou or assigned_ignored):
+                    det_idx, valid_detection, max_iou, assigned_ignored = j, 1, iou, False
+                elif valid_detection == _KittiNoDetection and ignored_dt[d0+j] == 1:
+                    det_idx, valid_detection, assigned_ignored = j, 1, True
+
+            if valid_detection == _KittiNoDetection:
+                if ignored_gt[g0+g] == 0:
+                    total.fn += 1
+            elif ignored_gt[g0+g] == 1 or ignored_dt[d0+det_idx] == 1:
+                assigned[det_idx] = 1
+            else:
+                ntp += 1
+                assigned[det_idx] = 1
+                if not compute_fp:
+                    tp_scores.push_back(score[d0+det_idx])
+                if compute_aos:
+                    similarity += (1 + cos(gt_alpha[g0+g] - dt_alpha[d0+det_idx])) / 2
+
+        if compute_fp:
+            for j in range(ndt):
+                if not assigned[j] and ignored_dt[d0+j] == 0 and score[d0+j] >= thres:
+                    nfp += 1
+
+            # detections in the DontCare areas are not false positives
+            if cover.shape[0] > 0:
+                for g in range(ngt):
+                    if not dontcare[g0+g]:
+                        continue
+                    for j in range(ndt):
+                        if assigned[j] or ignored_dt[d0+j] != 0 or score[d0+j] < thres:
+                            continue
+                        if cover[base + g*ndt + j] > min_overlap:
+                            assigned[j] = 1
+                            nfp -= 1
+
+        total.tp += ntp
+        total.fp += nfp
+        total.similarity += similarity
+    return total
+
+def _kitti_thresholds(scores, long long ngt):
+    '''Port of getThresholds in the official KITTI devkit, sample score thresholds at equally spaced recalls'''
+    cdef Py_ssize_t i, n = len(scores)
+    cdef double l_recall, r_recall, current_recall = 0
+    cdef list thresholds = []
+    scores = np.sort(scores)[::-1]
+    for i in range(n):
+        l_recall = <double>(i + 1) / ngt
+        r_recall = <double>(i + 2) / ngt if i < n - 1 else l_recall
+        if r_recall - current_recall < current_recall - l_recall and i < n - 1:
+            continue
+        thresholds.append(scores[i])
+        current_recall += 1.0 / (_KittiSamplePoints - 1)
+    return thresholds
+
+def _kitti_overlaps(gt_cols, dt_cols, str metric):
+    '''
+    Calculate the overlaps used by a KITTI metric in camera coordinates. The BEV boxes lie in the x-z plane
+    and the rotation around y axis is consistent with box2d functions.
+    '''
+    if metric == "bbox":
+        boxes = [np.concatenate([(c.bbox[:, :2] + c.bbox[:, 2:]) / 2, c.bbox[:, 2:] - c.bbox[:, :2],
+            np.zeros((len(c.bbox), 1))], axis=1) for c in (gt_cols, dt_cols)]
+        method = "box"
+    elif metric == "bev":
+        boxes = [np.stack([c.location[:, 0], c.location[:, 2], c.dimension[:, 2], c.dimension[:, 1], c.rotation_y],
+            axis=1) for c in (gt_cols, dt_cols)]
+        method = "rbox"
+    elif metric == "3d":
+        boxes = [np.stack([c.location[:, 0], c.location[:, 2], c.location[:, 1] - c.dimension[:, 0] / 2,
+            c.dimension[:, 2], c.dimension[:, 1], c.dimension[:, 0], c.rotation_y], axis=1) for c in (gt_cols, dt_cols)]
+        method = "box3d"
+    else:
+        raise ValueError("Unrecognized KITTI metric: %s" % metric)
+
+    if len(boxes[0]) == 0 or len(boxes[1]) == 0:
+        return np.zeros((len(boxes[0]), len(boxes[1])), dtype=np.float32)
+    boxes = [torch.from_numpy(np.ascontiguousarray(b, dtype=np.float32)) for b in boxes]
+    return box2d_iou(boxes[0], boxes[1], method=method).numpy()
+
+def _kitti_cover(gt_bbox, dt_bbox):
+    '''Intersection of the 2D boxes divided by the area of the detection, used for DontCare areas'''
+    width = np.minimum(gt_bbox[:, None, 2], dt_bbox[None, :, 2]) - np.maximum(gt_bbox[:, None, 0], dt_bbox[None, :, 0])
+    height = np.minimum(gt_bbox[:, None, 3], dt_bbox[None, :, 3]) - np.maximum(gt_bbox[:, None, 1], dt_bbox[None, :, 1])
+    area = (dt_bbox[:, 2] - dt_bbox[:, 0]) * (dt_bbox[:, 3] - dt_bbox[:, 1])
+    with np.errstate(divide='ignore', invalid='ignore'):
+        cover = np.clip(width, 0, None) * np.clip(height, 0, None) / area
+    return np.nan_to_num(cover).astype(np.float32)
+
+class KittiObjectBenchmark:
+    '''
+    In-process implementation of the official KITTI object detection benchmark (2D, BEV and 3D AP with
+    easy, moderate and hard difficulties). The evaluation follows the devkit, so that the numbers are the
+    same as those from the official evaluator without writing result files.
+
+    The targets are given in columnar format with KITTI label fields in camera coordinates, see
+    d3d.dataset.kitti.object.label_columns and d3d.dataset.kitti.object.object_columns
+    '''
+    METRICS = ("bbox", "bev", "3d")
+
+    def __init__(self, classes, min_overlaps=None, metrics=METRICS):
+        '''
+        :param classes: Object classes to evaluate (members of KittiObjectClass)
+        :param min_overlaps: Min overlaps per class for a detection being a true positive, can be a single value,
+            values aligned with the classes or a dict. By default 0.7 is used for vehicles and 0.5 for others
+        :param metrics: Overlap metrics to evaluate, {bbox: 2D box on image, bev: rotated box in bird's eye view,
+            3d: rotated 3D box}. Orientation similarity (AOS) is calculated along with bbox.
+        '''
+        if not isinstance(classes, (list, tuple)):
+            classes = [classes]
+        self._class_type = type(classes[0])
+        self._class_values = [c.value for c in classes]
+        members = self._class_type.__members__
+
+        if min_overlaps is None:
+            min_overlaps = {c.value: _KittiMinOverlaps.get(c.name, 0.5) for c in classes}
+        elif isinstance(min_overlaps, dict):
+            min_overlaps = {getattr(c, "value", c): v for c, v in min_overlaps.items()}
+        elif isinstance(min_overlaps, (list, tuple, np.ndarray)):
+            if len(min_overlaps) != len(classes):
+                raise ValueError("Number of thresholds is inconsistent with the number of classes!")
+            min_overlaps = {c: v for c, v in zip(self._class_values, min_overlaps)}
+        else:
+            min_overlaps = {c: min_overlaps for c in self._class_values}
+        self._min_overlaps = [float(min_overlaps[c]) for c in self._class_values]
+
+        for metric in metrics:
+            if metric not in self.METRICS:
+                raise ValueError("Unrecognized KITTI metric: %s" % metric)
+        self._metrics = list(metrics)
+        self._neighbors = [members[_KittiNeighbors[c.name]].value
+            if c.name in _KittiNeighbors and _KittiNeighbors[c.name] in members else None for c in classes]
+        self._dontcare = members["DontCare"].value if "DontCare" in members else None
+
+        self.reset()
+
+    def reset(self):
+        self._frames = []
+        self._results = None
+
+    @profile()
+    def add_frame(self, gt_cols, dt_cols):
+        '''
+        Add the targets of one frame. The overlaps are calculated immediately and only the fields used in
+        the evaluation are kept.
+
+        :param gt_cols: ground truths with fields label, truncation, occlusion, alpha, bbox, dimension (h, w, l),
+            location and rotation_y. DontCare areas should be kept in the ground truths.
+        :param dt_cols: detections with fields label, alpha, bbox, dimension, location, rotation_y and score
+        '''
+        gt_cols, dt_cols = edict(gt_cols), edict(dt_cols)
+        for cols in (gt_cols, dt_cols):
+            cols.bbox = np.asarray(cols.bbox, dtype=np.float64).reshape(-1, 4)
+            cols.location = np.asarray(cols.location, dtype=np.float64).reshape(-1, 3)
+            cols.dimension = np.asarray(cols.dimension, dtype=np.float64).reshape(-1, 3)
+            cols.rotation_y = np.asarray(cols.rotation_y, dtype=np.float64)
+
+        gt_label = np.asarray(gt_cols.label, dtype=np.int32)
+        frame = edict(
+            gt_label=gt_label,
+            gt_truncation=np.asarray(gt_cols.truncation, dtype=np.float64),
+            gt_occlusion=np.asarray(gt_cols.occlusion, dtype=np.float64),
+            gt_height=np.abs(gt_cols.bbox[:, 3] - gt_cols.bbox[:, 1]),
+            gt_alpha=np.asarray(gt_cols.alpha, dtype=np.float64),
+            dt_label=np.asarray(dt_cols.label, dtype=np.int32),
+            dt_height=np.abs(dt_cols.bbox[:, 3] - dt_cols.bbox[:, 1]),
+            dt_alpha=np.asarray(dt_cols.alpha, dtype=np.float64),
+            dt_score=np.asarray(dt_cols.score, dtype=np.float64),
+            overlaps={metric: _kitti_overlaps(gt_cols, dt_cols, metric).ravel() for metric in self._metrics}
+        )
+        if "bbox" in self._metrics:
+            frame.cover = _kitti_cover(gt_cols.bbox, dt_cols.bbox).ravel()
+
+        self._frames.append(frame)
+        self._results = None
+
+    def _evaluate_class(self, columns, str metric, int c, int difficulty):
+        '''Calculate the interpolated precision (and AOS) at the 41 sample points of a class'''
+        cdef int k = self._class_values[c]
+        cdef double min_overlap = self._min_overlaps[c]
+        cdef bint compute_aos = metric == "bbox"
+
+        # ignored flags of the targets, see cleanData in the devkit
+        gt_valid = np.where(columns.gt_label == k, 1, -1)
+        if self._neighbors[c] is not None:
+            gt_valid[columns.gt_label == self._neighbors[c]] = 0
+        ignore = (columns.gt_occlusion > _KittiMaxOcclusion[difficulty]) \
+            | (columns.gt_truncation > _KittiMaxTruncation[difficulty]) \
+            | (columns.gt_height <= _KittiMinHeight[difficulty])
+        ignored_gt = np.full(len(gt_valid), -1, dtype=np.int8)
+        ignored_gt[(gt_valid == 0) | ((gt_valid == 1) & ignore)] = 1
+        ignored_gt[(gt_valid == 1) & ~ignore] = 0
+        ignored_dt = np.where(columns.dt_label == k, 0, -1).astype(np.int8)
+        ignored_dt[columns.dt_height < _KittiMinHeight[difficulty]] = 1
+
+        overlap = columns.overlaps[metric]
+        cover = columns.cover if metric == "bbox" else np.empty(0, dtype=np.float32)
+        pair_offset, gt_offset, dt_offset = columns.pair_offset, columns.gt_offset, columns.dt_offset
+        dontcare, score = columns.dontcare, columns.dt_score
+        gt_alpha, dt_alpha = columns.gt_alpha, columns.dt_alpha
+
+        # score thresholds are sampled from the true positives
+        cdef vector[double] tp_scores
+        cdef _KittiCounts counts
+        cdef double thres
+        cdef const float[:] overlap_view = overlap, cover_view = cover
+        cdef const Py_ssize_t[:] pair_offset_view = pair_offset, gt_offset_view = gt_offset
+        cdef const Py_ssize_t[:] dt_offset_view = dt_offset
+        cdef const signed char[:] ignored_gt_view = ignored_gt, dontcare_view = dontcare
+        cdef const signed char[:] ignored_dt_view = ignored_dt
+        cdef const double[:] score_view = score, gt_alpha_view = gt_alpha, dt_alpha_view = dt_alpha
+        with nogil:
+            _kitti_statistics(overlap_view, cover_view, pair_offset_view, gt_offset_view, dt_offset_view,
+                ignored_gt_view, dontcare_view, ignored_dt_view, score_view, gt_alpha_view, dt_alpha_view,
+                min_overlap, False, False, 0, &tp_scores)
+        thresholds = _kitti_thresholds(np.array(tp_scores, dtype=np.float64), np.sum(ignored_gt == 0))
+
+        precision = np.zeros(_KittiSamplePoints)
+        aos = np.zeros(_KittiSamplePoints)
+        for t, thres in enumerate(thresholds):
+            with nogil:
+                counts = _kitti_statistics(overlap_view, cover_view, pair_offset_view, gt_offset_view,
+                    dt_offset_view, ignored_gt_view, dontcare_view, ignored_dt_view, score_view, gt_alpha_view,
+                    dt_alpha_view, min_overlap, True, compute_aos, thres, NULL)
+            if counts.tp + counts.fp > 0:
+                precision[t] = <double>counts.tp / (counts.tp + counts.fp)
+                aos[t] = counts.similarity / (counts.tp + counts.fp)
+        precision = np.maximum.accumulate(precision[::-1])[::-1]
+        aos = np.maximum.accumulate(aos[::-1])[::-1]
+        return precision, aos
+
+    @profile()
+    def evaluate(self):
+        '''
+        Evaluate all the added frames, the results are cached until new frames are added.
+
+        :return: interpolated precisions and orientation similarities at the 41 recall sample points, with
+            shape (metrics x difficulties x classes x 41). AOS is NaN if the metric is not bbox.
+        '''
+        if self._results is not None:
+            return self._results
+
+        # concatenate the frames, overlaps of each frame are stored as flattened matrices
+        frames = self._frames
+        columns = edict()
+        for name in ["gt_label", "gt_truncation", "gt_occlusion", "gt_height", "gt_alpha",
+                     "dt_label", "dt_height", "dt_alpha", "dt_score"]:
+            dtype = np.int32 if name.endswith("label") else np.float64
+            columns[name] = np.concatenate([f[name] for f in frames]).astype(dtype) if frames else np.empty(0, dtype)
+        columns.dontcare = (columns.gt_label == (self._dontcare if self._dontcare is not None else -1)).astype(np.int8)
+        ngt = np.array([len(f.gt_label) for f in frames], dtype=np.intp)
+        ndt = np.array([len(f.dt_label) for f in frames], dtype=np.intp)
+        columns.gt_offset = np.concatenate([[0], np.cumsum(ngt)]).astype(np.intp)
+        columns.dt_offset = np.concatenate([[0], np.cumsum(ndt)]).astype(np.intp)
+        columns.pair_offset = np.concatenate([[0], np.cumsum(ngt * ndt)]).astype(np.intp)
+        columns.overlaps = {metric: np.concatenate([f.overlaps[metric] for f in frames] + [np.empty(0, np.float32)])
+            for metric in self._metrics}
+        if "bbox" in self._metrics:
+            columns.cover = np.concatenate([f.cover for f in frames] + [np.empty(0, np.float32)])
+
+        shape = (len(self._metrics), len(_KittiDifficulties), len(self._class_values), _KittiSamplePoints)
+        self._results = edict(precision=np.zeros(shape), aos=np.full(shape, np.nan))
+        for m, metric in enumerate(self._metrics):
+            for d in range(len(_KittiDifficulties)):
+                for c in range(len(self._class_values)):
+                    precision, aos = self._evaluate_class(columns, metric, c, d)
+                    self._results.precision[m, d, c] = precision
+                    if metric == "bbox":
+                        self._results.aos[m, d, c] = aos
+        return self._results
+
+    def _average(self, values, int sample_points):
+        if sample_points == 11:
+            return np.sum(values[..., 0::4], axis=-1) / 11 * 100
+        elif sample_points == 40:
+            return np.sum(values[..., 1:], axis=-1) / 40 * 100
+        else:
+            raise ValueError("KITTI AP uses either 11 or 40 sample points!")
+
+    def ap(self, str metric="3d", str difficulty="moderate", int sample_points=40):
+        '''
+        Return the average precision (in percentage) of each class
+
+        :param metric: one of bbox, bev and 3d
+        :param difficulty: one of easy, moderate and hard
+        :param sample_points: 40 for the current official metric (R40), 11 for the metric before Oct 2019 (R11)
+        '''
+        results = self.evaluate()
+        ap = self._average(results.precision[self._metrics.index(metric), _KittiDifficulties.index(difficulty)],
+            sample_points)
+        return {self._class_type(k): ap[c] for c, k in enumerate(self._class_values)}
+
+    def aos(self, str difficulty="moderate", int sample_points=40):
+        '''Return the average orientation similarity (in percentage) of each class, requires the bbox metric'''
+        results = self.evaluate()
+        aos = self._average(results.aos[self._metrics.index("bbox"), _KittiDifficulties.index(difficulty)],
+            sample_points)
+        return {self._class_type(k): aos[c] for c, k in enumerate(self._class_values)}
+
+    def summary(self, int sample_points=40):
+        '''
+        Print the summary in the format of the official evaluator (into returned string)
+        '''
+        results = self.evaluate()
+        ap = self._average(results.precision, sample_points)
+        aos = self._average(results.aos, sample_points)
+
+        cdef list lines = [''] # prepend an empty line
+        lines.append("========== KITTI Benchmark Summary (R%d) ==========" % sample_points)
+        for c, k in enumerate(self._class_values):
+            lines.append("%s AP@%.2f:" % (self._class_type(k).name, self._min_overlaps[c]))
+            for m, metric in enumerate(self._metrics):
+                lines.append("\t%s AP:\t%.4f, %.4f, %.4f" % ((metric,) + tuple(ap[m, :, c])))
+            if "bbox" in self._metrics:
+                lines.append("\taos AP:\t%.4f, %.4f, %.4f" % tuple(aos[self._metrics.index("bbox"), :, c]))
         lines.append("========== Summary End ==========")
 
         return '\n'.join(lines)
@@ -1,32 +1,149 @@
+import numpy as np
 import torch
 from .box_impl import (
     iou2d as iou2d_cc, iou2d_cuda,
+    iou2d_sparse as iou2d_sparse_cc, iou2d_sparse_cuda,
+    iou2d_loss_forward as iou2d_loss_forward_cc, iou2d_loss_forward_cuda,
+    iou2d_loss_backward as iou2d_loss_backward_cc, iou2d_loss_backward_cuda,
     nms2d as nms2d_cc, nms2d_cuda,
+    nms2d_batched as nms2d_batched_cc, nms2d_batched_cuda,
     rbox_2d_crop as rbox_2d_crop_cc,
-    IouType, SupressionType)
+    IouType, IouLossType, SupressionType)
+
+_IOU_METHODS = dict(box=IouType.BOX, rbox=IouType.RBOX, bev=IouType.RBOX, box3d=IouType.BOX3D)
+
+def box2d_from_flu(boxes):
+    '''
+    Convert boxes whose yaw is defined in FLU coordinates (counter-clockwise in bird's eye view) to the
+    input of box functions in this module, whose rotation is clockwise (see d3d/box/geometry.hpp).
+
+    :param boxes: boxes (x, y, l, w, yaw) with shape N x 5 or (x, y, z, l, w, h, yaw) with shape N x 7,
+        numpy arrays are converted to float tensors
+    :return: a tensor of the boxes with the sign of yaw flipped
+    '''
+    if not isinstance(boxes, torch.Tensor):
+        boxes = torch.from_numpy(np.asarray(boxes, dtype=np.float32))
+    if len(boxes.shape) != 2 or boxes.shape[1] not in [5, 7]:
+        raise ValueError("Input boxes should be Nx5 (x, y, l, w, yaw) or Nx7 (x, y, z, l, w, h, yaw) tensors!")
+
+    boxes = boxes.clone()
+    boxes[:, -1] = -boxes[:, -1]
+    return boxes
+
+def _prepare_boxes(boxes, method):
+    '''
+    Select the box fields used by the iou method. Boxes can have 5 fields (x, y, w, h, r)
+    or 7 fields (x, y, z, w, h, d, r), the 3D boxes are assumed to be upright.
+    '''
+    if method not in _IOU_METHODS:
+        raise ValueError("Invalid iou method %s, valid options are %s" % (method, ", ".join(_IOU_METHODS)))
+    if len(boxes.shape) != 2 or boxes.shape[1] not in [5, 7]:
+        raise ValueError("Input boxes should be Nx5 (x, y, w, h, r) or Nx7 (x, y, z, w, h, d, r) tensors!")
+
+    if method == "box3d":
+        if boxes.shape[1] != 7:
+            raise ValueError("3D IoU requires boxes with 7 fields: x, y, z, w, h, d, r")
+        return boxes
+    elif boxes.shape[1] == 7: # use bird's eye view
+        return boxes[:, [0, 1, 3, 4, 6]]
+    return boxes
 
 def box2d_iou(boxes1, boxes2, method="box"):
     '''
-    :param method: 'box' - normal box, 'rbox' - rotated box
+    :param method: 'box' - normal box, 'rbox' - rotated box, 'bev' - rotated box in bird's eye view
+        (same as 'rbox'), 'box3d' - rotated 3D box (requires 7 fields)
     '''
-    if len(boxes1.shape) != 2 or len(boxes2.shape) != 2:
-        raise ValueError("Input of rbox_2d_iou should be Nx2 tensors!")
-    if boxes1.shape[1] != 5 or boxes2.shape[1] != 5:
-        raise ValueError("Input boxes should have 5 fields: x, y, w, h, r")
+    iou_type = _IOU_METHODS.get(method, None)
+    boxes1 = _prepare_boxes(boxes1, method)
+    boxes2 = _prepare_boxes(boxes2, method)
 
-    iou_type = getattr(IouType, method.upper())
     if boxes1.is_cuda and boxes2.is_cuda:
         impl = iou2d_cuda
     else:
         impl = iou2d_cc
     return impl(boxes1, boxes2, iou_type)
 
-# TODO: implement IoU loss, GIoU, DIoU, CIoU: https://zhuanlan.zhihu.com/p/104236411
+def box2d_iou_sparse(boxes1, boxes2, method="box", as_tensor=False):
+    '''
+    Calculate IoU only for the overlapping pairs of boxes. Pairs are rejected by their bounding boxes
+    (indexed by a uniform grid) and bounding circles (CPU only) before the exact IoU is calculated, which is
+    much faster than box2d_iou when most of the boxes are far apart (e.g. anchors and ground truth boxes).
+
+    :param method: same as box2d_iou
+    :param as_tensor: If True, the result is returned as a sparse COO tensor with shape N x M
+    :return: (indices, values). indices is a 2 x K tensor of (index in boxes1, index in boxes2) sorted
+        by rows, values are the IoUs of these pairs (all positive).
+    '''
+    iou_type = _IOU_METHODS.get(method, None)
+    boxes1 = _prepare_boxes(boxes1, method)
+    boxes2 = _prepare_boxes(boxes2, method)
+
+    if boxes1.is_cuda and boxes2.is_cuda:
+        impl = iou2d_sparse_cuda
+    else:
+        impl = iou2d_sparse_cc
+    indices, values = impl(boxes1, boxes2, iou_type)
+
+    if as_tensor:
+        return torch.sparse_coo_tensor(indices, values, (len(boxes1), len(boxes2)), is_coalesced=True)
+    return indices, values
+
+class _IouLossFunction(torch.autograd.Function):
+    @staticmethod
+    def forward(ctx, boxes1, boxes2, loss_type):
+        ctx.save_for_backward(boxes1, boxes2)
+        ctx.loss_type = loss_type
+        if boxes1.is_cuda and boxes2.is_cuda:
+            return iou2d_loss_forward_cuda(boxes1, boxes2, loss_type)
+        return iou2d_loss_forward_cc(boxes1, boxes2, loss_type)
+
+    @staticmethod
+    def backward(ctx, grad):
+        boxes1, boxes2 = ctx.saved_tensors
+        grad = grad.contiguous()
+        if boxes1.is_cuda and boxes2.is_cuda:
+            grad1, grad2 = iou2d_loss_backward_cuda(boxes1, boxes2, grad, ctx.loss_type)
+        else:
+            grad1, grad2 = iou2d_loss_backward_cc(boxes1, boxes2, grad, ctx.loss_type)
+        return grad1, grad2, None
+
+def box2d_iou_loss(boxes1, boxes2, loss_type="iou"):
+    '''
+    Calculate IoU-family losses between paired rotated boxes (boxes1[i] and boxes2[i]), the gradients
+    are calculated natively for both inputs.
+
+    :param boxes1: boxes (x, y, w, h, r) with shape N x 5, usually the predictions
+    :param boxes2: boxes (x, y, w, h, r) with shape N x 5, usually the targets
+    :param loss_type: 'iou' - 1 - IoU, 'giou' - generalized IoU loss, 'diou' - distance IoU loss,
+        'ciou' - complete IoU loss. The enclosing box used in GIoU and DIoU is axis aligned.
+    :return: losses with shape N
+
+    GIoU: Rezatofighi, Hamid, et al. "Generalized intersection over union: A metric and a loss for bounding box regression." CVPR 2019.
+    DIoU/CIoU: Zheng, Zhaohui, et al. "Distance-IoU loss: Faster and better learning for bounding box regression." AAAI 2020.
+    '''
+    if len(boxes1.shape) != 2 or boxes1.shape[1] != 5 or boxes1.shape != boxes2.shape:
+        raise ValueError("Input boxes should be paired Nx5 tensors!")
+    loss_type = getattr(IouLossType, loss_type.upper())
+
+    if len(boxes1) == 0:
+        return boxes1.new_empty(0)
+    return _IouLossFunction.apply(boxes1.contiguous(), boxes2.contiguous(), loss_type)
+
+def box2d_iou_paired(boxes1, boxes2):
+    '''
+    Calculate the IoU between paired rotated boxes (boxes1[i] and boxes2[i]) with shape N x 5, this is
+    the forward pass of box2d_iou_loss and it's differentiable.
+    '''
+    return 1 - box2d_iou_loss(boxes1, boxes2, loss_type="iou")
 
 def box2d_nms(boxes, scores, iou_method="box", supression_method="hard",
-    iou_threshold=0, score_threshold=0, supression_param=0):
+    iou_threshold=0, score_threshold=0, supression_param=0, pre_nms_top_n=0, max_output=0):
     '''
-    :param method: 'box' - normal box, 'rbox' - rotated box
+    :param iou_method: 'box' - normal box, 'rbox' - rotated box, 'bev' - rotated box in bird's eye view
+        (same as 'rbox'), 'box3d' - rotated 3D box (requires 7 fields)
+    :param pre_nms_top_n: only the boxes with top n scores are considered in NMS, 0 means no limit
+    :param max_output: maximum number of kept boxes, 0 means no limit
+    :return: mask of the kept boxes
 
     Soft-NMS: Bodla, Navaneeth, et al. "Soft-NMS--improving object detection with one line of code." Proceedings of the IEEE international conference on computer vision. 2017.
     '''
@@ -38,9 +155,18 @@ def box2d_nms(boxes, scores, iou_method="box", supression_method="hard",
     if boxes.numel() == 0:
         return torch.tensor([], dtype=torch.bool)
 
-    iou_type = getattr(IouType, iou_method.upper())
+    iou_type = _IOU_METHODS.get(iou_method, None)
+    boxes = _prepare_boxes(boxes, iou_method)
     supression_type = getattr(SupressionType, supression_method.upper())
 
+    if pre_nms_top_n > 0 and len(scores) > pre_nms_top_n:
+        top_idx = scores.topk(pre_nms_top_n).indices
+        top_mask = box2d_nms(boxes[top_idx], scores[top_idx], iou_method, supression_method,
+            iou_threshold, score_threshold, supression_param, max_output=max_output)
+        mask = torch.zeros(len(scores), dtype=torch.bool, device=top_mask.device)
+        mask[top_idx[top_mask]] = True
+        return mask
+
     if boxes.is_cuda and scores.is_cuda:
         impl = nms2d_cuda
     else:
@@ -48,15 +174,89 @@ def box2d_nms(boxes, scores, iou_method="box", supression_method="hard",
 
     suppressed = impl(boxes, scores,
         iou_type, supression_type,
-        iou_threshold, score_threshold, supression_param
+        iou_threshold, score_threshold, supression_param, max_output
     )
     return ~suppressed
 
+def box2d_nms_batched(boxes, scores, batch_indices=None, class_indices=None, iou_method="box",
+    iou_threshold=0, score_threshold=0, max_per_group=0):
+    '''
+    Hard NMS applied independently in each (batch, class) group of boxes, all groups are processed in one call.
+
+    :param boxes: boxes of all samples and classes, with shape N x 5 or N x 7
+    :param scores: scores of the boxes with shape N. If scores have shape N x C and class_indices is not
+        given, the class with maximum score is used for each box
+    :param batch_indices: index of the sample each box belongs to, with shape N
+    :param class_indices: class index of each box, with shape N
+    :param iou_method: same as box2d_nms
+    :param max_per_group: maximum number of boxes kept in each group (top-k by score), 0 means no limit
+    :return: indices of the kept boxes, sorted by batch index, class index and then descending score
+    '''
+    if len(boxes) != len(scores):
+        raise ValueError("Numbers of boxes and scores are inconsistent!")
+    if len(scores.shape) == 2:
+        if class_indices is None:
+            scores, class_indices = scores.max(axis=1)
+        else:
+            scores = scores.max(axis=1).values
+
+    if boxes.numel() == 0:
+        return torch.tensor([], dtype=torch.long, device=boxes.device)
+
+    iou_type = _IOU_METHODS.get(iou_method, None)
+    boxes = _prepare_boxes(boxes, iou_method)
+
+    # combine batch and class indices into contiguous group indices
+    keys = torch.zeros(len(boxes), dtype=torch.long, device=boxes.device)
+    if batch_indices is not None:
+        keys += torch.as_tensor(batch_indices, dtype=torch.long, device=boxes.device)
+    if class_indices is not None:
+        class_indices = torch.as_tensor(class_indices, dtype=torch.long, device=boxes.device)
+        keys = keys * (int(class_indices.max()) + 1) + class_indices
+    groups = torch.unique(keys, return_inverse=True)[1]
+
+    if boxes.is_cuda and scores.is_cuda:
+        impl = nms2d_batched_cuda
+    else:
+        impl = nms2d_batched_cc
+    return impl(boxes, scores, groups, iou_type, iou_threshold, score_threshold, max_per_group)
+
+def box_crop(cloud, boxes, zranges=None):
+    '''
+    Crop points out of a point cloud given rotated boxes. The points are binned into a BEV grid first,
+    so only the points in the cells covered by a box are tested.
+
+    :param cloud: point cloud with shape N x C, the first two (three if z is checked) columns are coordinates
+    :param boxes: BEV boxes (x, y, w, h, r) with shape M x 5, or 3D boxes (x, y, z, w, h, d, r) with shape M x 7.
+        3D boxes are assumed to be upright, the points are also checked with their z ranges
+    :param zranges: optional z ranges (min, max) for BEV boxes, with shape M x 2
+    :return: (indices, offsets, box_ids). indices[offsets[i]:offsets[i+1]] are the indices of the points in the
+        i-th box in ascending order. box_ids is the index of the box containing each point (-1 if the point is
+        not in any box, the smallest index is used if the point is in multiple boxes).
+    '''
+    if len(cloud.shape) != 2 or len(boxes.shape) != 2:
+        raise ValueError("Input of box_crop should be two dimensional tensors!")
+    if boxes.shape[1] == 7:
+        if zranges is not None:
+            raise ValueError("Z ranges cannot be specified for 3D boxes")
+        zranges = torch.stack([boxes[:, 2] - boxes[:, 5] / 2, boxes[:, 2] + boxes[:, 5] / 2], dim=1)
+        boxes = boxes[:, [0, 1, 3, 4, 6]]
+    elif boxes.shape[1] != 5:
+        raise ValueError("Input boxes should have 5 fields (x, y, w, h, r) or 7 fields (x, y, z, w, h, d, r)")
+
+    boxes = boxes.to(cloud.dtype)
+    if zranges is None:
+        zranges = torch.empty((0, 2), dtype=cloud.dtype)
+    else:
+        zranges = zranges.to(cloud.dtype)
+    indices, offsets, box_ids = rbox_2d_crop_cc(cloud, boxes, zranges)
+    return indices, offsets, box_ids
+
 def box2d_crop(cloud, boxes):
     '''
     Crop point cloud points out given rotated boxes.
     The result is a list of indices tensor where each tensor is corresponding to indices of points lying in the box
     '''
 
-    result = rbox_2d_crop_cc(cloud, boxes)
-    return result
+    indices, offsets, _ = box_crop(cloud, boxes)
+    return list(torch.split(indices, (offsets[1:] - offsets[:-1]).tolist()))
@@ -1,7 +1,16 @@
 #pragma once
 
-enum class IouType : int { NA=0, BOX=1, RBOX=2 };
+#include "d3d/box/geometry.hpp"
+
+enum class IouType : int { NA=0, BOX=1, RBOX=2, BOX3D=3 };
 enum class SupressionType : int { HARD=0, LINEAR=1, GAUSSIAN=2 };
+enum class IouLossType : int { IOU=0, GIOU=1, DIOU=2, CIOU=3 };
+
+// box types used for each iou type
+template <IouType Iou> struct _IouBox;
+template <> struct _IouBox<IouType::BOX> { using type = AABox2f; };
+template <> struct _IouBox<IouType::RBOX> { using type = Box2f; };
+template <> struct _IouBox<IouType::BOX3D> { using type = Box3f; };
 
 // define dispatch macros
 #define _NMS_DISPATCH_IOUTYPE_CASE(IOUTYPE, ...)    \
@@ -14,6 +23,7 @@ enum class SupressionType : int { HARD=0, LINEAR=1, GAUSSIAN=2 };
     {                                                       \
     _NMS_DISPATCH_IOUTYPE_CASE(IouType::BOX, __VA_ARGS__)   \
     _NMS_DISPATCH_IOUTYPE_CASE(IouType::RBOX, __VA_ARGS__)  \
+    _NMS_DISPATCH_IOUTYPE_CASE(IouType::BOX3D, __VA_ARGS__) \
     case IouType::NA:                                       \
     default:                                                \
         throw py::value_error("Unsupported iou type!");     \
@@ -16,12 +16,14 @@ template <typename scalar_t = float> struct Line2;
 template <typename scalar_t = float> struct AABox2;
 template <typename scalar_t, int MaxPoints> struct Poly2;
 template <typename scalar_t = float> struct Box2;
+template <typename scalar_t = float> struct Box3;
 
 using Point2f = Point2<float>;
 using Line2f = Line2<float>;
 using AABox2f = AABox2<float>;
 template <int MaxPoints> using Poly2f = Poly2<float, MaxPoints>;
 using Box2f = Box2<float>;
+using Box3f = Box3<float>;
 
 // implementations
 template <typename scalar_t> struct Point2
@@ -94,6 +96,10 @@ template <typename scalar_t> struct AABox2 // Axis-aligned 2D box for quick calc
         scalar_t area_u = area() + other.area() - area_i;
         return area_i / area_u;
     }
+    CUDA_CALLABLE_MEMBER inline AABox2<scalar_t> bbox() const
+    {
+        return *this;
+    }
     CUDA_CALLABLE_MEMBER inline Box2<scalar_t> box() const;
 };
 
@@ -165,6 +171,8 @@ template <typename scalar_t, int MaxPoints> struct Poly2 // Convex polygon with
     inline scalar_t iou(const Poly2<scalar_t, MaxPointsOther> &other) const
     {
         scalar_t area_i = intersect(other).area();
+        if (area_i < 0) // degenerated intersection of touching polygons
+            area_i = 0;
         scalar_t area_u = area() + other.area() - area_i;
         return area_i / area_u;
     }
@@ -219,12 +227,45 @@ template <typename scalar_t> struct Box2 : Poly2<scalar_t, 4>
         // vertices[3] = Point2<scalar_t>(x - dxcos - dysin, y - dxsin + dycos);
 
         /// coordinate: right x, down y
-        /// 4 vertices: top-left, bottom-left, bottom-right, top-right
+        /// 4 vertices: top-left, top-right, bottom-right, bottom-left
+        ///   (counter-clockwise in the x-right, y-up convention used by Poly2)
         /// rotation matrix: [[c, s], [-s, c]]
         vertices[0] = Point2<scalar_t>(x - dxcos - dysin, y + dxsin - dycos);
-        vertices[1] = Point2<scalar_t>(x - dxcos + dysin, y + dxsin + dycos);
+        vertices[1] = Point2<scalar_t>(x + dxcos - dysin, y - dxsin - dycos);
         vertices[2] = Point2<scalar_t>(x + dxcos + dysin, y - dxsin + dycos);
-        vertices[3] = Point2<scalar_t>(x + dxcos - dysin, y - dxsin - dycos);
+        vertices[3] = Point2<scalar_t>(x - dxcos + dysin, y + dxsin + dycos);
+    }
+};
+
+template <typename scalar_t> struct Box3 // 3D box with rotation only around z-axis
+{
+    Box2<scalar_t> bev;
+    scalar_t min_z = NAN, max_z = NAN;
+
+    CUDA_CALLABLE_MEMBER Box3() {}
+    CUDA_CALLABLE_MEMBER Box3(const scalar_t& x, const scalar_t& y, const scalar_t& z,
+        const scalar_t& w, const scalar_t& h, const scalar_t& d, const scalar_t& r) :
+        bev(x, y, w, h, r), min_z(z - d/2), max_z(z + d/2) {}
+
+    CUDA_CALLABLE_MEMBER inline AABox2<scalar_t> bbox() const
+    {
+        return bev.bbox();
+    }
+    CUDA_CALLABLE_MEMBER inline scalar_t volume() const
+    {
+        return bev.area() * (max_z - min_z);
+    }
+    CUDA_CALLABLE_MEMBER inline scalar_t iou(const Box3<scalar_t> &other) const
+    {
+        scalar_t height_i = fminf(max_z, other.max_z) - fmaxf(min_z, other.min_z);
+        if (height_i <= 0)
+            return 0;
+        scalar_t area_i = bev.intersect(other.bev).area();
+        if (area_i < 0) // degenerated intersection of touching polygons
+            area_i = 0;
+        scalar_t volume_i = area_i * height_i;
+        scalar_t volume_u = volume() + other.volume() - volume_i;
+        return volume_i / volume_u;
     }
 };
 
@@ -0,0 +1,198 @@
+/*
+ * This file contains differentiable versions of the geometry operations on rotated boxes, which are used
+ * for the IoU losses. The gradients are calculated manually so that they can be used in both CPU and GPU.
+ */
+
+#ifndef D3D_GEOMETRY_GRAD_HPP
+#define D3D_GEOMETRY_GRAD_HPP
+
+#include "d3d/box/geometry.hpp"
+
+// box parameters are (x, y, w, h, r), the corners are consistent with Box2 (counter-clockwise)
+template <typename scalar_t> CUDA_CALLABLE_MEMBER
+inline void box2_corners(const scalar_t x, const scalar_t y, const scalar_t w, const scalar_t h, const scalar_t r,
+    Point2<scalar_t> corners[4])
+{
+    const scalar_t signs_w[4] = {-1, 1, 1, -1}, signs_h[4] = {-1, -1, 1, 1};
+    const scalar_t c = cos(r), s = sin(r);
+    for (int k = 0; k < 4; k++)
+    {
+        const scalar_t dw = signs_w[k] * w / 2, dh = signs_h[k] * h / 2;
+        corners[k] = Point2<scalar_t>(x + dw * c + dh * s, y - dw * s + dh * c);
+    }
+}
+
+// back propagate gradients of corners to box parameters (accumulated into grad_params)
+template <typename scalar_t> CUDA_CALLABLE_MEMBER
+inline void box2_corners_grad(const scalar_t w, const scalar_t h, const scalar_t r,
+    const Point2<scalar_t> grad_corners[4], scalar_t grad_params[5])
+{
+    const scalar_t signs_w[4] = {-1, 1, 1, -1}, signs_h[4] = {-1, -1, 1, 1};
+    const scalar_t c = cos(r), s = sin(r);
+    for (int k = 0; k < 4; k++)
+    {
+        const scalar_t gx = grad_corners[k].x, gy = grad_corners[k].y;
+        const scalar_t dw = signs_w[k] * w / 2, dh = signs_h[k] * h / 2;
+        grad_params[0] += gx;
+        grad_params[1] += gy;
+        grad_params[2] += (gx * c - gy * s) * signs_w[k] / 2;
+        grad_params[3] += (gx * s + gy * c) * signs_h[k] / 2;
+        grad_params[4] += gx * (-dw * s + dh * c) + gy * (-dw * c - dh * s);
+    }
+}
+
+template <typename scalar_t> CUDA_CALLABLE_MEMBER
+inline scalar_t _cross(const scalar_t ax, const scalar_t ay, const scalar_t bx, const scalar_t by)
+{
+    return ax * by - ay * bx;
+}
+
+// vertex of the intersection polygon, type 0 is a corner of box 1, type 1 is a corner of box 2,
+// type 2 is the intersection of edge i of box 1 and edge j of box 2
+template <typename scalar_t> struct _IntersectionVertex
+{
+    Point2<scalar_t> p;
+    scalar_t angle;
+    int type, i, j;
+};
+
+/*
+ * Calculate the intersection area of two convex quadrilaterals with corners in counter-clockwise order.
+ * The vertices of the intersection are the corners inside the other box and the intersections of edges,
+ * so that each vertex can be differentiated with respect to the corners. If grad_area is not zero, the
+ * gradients of the corners are accumulated into grad_corners1 and grad_corners2.
+ */
+template <typename scalar_t> CUDA_CALLABLE_MEMBER
+scalar_t quad_intersection_area(const Point2<scalar_t> corners1[4], const Point2<scalar_t> corners2[4],
+    const scalar_t grad_area = 0, Point2<scalar_t> grad_corners1[4] = nullptr, Point2<scalar_t> grad_corners2[4] = nullptr)
+{
+    constexpr int MaxVertices = 24; // 4 + 4 corners and 16 edge intersections (duplicates are allowed)
+    const scalar_t eps = 1e-6;
+    _IntersectionVertex<scalar_t> vertices[MaxVertices];
+    int nvertices = 0;
+
+    // collect corners inside the other box
+    const Point2<scalar_t> *corners[2] = {corners1, corners2};
+    for (int b = 0; b < 2; b++)
+    {
+        const Point2<scalar_t> *self = corners[b], *other = corners[1-b];
+        for (int k = 0; k < 4; k++)
+        {
+            bool inside = true;
+            for (int e = 0; e < 4 && inside; e++)
+            {
+                const Point2<scalar_t> &o1 = other[e], &o2 = other[(e+1) % 4];
+                inside = _cross(o2.x - o1.x, o2.y - o1.y, self[k].x - o1.x, self[k].y - o1.y) >= -eps;
+            }
+            if (inside)
+                vertices[nvertices++] = {self[k], 0, b, k, 0};
+        }
+    }
+
+    // collect intersections of edges
+    for (int i = 0; i < 4; i++)
+    {
+        const Point2<scalar_t> &p1 = corners1[i], &p2 = corners1[(i+1) % 4];
+        for (int j = 0; j < 4; j++)
+        {
+            const Point2<scalar_t> &q1 = corners2[j], &q2 = corners2[(j+1) % 4];
+            const scalar_t den = _cross(p2.x - p1.x, p2.y - p1.y, q2.x - q1.x, q2.y - q1.y);
+            if (fabs(den) < eps) // parallel edges
+                continue;
+
+            const scalar_t t = _cross(q1.x - p1.x, q1.y - p1.y, q2.x - q1.x, q2.y - q1.y) / den;
+            const scalar_t u = _cross(q1.x - p1.x, q1.y - p1.y, p2.x - p1.x, p2.y - p1.y) / den;
+            if (t < 0 || t > 1 || u < 0 || u > 1)
+                continue;
+
+            Point2<scalar_t> p(p1.x + t * (p2.x - p1.x), p1.y + t * (p2.y - p1.y));
+            vertices[nvertices++] = {p, 0, 2, i, j};
+        }
+    }
+    if (nvertices < 3)
+        return 0;
+
+    // sort the vertices by angle around their center with insertion sort
+    scalar_t cx = 0, cy = 0;
+    for (int k = 0; k < nvertices; k++)
+    {
+        cx += vertices[k].p.x;
+        cy += vertices[k].p.y;
+    }
+    cx /= nvertices; cy /= nvertices;
+    for (int k = 0; k < nvertices; k++)
+        vertices[k].angle = atan2(vertices[k].p.y - cy, vertices[k].p.x - cx);
+    for (int k = 1; k < nvertices; k++)
+    {
+        _IntersectionVertex<scalar_t> v = vertices[k];
+        int l = k - 1;
+        while (l >= 0 && vertices[l].angle > v.angle)
+        {
+            vertices[l+1] = vertices[l];
+            l--;
+        }
+        vertices[l+1] = v;
+    }
+
+    // calculate area with shoelace formula
+    scalar_t area = 0;
+    for (int k = 0; k < nvertices; k++)
+    {
+        const Point2<scalar_t> &a = vertices[k].p, &b = vertices[(k+1) % nvertices].p;
+        area += _cross(a.x, a.y, b.x, b.y);
+    }
+    area /= 2;
+    if (grad_area == 0 || grad_corners1 == nullptr || grad_corners2 == nullptr)
+        return area;
+
+    // back propagate to the corners
+    for (int k = 0; k < nvertices; k++)
+    {
+        const Point2<scalar_t> &prev = vertices[(k + nvertices - 1) % nvertices].p;
+        const Point2<scalar_t> &next = vertices[(k+1) % nvertices].p;
+        const scalar_t gx = grad_area * (next.y - prev.y) / 2;
+        const scalar_t gy = grad_area * (prev.x - next.x) / 2;
+
+        const _IntersectionVertex<scalar_t> &v = vertices[k];
+        if (v.type == 0)
+        {
+            grad_corners1[v.i].x += gx;
+            grad_corners1[v.i].y += gy;
+        }
+        else if (v.type == 1)
+        {
+            grad_corners2[v.i].x += gx;
+            grad_corners2[v.i].y += gy;
+        }
+        else
+        {
+            // v = p1 + t * d1, t = cross(q1 - p1, d2) / cross(d1, d2)
+            const int i1 = v.i, i2 = (v.i+1) % 4, j1 = v.j, j2 = (v.j+1) % 4;
+            const Point2<scalar_t> &p1 = corners1[i1], &p2 = corners1[i2];
+            const Point2<scalar_t> &q1 = corners2[j1], &q2 = corners2[j2];
+            const scalar_t d1x = p2.x - p1.x, d1y = p2.y - p1.y;
+            const scalar_t d2x = q2.x - q1.x, d2y = q2.y - q1.y;
+            const scalar_t ex = q1.x - p1.x, ey = q1.y - p1.y;
+            const scalar_t den = _cross(d1x, d1y, d2x, d2y);
+            const scalar_t t = _cross(ex, ey, d2x, d2y) / den;
+            const scalar_t gt = (gx * d1x + gy * d1y) / den; // gradient of t scaled by 1 / den
+
+            // gradients w.r.t. e = q1 - p1, d1 = p2 - p1 and d2 = q2 - q1
+            const scalar_t gex = gt * d2y, gey = -gt * d2x;
+            const scalar_t gd1x = -gt * t * d2y + gx * t, gd1y = gt * t * d2x + gy * t;
+            const scalar_t gd2x = -gt * ey + gt * t * d1y, gd2y = gt * ex - gt * t * d1x;
+
+            grad_corners1[i1].x += gx - gex - gd1x;
+            grad_corners1[i1].y += gy - gey - gd1y;
+            grad_corners1[i2].x += gd1x;
+            grad_corners1[i2].y += gd1y;
+            grad_corners2[j1].x += gex - gd2x;
+            grad_corners2[j1].y += gey - gd2y;
+            grad_corners2[j2].x += gd2x;
+            grad_corners2[j2].y += gd2y;
+        }
+    }
+    return area;
+}
+
+#endif // D3D_GEOMETRY_GRAD_HPP
@@ -1,22 +1,37 @@
 #include <torch/extension.h>
 
 #include "d3d/box/iou.h"
+#include "d3d/box/loss.h"
 #include "d3d/box/nms.h"
 #include "d3d/box/utils.h"
 
 PYBIND11_MODULE(TORCH_EXTENSION_NAME, m) {
     m.def("iou2d", &iou2d, "IoU of 2D boxes");
     m.def("iou2d_cuda", &iou2d_cuda, "IoU of 2D boxes (using CUDA)");
+    m.def("iou2d_sparse", &iou2d_sparse, "IoU of overlapping 2D boxes (in COO format)");
+    m.def("iou2d_sparse_cuda", &iou2d_sparse_cuda, "IoU of overlapping 2D boxes (in COO format, using CUDA)");
+    m.def("iou2d_loss_forward", &iou2d_loss_forward, "IoU losses of paired 2D boxes");
+    m.def("iou2d_loss_forward_cuda", &iou2d_loss_forward_cuda, "IoU losses of paired 2D boxes (using CUDA)");
+    m.def("iou2d_loss_backward", &iou2d_loss_backward, "Gradients of IoU losses of paired 2D boxes");
+    m.def("iou2d_loss_backward_cuda", &iou2d_loss_backward_cuda, "Gradients of IoU losses of paired 2D boxes (using CUDA)");
     m.def("nms2d", &nms2d, "NMS on 2D boxes");
     m.def("nms2d_cuda", &nms2d_cuda, "NMS on 2D boxes (using CUDA)");
-    m.def("rbox_2d_crop", &rbox_2d_crop, "Crop points from a point cloud within boxes");
+    m.def("nms2d_batched", &nms2d_batched, "NMS on 2D boxes within each group");
+    m.def("nms2d_batched_cuda", &nms2d_batched_cuda, "NMS on 2D boxes within each group (using CUDA)");
+    m.def("rbox_2d_crop", &rbox_2d_crop, "Crop points from a point cloud within boxes (in CSR format)");
     
     py::enum_<IouType>(m, "IouType")
         .value("NA", IouType::NA)
         .value("BOX", IouType::BOX)
-        .value("RBOX", IouType::RBOX);
+        .value("RBOX", IouType::RBOX)
+        .value("BOX3D", IouType::BOX3D);
     py::enum_<SupressionType>(m, "SupressionType")
         .value("HARD", SupressionType::HARD)
         .value("LINEAR", SupressionType::LINEAR)
         .value("GAUSSIAN", SupressionType::GAUSSIAN);
+    py::enum_<IouLossType>(m, "IouLossType")
+        .value("IOU", IouLossType::IOU)
+        .value("GIOU", IouLossType::GIOU)
+        .value("DIOU", IouLossType::DIOU)
+        .value("CIOU", IouLossType::CIOU);
 }
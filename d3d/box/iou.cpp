@@ -1,3 +1,7 @@
+#include <algorithm>
+#include <array>
+#include <numeric>
+#include <vector>
 #include "d3d/box/iou.h"
 #include "d3d/box/utils.h"
 
@@ -10,7 +14,7 @@ void iou2d_templated(
     const _CpuAccessor(2) boxes2_,
     _CpuAccessor(2) ious_
 ) {
-    using BoxType = typename std::conditional<Iou == IouType::BOX, AABox2f, Box2f>::type;
+    using BoxType = typename _IouBox<Iou>::type;
     const auto N = boxes1_.size(0);
     const auto M = boxes2_.size(0);
 
@@ -40,3 +44,163 @@ Tensor iou2d(
     }));
     return ious;
 }
+
+constexpr int64_t SparseMaxGridSize = 1024; // maximum number of cells along each axis
+
+template <typename scalar_t, IouType Iou>
+void iou2d_sparse_templated(
+    const _CpuAccessor(2) boxes1_,
+    const _CpuAccessor(2) boxes2_,
+    vector<vector<pair<int64_t, scalar_t>>> &rows
+) {
+    using BoxType = typename _IouBox<Iou>::type;
+    const int64_t N = boxes1_.size(0);
+    const int64_t M = boxes2_.size(0);
+    const bool has_z = boxes1_.size(1) == 7;
+    const int iw = has_z ? 3 : 2, ih = has_z ? 4 : 3;
+
+    // construct boxes and their bounding boxes and bounding circles (x, y, radius) only once
+    vector<BoxType> b1(N), b2(M);
+    vector<AABox2f> a1(N), a2(M);
+    vector<array<scalar_t, 3>> c1(N), c2(M);
+    auto prepare = [&](const _CpuAccessor(2) boxes_, vector<BoxType> &b, vector<AABox2f> &a, vector<array<scalar_t, 3>> &c)
+    {
+        parallel_for(0, boxes_.size(0), 0, [&](int64_t begin, int64_t end)
+        {
+            for (int64_t i = begin; i < end; i++)
+            {
+                b[i] = _BoxUtilCpu<scalar_t, BoxType>::make_box(boxes_[i]);
+                a[i] = b[i].bbox();
+                const scalar_t radius = Iou == IouType::BOX ? // axis aligned boxes are the bounding boxes
+                    hypot(a[i].max_x - a[i].min_x, a[i].max_y - a[i].min_y) / 2 :
+                    hypot(boxes_[i][iw], boxes_[i][ih]) / 2;
+                c[i] = {boxes_[i][0], boxes_[i][1], radius};
+            }
+        });
+    };
+    prepare(boxes1_, b1, a1, c1);
+    prepare(boxes2_, b2, a2, c2);
+    if (N == 0 || M == 0)
+        return;
+
+    // build a uniform grid on the second set of boxes, the cell size is the average box size
+    float lo_x = INFINITY, hi_x = -INFINITY, lo_y = INFINITY, hi_y = -INFINITY;
+    float avg_size = 0;
+    for (int64_t j = 0; j < M; j++)
+    {
+        lo_x = min(lo_x, a2[j].min_x); hi_x = max(hi_x, a2[j].max_x);
+        lo_y = min(lo_y, a2[j].min_y); hi_y = max(hi_y, a2[j].max_y);
+        avg_size += max(a2[j].max_x - a2[j].min_x, a2[j].max_y - a2[j].min_y);
+    }
+    const float cell_size = max(avg_size / M, 1e-6f);
+    const int64_t nx = min(max(int64_t(ceil((hi_x - lo_x) / cell_size)), int64_t(1)), SparseMaxGridSize);
+    const int64_t ny = min(max(int64_t(ceil((hi_y - lo_y) / cell_size)), int64_t(1)), SparseMaxGridSize);
+    const float cell_x = hi_x > lo_x ? (hi_x - lo_x) / nx : 1, cell_y = hi_y > lo_y ? (hi_y - lo_y) / ny : 1;
+    auto cell_index = [&](float value, float lower, float size, int64_t count) -> int64_t
+    {
+        return min(max(int64_t(floor((value - lower) / size)), int64_t(0)), count - 1);
+    };
+
+    // insert the boxes into all the cells they cover (in CSR format)
+    auto cell_range = [&](const AABox2f &a, int64_t &ix0, int64_t &ix1, int64_t &iy0, int64_t &iy1)
+    {
+        ix0 = cell_index(a.min_x, lo_x, cell_x, nx); ix1 = cell_index(a.max_x, lo_x, cell_x, nx);
+        iy0 = cell_index(a.min_y, lo_y, cell_y, ny); iy1 = cell_index(a.max_y, lo_y, cell_y, ny);
+    };
+    int64_t ix0, ix1, iy0, iy1;
+    vector<int64_t> cell_start(nx * ny + 1, 0);
+    for (int64_t j = 0; j < M; j++)
+    {
+        cell_range(a2[j], ix0, ix1, iy0, iy1);
+        for (int64_t iy = iy0; iy <= iy1; iy++)
+            for (int64_t ix = ix0; ix <= ix1; ix++)
+                cell_start[iy * nx + ix + 1]++;
+    }
+    partial_sum(cell_start.begin(), cell_start.end(), cell_start.begin());
+    vector<int64_t> cell_boxes(cell_start.back()), cell_fill(cell_start.begin(), cell_start.end() - 1);
+    for (int64_t j = 0; j < M; j++)
+    {
+        cell_range(a2[j], ix0, ix1, iy0, iy1);
+        for (int64_t iy = iy0; iy <= iy1; iy++)
+            for (int64_t ix = ix0; ix <= ix1; ix++)
+                cell_boxes[cell_fill[iy * nx + ix]++] = j;
+    }
+
+    // query the grid with the first set of boxes
+    parallel_for(0, N, 0, [&](int64_t begin, int64_t end)
+    {
+        for (int64_t i = begin; i < end; i++)
+        {
+            const AABox2f &ai = a1[i];
+            if (ai.max_x < lo_x || ai.min_x > hi_x || ai.max_y < lo_y || ai.min_y > hi_y)
+                continue;
+
+            int64_t qx0, qx1, qy0, qy1;
+            cell_range(ai, qx0, qx1, qy0, qy1);
+            auto &row = rows[i];
+            for (int64_t iy = qy0; iy <= qy1; iy++)
+                for (int64_t ix = qx0; ix <= qx1; ix++)
+                {
+                    const int64_t cell = iy * nx + ix;
+                    for (int64_t k = cell_start[cell]; k < cell_start[cell+1]; k++)
+                    {
+                        const int64_t j = cell_boxes[k];
+                        const AABox2f &aj = a2[j];
+                        if (ai.max_x <= aj.min_x || ai.min_x >= aj.max_x || ai.max_y <= aj.min_y || ai.min_y >= aj.max_y)
+                            continue; // bounding box rejection
+
+                        // a pair can share multiple cells, it's only tested in the cell containing
+                        // the lower corner of the intersection of their bounding boxes
+                        if (cell_index(max(ai.min_x, aj.min_x), lo_x, cell_x, nx) != ix ||
+                            cell_index(max(ai.min_y, aj.min_y), lo_y, cell_y, ny) != iy)
+                            continue;
+
+                        const scalar_t dx = c1[i][0] - c2[j][0], dy = c1[i][1] - c2[j][1];
+                        const scalar_t rsum = c1[i][2] + c2[j][2];
+                        if (dx * dx + dy * dy >= rsum * rsum)
+                            continue; // bounding circle rejection
+
+                        const scalar_t iou = b1[i].iou(b2[j]);
+                        if (iou > 0)
+                            row.emplace_back(j, iou);
+                    }
+                }
+            sort(row.begin(), row.end());
+        }
+    });
+}
+
+vector<Tensor> iou2d_sparse(
+    const Tensor boxes1, const Tensor boxes2, const IouType iou_type
+) {
+    vector<Tensor> result;
+    AT_DISPATCH_FLOATING_TYPES(boxes1.scalar_type(), "iou2d_sparse", _NMS_DISPATCH_IOUTYPE(iou_type, [&] {
+        vector<vector<pair<int64_t, scalar_t>>> rows(boxes1.size(0));
+        iou2d_sparse_templated<scalar_t, Iou>(
+            boxes1._cpu_accessor(2),
+            boxes2._cpu_accessor(2),
+            rows);
+
+        // collect results in COO format
+        vector<int64_t> offsets(rows.size() + 1, 0);
+        for (size_t i = 0; i < rows.size(); i++)
+            offsets[i+1] = offsets[i] + rows[i].size();
+
+        Tensor indices = torch::empty({2, offsets.back()}, torch::kLong);
+        Tensor values = torch::empty({offsets.back()}, boxes1.options());
+        auto indices_ = indices._cpu_accessor_t(int64_t, 2);
+        auto values_ = values._cpu_accessor(1);
+        parallel_for(0, rows.size(), 0, [&](int64_t begin, int64_t end)
+        {
+            for (int64_t i = begin; i < end; i++)
+                for (size_t k = 0; k < rows[i].size(); k++)
+                {
+                    indices_[0][offsets[i] + k] = i;
+                    indices_[1][offsets[i] + k] = rows[i][k].first;
+                    values_[offsets[i] + k] = rows[i][k].second;
+                }
+        });
+        result = {indices, values};
+    }));
+    return result;
+}
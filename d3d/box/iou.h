@@ -1,5 +1,6 @@
 #pragma once
 
+#include <vector>
 #include <torch/extension.h>
 #include "d3d/box/common.h"
 
@@ -9,3 +10,9 @@ torch::Tensor iou2d(
 torch::Tensor iou2d_cuda(
     const torch::Tensor boxes1, const torch::Tensor boxes2, const IouType iou_type
 );
+std::vector<torch::Tensor> iou2d_sparse(
+    const torch::Tensor boxes1, const torch::Tensor boxes2, const IouType iou_type
+);
+std::vector<torch::Tensor> iou2d_sparse_cuda(
+    const torch::Tensor boxes1, const torch::Tensor boxes2, const IouType iou_type
+);
@@ -11,7 +11,7 @@ __global__ void iou2d_kernel(
     const _CudaAccessor(2) boxes2_,
     _CudaAccessor(2) ious_
 ) {
-    using BoxType = typename std::conditional<Iou == IouType::BOX, AABox2f, Box2f>::type;
+    using BoxType = typename _IouBox<Iou>::type;
     const int nm = blockIdx.x * blockDim.x + threadIdx.x;    
     const auto N = boxes1_.size(0);
     const auto M = boxes2_.size(0);
@@ -46,3 +46,216 @@ Tensor iou2d_cuda(
 
     return ious;
 }
+
+constexpr int64_t SparseMaxGridSize = 1024; // maximum number of cells along each axis, same as the CPU version
+
+// uniform grid on the bounding boxes of the second set of boxes
+struct SparseGrid
+{
+    float lo_x, lo_y, hi_x, hi_y, cell_x, cell_y;
+    int nx, ny;
+
+    __device__ inline int index_x(float value) const
+    {
+        return min(max(int(floorf((value - lo_x) / cell_x)), 0), nx - 1);
+    }
+    __device__ inline int index_y(float value) const
+    {
+        return min(max(int(floorf((value - lo_y) / cell_y)), 0), ny - 1);
+    }
+};
+
+template <typename scalar_t, IouType Iou>
+__global__ void iou2d_bbox_kernel(
+    const _CudaAccessor(2) boxes_,
+    _CudaAccessorT(float, 2) aabbs_ // (min_x, min_y, max_x, max_y)
+) {
+    using BoxType = typename _IouBox<Iou>::type;
+    const int i = blockIdx.x * blockDim.x + threadIdx.x;
+    if (i < boxes_.size(0))
+    {
+        AABox2f a = _BoxUtilCuda<scalar_t, BoxType>::make_box(boxes_[i]).bbox();
+        aabbs_[i][0] = a.min_x; aabbs_[i][1] = a.min_y;
+        aabbs_[i][2] = a.max_x; aabbs_[i][3] = a.max_y;
+    }
+}
+
+__global__ void grid_count_kernel(
+    const _CudaAccessorT(float, 2) aabbs_,
+    const SparseGrid grid,
+    _CudaAccessorT(int64_t, 1) counts_ // number of cells covered by each box
+) {
+    const int j = blockIdx.x * blockDim.x + threadIdx.x;
+    if (j < aabbs_.size(0))
+        counts_[j] = int64_t(grid.index_x(aabbs_[j][2]) - grid.index_x(aabbs_[j][0]) + 1) *
+                     (grid.index_y(aabbs_[j][3]) - grid.index_y(aabbs_[j][1]) + 1);
+}
+
+__global__ void grid_fill_kernel(
+    const _CudaAccessorT(float, 2) aabbs_,
+    const SparseGrid grid,
+    const _CudaAccessorT(int64_t, 1) offsets_, // start of the entries of each box
+    _CudaAccessorT(int64_t, 1) entry_cells_ // cell index of each (cell, box) entry
+) {
+    const int j = blockIdx.x * blockDim.x + threadIdx.x;
+    if (j >= aabbs_.size(0))
+        return;
+
+    int64_t k = offsets_[j];
+    const int ix0 = grid.index_x(aabbs_[j][0]), ix1 = grid.index_x(aabbs_[j][2]);
+    const int iy0 = grid.index_y(aabbs_[j][1]), iy1 = grid.index_y(aabbs_[j][3]);
+    for (int iy = iy0; iy <= iy1; iy++)
+        for (int ix = ix0; ix <= ix1; ix++)
+            entry_cells_[k++] = int64_t(iy) * grid.nx + ix;
+}
+
+// query the grid with the first set of boxes. The kernel runs twice, the first pass counts the
+// candidate pairs of each box and the second pass writes them.
+template <bool Fill>
+__global__ void grid_query_kernel(
+    const _CudaAccessorT(float, 2) aabbs1_,
+    const _CudaAccessorT(float, 2) aabbs2_,
+    const SparseGrid grid,
+    const _CudaAccessorT(int64_t, 1) cell_start_, // CSR offsets of the cells
+    const _CudaAccessorT(int64_t, 1) cell_boxes_,
+    _CudaAccessorT(int64_t, 1) offsets_, // output of the first pass (counts), input of the second pass
+    _CudaAccessorT(int64_t, 2) pairs_ // output of the second pass
+) {
+    const int i = blockIdx.x * blockDim.x + threadIdx.x;
+    if (i >= aabbs1_.size(0))
+        return;
+
+    const float min_x = aabbs1_[i][0], min_y = aabbs1_[i][1], max_x = aabbs1_[i][2], max_y = aabbs1_[i][3];
+    int64_t k = Fill ? offsets_[i] : 0;
+    if (!(max_x < grid.lo_x || min_x > grid.hi_x || max_y < grid.lo_y || min_y > grid.hi_y))
+    {
+        const int qx0 = grid.index_x(min_x), qx1 = grid.index_x(max_x);
+        const int qy0 = grid.index_y(min_y), qy1 = grid.index_y(max_y);
+        for (int iy = qy0; iy <= qy1; iy++)
+            for (int ix = qx0; ix <= qx1; ix++)
+            {
+                const int64_t cell = int64_t(iy) * grid.nx + ix;
+                for (int64_t c = cell_start_[cell]; c < cell_start_[cell+1]; c++)
+                {
+                    const int64_t j = cell_boxes_[c];
+                    if (max_x <= aabbs2_[j][0] || min_x >= aabbs2_[j][2] ||
+                        max_y <= aabbs2_[j][1] || min_y >= aabbs2_[j][3])
+                        continue; // bounding box rejection
+
+                    // a pair is only tested in the cell containing the lower corner of the bounding box intersection
+                    if (grid.index_x(max(min_x, aabbs2_[j][0])) != ix || grid.index_y(max(min_y, aabbs2_[j][1])) != iy)
+                        continue;
+
+                    if (Fill)
+                    {
+                        pairs_[k][0] = i;
+                        pairs_[k][1] = j;
+                    }
+                    k++;
+                }
+            }
+    }
+    if (!Fill)
+        offsets_[i] = k;
+}
+
+template <typename scalar_t, IouType Iou>
+__global__ void iou2d_pairs_kernel(
+    const _CudaAccessor(2) boxes1_,
+    const _CudaAccessor(2) boxes2_,
+    const _CudaAccessorT(int64_t, 2) pairs_,
+    _CudaAccessor(1) ious_
+) {
+    using BoxType = typename _IouBox<Iou>::type;
+    const int64_t k = int64_t(blockIdx.x) * blockDim.x + threadIdx.x;
+    if (k < pairs_.size(0))
+    {
+        BoxType bi = _BoxUtilCuda<scalar_t, BoxType>::make_box(boxes1_[pairs_[k][0]]);
+        BoxType bj = _BoxUtilCuda<scalar_t, BoxType>::make_box(boxes2_[pairs_[k][1]]);
+        ious_[k] = bi.iou(bj);
+    }
+}
+
+vector<Tensor> iou2d_sparse_cuda(
+    const Tensor boxes1, const Tensor boxes2, const IouType iou_type
+) {
+    const int64_t N = boxes1.size(0), M = boxes2.size(0);
+    const int threads = THREADS_COUNT;
+    auto long_options = torch::dtype(torch::kLong).device(boxes1.device());
+    if (N == 0 || M == 0)
+        return {torch::empty({2, 0}, long_options), torch::empty({0}, boxes1.options())};
+
+    // bounding boxes of both sets
+    Tensor aabbs1 = torch::empty({N, 4}, torch::dtype(torch::kFloat32).device(boxes1.device()));
+    Tensor aabbs2 = torch::empty({M, 4}, torch::dtype(torch::kFloat32).device(boxes1.device()));
+    AT_DISPATCH_FLOATING_TYPES(boxes1.scalar_type(), "iou2d_bbox_cuda", _NMS_DISPATCH_IOUTYPE(iou_type, [&] {
+        iou2d_bbox_kernel<scalar_t, Iou><<<divup(N, threads), threads>>>(
+            boxes1._cuda_accessor(2), aabbs1._cuda_accessor_t(float, 2));
+        iou2d_bbox_kernel<scalar_t, Iou><<<divup(M, threads), threads>>>(
+            boxes2._cuda_accessor(2), aabbs2._cuda_accessor_t(float, 2));
+    }));
+
+    // build a uniform grid on the second set of boxes, the cell size is the average box size
+    Tensor extent = torch::stack({aabbs2.select(1, 0).min(), aabbs2.select(1, 1).min(),
+        aabbs2.select(1, 2).max(), aabbs2.select(1, 3).max(),
+        torch::max(aabbs2.select(1, 2) - aabbs2.select(1, 0), aabbs2.select(1, 3) - aabbs2.select(1, 1)).mean()
+    }).cpu();
+    auto extent_ = extent.accessor<float, 1>();
+    SparseGrid grid;
+    grid.lo_x = extent_[0]; grid.lo_y = extent_[1]; grid.hi_x = extent_[2]; grid.hi_y = extent_[3];
+    const float cell_size = max(extent_[4], 1e-6f);
+    grid.nx = min(max(int64_t(ceil((grid.hi_x - grid.lo_x) / cell_size)), int64_t(1)), SparseMaxGridSize);
+    grid.ny = min(max(int64_t(ceil((grid.hi_y - grid.lo_y) / cell_size)), int64_t(1)), SparseMaxGridSize);
+    grid.cell_x = grid.hi_x > grid.lo_x ? (grid.hi_x - grid.lo_x) / grid.nx : 1;
+    grid.cell_y = grid.hi_y > grid.lo_y ? (grid.hi_y - grid.lo_y) / grid.ny : 1;
+
+    // insert the boxes into all the cells they cover, and sort the entries by cell (CSR format)
+    Tensor counts = torch::empty({M}, long_options);
+    grid_count_kernel<<<divup(M, threads), threads>>>(aabbs2._cuda_accessor_t(float, 2), grid,
+        counts._cuda_accessor_t(int64_t, 1));
+    Tensor offsets = torch::cat({torch::zeros({1}, long_options), counts.cumsum(0)});
+    Tensor entry_cells = torch::empty({offsets[M].item<int64_t>()}, long_options);
+    grid_fill_kernel<<<divup(M, threads), threads>>>(aabbs2._cuda_accessor_t(float, 2), grid,
+        offsets._cuda_accessor_t(int64_t, 1), entry_cells._cuda_accessor_t(int64_t, 1));
+
+    Tensor entry_order = std::get<1>(entry_cells.sort(/*stable=*/true, -1, false));
+    Tensor cell_boxes = torch::arange(M, long_options).repeat_interleave(counts).index({entry_order});
+    Tensor cell_start = torch::cat({torch::zeros({1}, long_options),
+        entry_cells.bincount({}, int64_t(grid.nx) * grid.ny).cumsum(0)});
+
+    // collect the candidate pairs with overlapping bounding boxes, pairs are grouped by row
+    Tensor pair_counts = torch::empty({N}, long_options);
+    Tensor pairs = torch::empty({0, 2}, long_options);
+    grid_query_kernel<false><<<divup(N, threads), threads>>>(
+        aabbs1._cuda_accessor_t(float, 2), aabbs2._cuda_accessor_t(float, 2), grid,
+        cell_start._cuda_accessor_t(int64_t, 1), cell_boxes._cuda_accessor_t(int64_t, 1),
+        pair_counts._cuda_accessor_t(int64_t, 1), pairs._cuda_accessor_t(int64_t, 2));
+    Tensor pair_offsets = pair_counts.cumsum(0) - pair_counts;
+    const int64_t total_pairs = pair_offsets[N-1].item<int64_t>() + pair_counts[N-1].item<int64_t>();
+    TORCH_CHECK(total_pairs <= INT32_MAX / 2, "Too many candidate pairs for sparse IoU");
+    if (total_pairs == 0)
+        return {torch::empty({2, 0}, long_options), torch::empty({0}, boxes1.options())};
+
+    pairs = torch::empty({total_pairs, 2}, long_options);
+    grid_query_kernel<true><<<divup(N, threads), threads>>>(
+        aabbs1._cuda_accessor_t(float, 2), aabbs2._cuda_accessor_t(float, 2), grid,
+        cell_start._cuda_accessor_t(int64_t, 1), cell_boxes._cuda_accessor_t(int64_t, 1),
+        pair_offsets._cuda_accessor_t(int64_t, 1), pairs._cuda_accessor_t(int64_t, 2));
+
+    // calculate iou only for the candidate pairs
+    Tensor ious = torch::empty({total_pairs}, boxes1.options());
+    AT_DISPATCH_FLOATING_TYPES(boxes1.scalar_type(), "iou2d_pairs_cuda", _NMS_DISPATCH_IOUTYPE(iou_type, [&] {
+        iou2d_pairs_kernel<scalar_t, Iou><<<divup(total_pairs, threads), threads>>>(
+        boxes1._cuda_accessor(2),
+        boxes2._cuda_accessor(2),
+        pairs._cuda_accessor_t(int64_t, 2),
+        ious._cuda_accessor(1));
+    }));
+
+    // keep the overlapping pairs, sorted by row and then by column as the CPU version
+    Tensor valid = ious > 0;
+    pairs = pairs.index({valid});
+    ious = ious.index({valid});
+    Tensor order = (pairs.select(1, 0) * M + pairs.select(1, 1)).argsort();
+    return {pairs.index({order}).t().contiguous(), ious.index({order})};
+}
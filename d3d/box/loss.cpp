@@ -0,0 +1,86 @@
+#include "d3d/box/loss.h"
+
+using namespace std;
+using namespace torch;
+
+template <typename scalar_t>
+void iou2d_loss_forward_templated(
+    const _CpuAccessor(2) boxes1_,
+    const _CpuAccessor(2) boxes2_,
+    const IouLossType loss_type,
+    _CpuAccessor(1) losses_
+) {
+    parallel_for(0, boxes1_.size(0), 0, [&](int64_t begin, int64_t end)
+    {
+        for (int64_t i = begin; i < end; i++)
+        {
+            scalar_t box1[5], box2[5];
+            for (int k = 0; k < 5; k++)
+            {
+                box1[k] = boxes1_[i][k];
+                box2[k] = boxes2_[i][k];
+            }
+            losses_[i] = rbox_iou_loss(box1, box2, loss_type);
+        }
+    });
+}
+
+template <typename scalar_t>
+void iou2d_loss_backward_templated(
+    const _CpuAccessor(2) boxes1_,
+    const _CpuAccessor(2) boxes2_,
+    const _CpuAccessor(1) grad_,
+    const IouLossType loss_type,
+    _CpuAccessor(2) grad_boxes1_,
+    _CpuAccessor(2) grad_boxes2_
+) {
+    parallel_for(0, boxes1_.size(0), 0, [&](int64_t begin, int64_t end)
+    {
+        for (int64_t i = begin; i < end; i++)
+        {
+            scalar_t box1[5], box2[5], grad1[5] = {0}, grad2[5] = {0};
+            for (int k = 0; k < 5; k++)
+            {
+                box1[k] = boxes1_[i][k];
+                box2[k] = boxes2_[i][k];
+            }
+            rbox_iou_loss(box1, box2, loss_type, grad_[i], grad1, grad2);
+            for (int k = 0; k < 5; k++)
+            {
+                grad_boxes1_[i][k] = grad1[k];
+                grad_boxes2_[i][k] = grad2[k];
+            }
+        }
+    });
+}
+
+Tensor iou2d_loss_forward(
+    const Tensor boxes1, const Tensor boxes2, const IouLossType loss_type
+) {
+    Tensor losses = torch::empty({boxes1.size(0)}, boxes1.options());
+    AT_DISPATCH_FLOATING_TYPES(boxes1.scalar_type(), "iou2d_loss_forward", [&] {
+        iou2d_loss_forward_templated<scalar_t>(
+            boxes1._cpu_accessor(2),
+            boxes2._cpu_accessor(2),
+            loss_type,
+            losses._cpu_accessor(1));
+    });
+    return losses;
+}
+
+vector<Tensor> iou2d_loss_backward(
+    const Tensor boxes1, const Tensor boxes2, const Tensor grad, const IouLossType loss_type
+) {
+    Tensor grad_boxes1 = torch::empty_like(boxes1);
+    Tensor grad_boxes2 = torch::empty_like(boxes2);
+    AT_DISPATCH_FLOATING_TYPES(boxes1.scalar_type(), "iou2d_loss_backward", [&] {
+        iou2d_loss_backward_templated<scalar_t>(
+            boxes1._cpu_accessor(2),
+            boxes2._cpu_accessor(2),
+            grad._cpu_accessor(1),
+            loss_type,
+            grad_boxes1._cpu_accessor(2),
+            grad_boxes2._cpu_accessor(2));
+    });
+    return {grad_boxes1, grad_boxes2};
+}
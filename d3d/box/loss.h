@@ -0,0 +1,127 @@
+#pragma once
+
+#include <torch/extension.h>
+#include "d3d/box/common.h"
+#include "d3d/box/geometry_grad.hpp"
+
+/*
+ * Calculate the IoU loss of a pair of rotated boxes (x, y, w, h, r). The enclosing box in GIoU and DIoU
+ * is the axis aligned bounding box of the two boxes. If grad_loss is not zero, the gradients of the box
+ * parameters are accumulated into grad1 and grad2. The alpha coefficient in CIoU is not differentiated.
+ */
+template <typename scalar_t> CUDA_CALLABLE_MEMBER
+scalar_t rbox_iou_loss(const scalar_t box1[5], const scalar_t box2[5], const IouLossType loss_type,
+    const scalar_t grad_loss = 0, scalar_t grad1[5] = nullptr, scalar_t grad2[5] = nullptr)
+{
+    const scalar_t pi = 3.14159265358979323846;
+    Point2<scalar_t> corners1[4], corners2[4];
+    box2_corners(box1[0], box1[1], box1[2], box1[3], box1[4], corners1);
+    box2_corners(box2[0], box2[1], box2[2], box2[3], box2[4], corners2);
+
+    const scalar_t area1 = box1[2] * box1[3], area2 = box2[2] * box2[3];
+    const scalar_t area_i = quad_intersection_area(corners1, corners2);
+    const scalar_t area_u = area1 + area2 - area_i;
+    const scalar_t iou = area_i / area_u;
+    scalar_t loss = 1 - iou;
+
+    // enclosing box, and the corners that define its bounds
+    scalar_t min_x = corners1[0].x, max_x = corners1[0].x, min_y = corners1[0].y, max_y = corners1[0].y;
+    int imin_x = 0, imax_x = 0, imin_y = 0, imax_y = 0;
+    for (int k = 1; k < 8; k++)
+    {
+        const Point2<scalar_t> &p = k < 4 ? corners1[k] : corners2[k-4];
+        if (p.x < min_x) { min_x = p.x; imin_x = k; }
+        if (p.x > max_x) { max_x = p.x; imax_x = k; }
+        if (p.y < min_y) { min_y = p.y; imin_y = k; }
+        if (p.y > max_y) { max_y = p.y; imax_y = k; }
+    }
+    const scalar_t enclose_w = max_x - min_x, enclose_h = max_y - min_y;
+    const scalar_t area_c = enclose_w * enclose_h;
+    const scalar_t diag2 = enclose_w * enclose_w + enclose_h * enclose_h;
+    const scalar_t dx = box1[0] - box2[0], dy = box1[1] - box2[1];
+    const scalar_t dist2 = dx * dx + dy * dy;
+    const scalar_t dangle = atan(box2[2] / box2[3]) - atan(box1[2] / box1[3]);
+    const scalar_t v = 4 / (pi * pi) * dangle * dangle;
+    const scalar_t alpha = v > 0 ? v / (1 - iou + v) : 0;
+
+    switch (loss_type)
+    {
+    case IouLossType::GIOU:
+        loss += (area_c - area_u) / area_c;
+        break;
+    case IouLossType::DIOU:
+        loss += dist2 / diag2;
+        break;
+    case IouLossType::CIOU:
+        loss += dist2 / diag2 + alpha * v;
+        break;
+    default:
+        break;
+    }
+    if (grad_loss == 0 || grad1 == nullptr || grad2 == nullptr)
+        return loss;
+
+    // gradients of the intermediate values
+    scalar_t g_u = grad_loss * iou / area_u; // from 1 - iou
+    scalar_t g_i = -grad_loss / area_u;
+    scalar_t g_c = 0, g_diag2 = 0, g_dist2 = 0, g_v = 0;
+    switch (loss_type)
+    {
+    case IouLossType::GIOU:
+        g_u -= grad_loss / area_c;
+        g_c = grad_loss * area_u / (area_c * area_c);
+        break;
+    case IouLossType::DIOU:
+    case IouLossType::CIOU:
+        g_dist2 = grad_loss / diag2;
+        g_diag2 = -grad_loss * dist2 / (diag2 * diag2);
+        if (loss_type == IouLossType::CIOU)
+            g_v = grad_loss * alpha;
+        break;
+    default:
+        break;
+    }
+    g_i -= g_u; // area_u = area1 + area2 - area_i
+
+    // back propagate through intersection and enclosing box
+    Point2<scalar_t> grad_corners1[4], grad_corners2[4];
+    for (int k = 0; k < 4; k++)
+        grad_corners1[k] = grad_corners2[k] = Point2<scalar_t>(0, 0);
+    quad_intersection_area(corners1, corners2, g_i, grad_corners1, grad_corners2);
+
+    const scalar_t g_w = g_c * enclose_h + g_diag2 * 2 * enclose_w;
+    const scalar_t g_h = g_c * enclose_w + g_diag2 * 2 * enclose_h;
+    (imax_x < 4 ? grad_corners1[imax_x] : grad_corners2[imax_x-4]).x += g_w;
+    (imin_x < 4 ? grad_corners1[imin_x] : grad_corners2[imin_x-4]).x -= g_w;
+    (imax_y < 4 ? grad_corners1[imax_y] : grad_corners2[imax_y-4]).y += g_h;
+    (imin_y < 4 ? grad_corners1[imin_y] : grad_corners2[imin_y-4]).y -= g_h;
+
+    box2_corners_grad(box1[2], box1[3], box1[4], grad_corners1, grad1);
+    box2_corners_grad(box2[2], box2[3], box2[4], grad_corners2, grad2);
+
+    // back propagate through areas, center distance and aspect ratios
+    grad1[2] += g_u * box1[3]; grad1[3] += g_u * box1[2];
+    grad2[2] += g_u * box2[3]; grad2[3] += g_u * box2[2];
+    grad1[0] += g_dist2 * 2 * dx; grad1[1] += g_dist2 * 2 * dy;
+    grad2[0] -= g_dist2 * 2 * dx; grad2[1] -= g_dist2 * 2 * dy;
+
+    const scalar_t g_dangle = g_v * 8 / (pi * pi) * dangle;
+    const scalar_t norm1 = box1[2] * box1[2] + box1[3] * box1[3];
+    const scalar_t norm2 = box2[2] * box2[2] + box2[3] * box2[3];
+    grad1[2] -= g_dangle * box1[3] / norm1; grad1[3] += g_dangle * box1[2] / norm1;
+    grad2[2] += g_dangle * box2[3] / norm2; grad2[3] -= g_dangle * box2[2] / norm2;
+    return loss;
+}
+
+torch::Tensor iou2d_loss_forward(
+    const torch::Tensor boxes1, const torch::Tensor boxes2, const IouLossType loss_type
+);
+std::vector<torch::Tensor> iou2d_loss_backward(
+    const torch::Tensor boxes1, const torch::Tensor boxes2, const torch::Tensor grad, const IouLossType loss_type
+);
+torch::Tensor iou2d_loss_forward_cuda(
+    const torch::Tensor boxes1, const torch::Tensor boxes2, const IouLossType loss_type
+);
+std::vector<torch::Tensor> iou2d_loss_backward_cuda(
+    const torch::Tensor boxes1, const torch::Tensor boxes2, const torch::Tensor grad, const IouLossType loss_type
+);
@@ -0,0 +1,91 @@
+#include "d3d/common.h"
+#include "d3d/box/loss.h"
+
+using namespace std;
+using namespace torch;
+
+template <typename scalar_t>
+__global__ void iou2d_loss_forward_kernel(
+    const _CudaAccessor(2) boxes1_,
+    const _CudaAccessor(2) boxes2_,
+    const IouLossType loss_type,
+    _CudaAccessor(1) losses_
+) {
+    const int i = blockIdx.x * blockDim.x + threadIdx.x;
+    if (i < boxes1_.size(0))
+    {
+        scalar_t box1[5], box2[5];
+        for (int k = 0; k < 5; k++)
+        {
+            box1[k] = boxes1_[i][k];
+            box2[k] = boxes2_[i][k];
+        }
+        losses_[i] = rbox_iou_loss(box1, box2, loss_type);
+    }
+}
+
+template <typename scalar_t>
+__global__ void iou2d_loss_backward_kernel(
+    const _CudaAccessor(2) boxes1_,
+    const _CudaAccessor(2) boxes2_,
+    const _CudaAccessor(1) grad_,
+    const IouLossType loss_type,
+    _CudaAccessor(2) grad_boxes1_,
+    _CudaAccessor(2) grad_boxes2_
+) {
+    const int i = blockIdx.x * blockDim.x + threadIdx.x;
+    if (i < boxes1_.size(0))
+    {
+        scalar_t box1[5], box2[5], grad1[5] = {0}, grad2[5] = {0};
+        for (int k = 0; k < 5; k++)
+        {
+            box1[k] = boxes1_[i][k];
+            box2[k] = boxes2_[i][k];
+        }
+        rbox_iou_loss(box1, box2, loss_type, grad_[i], grad1, grad2);
+        for (int k = 0; k < 5; k++)
+        {
+            grad_boxes1_[i][k] = grad1[k];
+            grad_boxes2_[i][k] = grad2[k];
+        }
+    }
+}
+
+Tensor iou2d_loss_forward_cuda(
+    const Tensor boxes1, const Tensor boxes2, const IouLossType loss_type
+) {
+    Tensor losses = torch::empty({boxes1.size(0)}, boxes1.options());
+    const int total_ops = boxes1.size(0);
+    const int threads = THREADS_COUNT;
+    const int blocks = divup(total_ops, threads);
+
+    AT_DISPATCH_FLOATING_TYPES(boxes1.scalar_type(), "iou2d_loss_forward_cuda", [&] {
+        iou2d_loss_forward_kernel<scalar_t><<<blocks, threads>>>(
+            boxes1._cuda_accessor(2),
+            boxes2._cuda_accessor(2),
+            loss_type,
+            losses._cuda_accessor(1));
+    });
+    return losses;
+}
+
+vector<Tensor> iou2d_loss_backward_cuda(
+    const Tensor boxes1, const Tensor boxes2, const Tensor grad, const IouLossType loss_type
+) {
+    Tensor grad_boxes1 = torch::empty_like(boxes1);
+    Tensor grad_boxes2 = torch::empty_like(boxes2);
+    const int total_ops = boxes1.size(0);
+    const int threads = THREADS_COUNT;
+    const int blocks = divup(total_ops, threads);
+
+    AT_DISPATCH_FLOATING_TYPES(boxes1.scalar_type(), "iou2d_loss_backward_cuda", [&] {
+        iou2d_loss_backward_kernel<scalar_t><<<blocks, threads>>>(
+            boxes1._cuda_accessor(2),
+            boxes2._cuda_accessor(2),
+            grad._cuda_accessor(1),
+            loss_type,
+            grad_boxes1._cuda_accessor(2),
+            grad_boxes2._cuda_accessor(2));
+    });
+    return {grad_boxes1, grad_boxes2};
+}
@@ -1,103 +1,227 @@
+#include <algorithm>
 #include <cmath>
+#include <queue>
+#include <vector>
 #include "d3d/box/nms.h"
 #include "d3d/box/utils.h"
 
 using namespace std;
 using namespace torch;
 
-template <typename scalar_t, IouType Iou, SupressionType Supression>
-void nms2d_templated(
-    const _CpuAccessor(2) boxes_,
-    _CpuAccessorT(long, 1) order_, // score order
-    _CpuAccessor(1) scores_, // original score array
+constexpr int NmsBlockSize = 64; // number of boxes resolved sequentially before suppressing the rest in parallel
+
+// pairs with separated bounding boxes have zero iou, so they can't suppress each other if iou threshold >= 0
+inline bool aabox_separated(const AABox2f &a, const AABox2f &b)
+{
+    return a.max_x < b.min_x || a.min_x > b.max_x || a.max_y < b.min_y || a.min_y > b.max_y;
+}
+
+template <typename scalar_t, IouType Iou>
+void nms2d_hard_templated(
+    const vector<typename _IouBox<Iou>::type> &boxes,
+    const vector<AABox2f> &aaboxes,
+    const _CpuAccessorT(long, 1) order_,
+    const int nvalid, // number of boxes above score threshold, in score order
     const float iou_threshold,
-    const float score_threshold,
-    const float supression_param, // parameter for supression
+    const int64_t max_output, // maximum number of kept boxes, 0 means no limit
     _CpuAccessorT(bool, 1) suppressed_
 ) {
-    using BoxType = typename std::conditional<Iou == IouType::BOX, AABox2f, Box2f>::type;
-    const int N = boxes_.size(0);
-
-    // remove box under score threshold
-    for (int _i = N - 1; _i > 0; _i--)
+    int64_t nkept = 0;
+    const bool use_aabox = iou_threshold >= 0;
+    auto suppress = [&](int i, int j) -> bool
     {
-        int i = order_[_i];
-        if (scores_[i] > score_threshold)
-            break;
-        suppressed_[i] = true;
-    }
+        if (use_aabox && aabox_separated(aaboxes[i], aaboxes[j]))
+            return false;
+        return boxes[i].iou(boxes[j]) > iou_threshold;
+    };
 
-    // main loop
-    for (int _i = 0; _i < N; _i++)
+    vector<int> kept;
+    kept.reserve(NmsBlockSize);
+    for (int block_start = 0; block_start < nvalid; block_start += NmsBlockSize)
     {
-        int i = order_[_i];
-        if (suppressed_[i])
+        const int block_end = min(block_start + NmsBlockSize, nvalid);
+
+        // resolve the boxes in the block sequentially
+        kept.clear();
+        for (int _i = block_start; _i < block_end; _i++)
         {
-            if (Supression == SupressionType::HARD)
+            int i = order_[_i];
+            if (suppressed_[i])
                 continue;
-            else break; // for soft-nms, remaining part are all suppressed
+            kept.push_back(i);
+            if (max_output > 0 && ++nkept >= max_output)
+            {
+                for (int _j = _i + 1; _j < nvalid; _j++)
+                    suppressed_[order_[_j]] = true;
+                return;
+            }
+            for (int _j = _i + 1; _j < block_end; _j++)
+            {
+                int j = order_[_j];
+                if (!suppressed_[j] && suppress(i, j))
+                    suppressed_[j] = true;
+            }
         }
 
-        BoxType bi = _BoxUtilCpu<scalar_t, BoxType>::make_box(boxes_[i]);
-        // suppress following boxes with lower score
-        for (int _j = _i + 1; _j < N; _j++)
+        // suppress the following boxes with the kept boxes in the block
+        parallel_for(block_end, nvalid, 0, [&](int64_t begin, int64_t end)
         {
-            int j = order_[_j];
-            if (Supression == SupressionType::HARD && suppressed_[j])
-                continue;
+            for (int64_t _j = begin; _j < end; _j++)
+            {
+                int j = order_[_j];
+                if (suppressed_[j])
+                    continue;
+                for (int i : kept)
+                    if (suppress(i, j))
+                    {
+                        suppressed_[j] = true;
+                        break;
+                    }
+            }
+        });
+    }
+}
+
+template <typename scalar_t, IouType Iou, SupressionType Supression>
+void nms2d_soft_templated(
+    const vector<typename _IouBox<Iou>::type> &boxes,
+    const vector<AABox2f> &aaboxes,
+    const _CpuAccessorT(long, 1) order_,
+    const int nvalid, // number of boxes above score threshold, in score order
+    _CpuAccessor(1) scores_, // score array to be decayed
+    const float iou_threshold,
+    const float score_threshold,
+    const float supression_param, // parameter for supression
+    const int64_t max_output, // maximum number of kept boxes, 0 means no limit
+    _CpuAccessorT(bool, 1) suppressed_
+) {
+    // max heap of (score, index), entries with outdated scores are skipped when popped
+    priority_queue<pair<scalar_t, int64_t>> heap;
+    vector<int64_t> active(nvalid);
+    for (int _i = 0; _i < nvalid; _i++)
+    {
+        active[_i] = order_[_i];
+        heap.emplace(scores_[active[_i]], active[_i]);
+    }
+
+    const bool use_aabox = iou_threshold >= 0;
+    vector<char> decayed;
+    int64_t nkept = 0;
+    while (!heap.empty() && (max_output <= 0 || nkept < max_output))
+    {
+        const auto top = heap.top();
+        heap.pop();
+        const int64_t i = top.second;
+        if (suppressed_[i] || top.first != scores_[i])
+            continue;
 
-            BoxType bj = _BoxUtilCpu<scalar_t, BoxType>::make_box(boxes_[j]);
-            scalar_t iou = bi.iou(bj);
+        // remove the selected box from active boxes
+        active.erase(find(active.begin(), active.end(), i));
+        nkept++;
 
-            if (iou > iou_threshold)
+        // decay the scores of the active boxes in parallel
+        decayed.assign(active.size(), false);
+        parallel_for(0, active.size(), 0, [&](int64_t begin, int64_t end)
+        {
+            for (int64_t k = begin; k < end; k++)
             {
+                const int64_t j = active[k];
+                if (use_aabox && aabox_separated(aaboxes[i], aaboxes[j]))
+                    continue;
+
+                scalar_t iou = boxes[i].iou(boxes[j]);
+                if (iou <= iou_threshold)
+                    continue;
+
+                const scalar_t score = scores_[j];
                 switch (Supression)
                 {
-                case SupressionType::HARD:
-                        suppressed_[j] = true;
-                    break;
-                
                 case SupressionType::LINEAR:
                     scores_[j] *= 1 - pow(iou, supression_param);
-                    suppressed_[j] = scores_[j] < score_threshold;
                     break;
-
                 case SupressionType::GAUSSIAN:
                     scores_[j] *= exp(-iou*iou/supression_param);
-                    suppressed_[j] = scores_[j] < score_threshold;
+                    break;
+                default:
                     break;
                 }
+                suppressed_[j] = scores_[j] < score_threshold;
+                decayed[k] = scores_[j] != score; // each box has only one heap entry with its current score
             }
-        }
+        });
 
-        // For soft-NMS, we need to maintain score order
-        if (Supression != SupressionType::HARD)
+        // update the heap and remove suppressed boxes
+        size_t nactive = 0;
+        for (size_t k = 0; k < active.size(); k++)
         {
-            // find suppression block start
-            int S = N - 1;
-            while (S > _i && !suppressed_[order_[S]]) S--;
+            const int64_t j = active[k];
+            if (suppressed_[j])
+                continue;
+            if (decayed[k])
+                heap.emplace(scores_[j], j);
+            active[nactive++] = j;
+        }
+        active.resize(nactive);
+    }
 
-            // sort the scores again with simple insertion sort and put suppressed indices into back
-            for (int _j = S - 1; _j > _i; _j--)
-            {
-                int j = order_[_j];
-                int _k = _j + 1;
-                while (_k < S && (suppressed_[j] || // suppression is like score = 0
-                    scores_[order_[_k]] > scores_[j]))
-                {
-                    order_[_k-1] = order_[_k];
-                    _k++;
-                }
-                order_[_k - 1] = j;
-            }
+    // remaining boxes are dropped when reaching the output limit
+    for (int64_t j : active)
+        suppressed_[j] = true;
+}
+
+template <typename scalar_t, IouType Iou, SupressionType Supression>
+void nms2d_templated(
+    const _CpuAccessor(2) boxes_,
+    _CpuAccessorT(long, 1) order_, // score order
+    _CpuAccessor(1) scores_, // original score array
+    const float iou_threshold,
+    const float score_threshold,
+    const float supression_param, // parameter for supression
+    const int64_t max_output, // maximum number of kept boxes, 0 means no limit
+    _CpuAccessorT(bool, 1) suppressed_
+) {
+    using BoxType = typename _IouBox<Iou>::type;
+    const int N = boxes_.size(0);
+
+    // remove box under score threshold
+    int nvalid = N;
+    for (int _i = N - 1; _i > 0; _i--)
+    {
+        int i = order_[_i];
+        if (scores_[i] > score_threshold)
+            break;
+        suppressed_[i] = true;
+        nvalid = _i;
+    }
+
+    // construct the boxes only once
+    vector<BoxType> boxes(N);
+    vector<AABox2f> aaboxes(N);
+    parallel_for(0, nvalid, 0, [&](int64_t begin, int64_t end)
+    {
+        for (int64_t _i = begin; _i < end; _i++)
+        {
+            int i = order_[_i];
+            boxes[i] = _BoxUtilCpu<scalar_t, BoxType>::make_box(boxes_[i]);
+            aaboxes[i] = boxes[i].bbox();
         }
+    });
+
+    if (Supression == SupressionType::HARD)
+    {
+        nms2d_hard_templated<scalar_t, Iou>(boxes, aaboxes, order_, nvalid, iou_threshold, max_output, suppressed_);
+        return;
     }
+
+    nms2d_soft_templated<scalar_t, Iou, Supression>(boxes, aaboxes, order_, nvalid, scores_,
+        iou_threshold, score_threshold, supression_param, max_output, suppressed_);
 }
 
 Tensor nms2d(
     const Tensor boxes, const Tensor scores,
     const IouType iou_type, const SupressionType supression_type,
-    const float iou_threshold, const float score_threshold, const float supression_param
+    const float iou_threshold, const float score_threshold, const float supression_param,
+    const int64_t max_output
 ) {
     Tensor order = scores.argsort(-1, true);
     Tensor scores_copy = torch::empty_like(scores);
@@ -110,9 +234,98 @@ Tensor nms2d(
                 boxes._cpu_accessor(2),
                 order._cpu_accessor_t(long, 1),
                 scores_copy._cpu_accessor(1),
-                iou_threshold, score_threshold, supression_param,
+                iou_threshold, score_threshold, supression_param, max_output,
                 suppressed._cpu_accessor_t(bool, 1));
         }))
     );
     return suppressed;
 }
+
+template <typename scalar_t, IouType Iou>
+void nms2d_batched_templated(
+    const _CpuAccessor(2) boxes_,
+    const _CpuAccessor(1) scores_,
+    const _CpuAccessorT(int64_t, 1) groups_, // group indices starting from 0
+    const int64_t ngroups,
+    const float iou_threshold,
+    const float score_threshold,
+    const int64_t max_per_group,
+    vector<vector<int64_t>> &kept // kept indices of each group in score order
+) {
+    using BoxType = typename _IouBox<Iou>::type;
+    const int64_t N = boxes_.size(0);
+
+    // collect the boxes above score threshold of each group
+    vector<vector<int64_t>> members(ngroups);
+    for (int64_t i = 0; i < N; i++)
+        if (scores_[i] > score_threshold)
+            members[groups_[i]].push_back(i);
+
+    // construct the boxes only once
+    vector<BoxType> boxes(N);
+    vector<AABox2f> aaboxes(N);
+    parallel_for(0, N, 0, [&](int64_t begin, int64_t end)
+    {
+        for (int64_t i = begin; i < end; i++)
+        {
+            boxes[i] = _BoxUtilCpu<scalar_t, BoxType>::make_box(boxes_[i]);
+            aaboxes[i] = boxes[i].bbox();
+        }
+    });
+
+    // run greedy nms in each group
+    const bool use_aabox = iou_threshold >= 0;
+    parallel_for(0, ngroups, 1, [&](int64_t begin, int64_t end)
+    {
+        for (int64_t g = begin; g < end; g++)
+        {
+            vector<int64_t> &order = members[g];
+            stable_sort(order.begin(), order.end(), [&](int64_t i, int64_t j) { return scores_[i] > scores_[j]; });
+
+            vector<int64_t> &result = kept[g];
+            for (int64_t i : order)
+            {
+                if (max_per_group > 0 && (int64_t)result.size() >= max_per_group)
+                    break;
+
+                bool suppressed = false;
+                for (int64_t k : result)
+                    if (!(use_aabox && aabox_separated(aaboxes[k], aaboxes[i])) &&
+                        boxes[k].iou(boxes[i]) > iou_threshold)
+                    {
+                        suppressed = true;
+                        break;
+                    }
+                if (!suppressed)
+                    result.push_back(i);
+            }
+        }
+    });
+}
+
+Tensor nms2d_batched(
+    const Tensor boxes, const Tensor scores, const Tensor groups,
+    const IouType iou_type, const float iou_threshold, const float score_threshold,
+    const int64_t max_per_group
+) {
+    const int64_t ngroups = groups.numel() > 0 ? groups.max().item<int64_t>() + 1 : 0;
+    vector<vector<int64_t>> kept(ngroups);
+
+    AT_DISPATCH_FLOATING_TYPES(boxes.scalar_type(), "nms2d_batched", _NMS_DISPATCH_IOUTYPE(iou_type, [&] {
+        nms2d_batched_templated<scalar_t, Iou>(
+            boxes._cpu_accessor(2),
+            scores._cpu_accessor(1),
+            groups._cpu_accessor_t(int64_t, 1),
+            ngroups, iou_threshold, score_threshold, max_per_group,
+            kept);
+    }));
+
+    int64_t total = 0;
+    for (const auto &result : kept)
+        total += result.size();
+    Tensor indices = torch::empty({total}, torch::kLong);
+    int64_t *indices_ = indices.data_ptr<int64_t>();
+    for (const auto &result : kept)
+        indices_ = copy(result.begin(), result.end(), indices_);
+    return indices;
+}
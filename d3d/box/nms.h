@@ -6,11 +6,25 @@
 torch::Tensor nms2d(
     const torch::Tensor boxes, const torch::Tensor scores,
     const IouType iou_type, const SupressionType supression_type,
-    const float iou_threshold, const float score_threshold, const float supression_param
+    const float iou_threshold, const float score_threshold, const float supression_param,
+    const int64_t max_output
 );
 
 torch::Tensor nms2d_cuda(
     const torch::Tensor boxes, const torch::Tensor scores,
     const IouType iou_type, const SupressionType supression_type,
-    const float iou_threshold, const float score_threshold, const float supression_param
+    const float iou_threshold, const float score_threshold, const float supression_param,
+    const int64_t max_output
+);
+
+torch::Tensor nms2d_batched(
+    const torch::Tensor boxes, const torch::Tensor scores, const torch::Tensor groups,
+    const IouType iou_type, const float iou_threshold, const float score_threshold,
+    const int64_t max_per_group
+);
+
+torch::Tensor nms2d_batched_cuda(
+    const torch::Tensor boxes, const torch::Tensor scores, const torch::Tensor groups,
+    const IouType iou_type, const float iou_threshold, const float score_threshold,
+    const int64_t max_per_group
 );
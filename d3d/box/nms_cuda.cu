@@ -21,19 +21,19 @@ __global__ void nms2d_iou_kernel(
     _CudaAccessor(2) iou_coeffs_, // store suppression coefficients
     _CudaAccessorT(bitvec_t, 2) iou_mask_ // store suppression masks
 ) {
-    using BoxType = typename std::conditional<Iou == IouType::BOX, AABox2f, Box2f>::type;
+    using BoxType = typename _IouBox<Iou>::type;
     const int row_start = blockIdx.y;
     const int col_start = blockIdx.x;
     if (row_start > col_start) return; // calculate only blocks in upper triangle part
 
     const int row_size = min(boxes_.size(0) - (row_start << FLAG_BITS), FLAG_WIDTH);
     const int col_size = min(boxes_.size(0) - (col_start << FLAG_BITS), FLAG_WIDTH);
-    __shared__ scalar_t block_boxes[FLAG_WIDTH][5];
+    __shared__ scalar_t block_boxes[FLAG_WIDTH][7]; // at most 7 parameters for a box
+    const int nfields = boxes_.size(1);
 
     if (threadIdx.x < col_size)
     {
-        #pragma unroll
-        for (int i = 0; i < 5; ++i)
+        for (int i = 0; i < nfields; ++i)
         {
             int boxi = order_[FLAG_WIDTH * col_start + threadIdx.x];
             block_boxes[threadIdx.x][i] = boxes_[boxi][i];
@@ -79,9 +79,11 @@ template <typename scalar_t>
 __global__ void nms_collect_kernel(
     const _CudaAccessorT(bitvec_t, 2) iou_mask_,
     const _CudaAccessorT(int64_t, 1) order_,
+    const int64_t max_output, // maximum number of kept boxes, 0 means no limit
     _CudaAccessorT(bool, 1) suppressed_ // need to be filled by false
 ) {
     const int nboxes = iou_mask_.size(0);
+    int64_t current_count = 0;
     const int nblocks = iou_mask_.size(1);
 
     // temporary tensor for block suppression flags
@@ -96,9 +98,14 @@ __global__ void nms_collect_kernel(
 
         if (remv[block_idx] & (1ULL << thread_idx)) // already suppressed
             suppressed_[order_[i]] = true; // mark
+        else if (max_output > 0 && current_count >= max_output)
+            suppressed_[order_[i]] = true; // the output is full
         else // suppress succeeding blocks
+        {
+            current_count++;
             for (int j = block_idx; j < nblocks; j++)
                 remv[j] |= iou_mask_[i][j]; // process 64 bits simutaneously
+        }
     }
 
     delete[] remv;
@@ -110,11 +117,19 @@ __global__ void soft_nms_collect_kernel(
     _CudaAccessorT(int64_t, 1) order_,
     _CudaAccessor(1) scores_, // original score array
     const float score_threshold,
+    const int64_t max_output, // maximum number of kept boxes, 0 means no limit
     _CudaAccessorT(bool, 1) suppressed_ // need to be filled by false
 ) {
     const int N = scores_.size(0);
     for (int _i = 0; _i < N; _i++)
     {
+        if (max_output > 0 && _i >= max_output) // boxes before _i are all kept
+        {
+            for (int _j = _i; _j < N; _j++)
+                suppressed_[order_[_j]] = true;
+            break;
+        }
+
         int i = order_[_i];
         if (suppressed_[i]) // for soft-nms, remaining part are all suppressed
             break;
@@ -151,11 +166,100 @@ __global__ void soft_nms_collect_kernel(
     }
 }
 
+template <typename scalar_t, IouType Iou>
+__global__ void nms2d_batched_iou_kernel(
+    const _CudaAccessor(2) boxes_,
+    const _CudaAccessorT(int64_t, 1) order_, // boxes are sorted by group and then by score
+    const _CudaAccessorT(int64_t, 1) group_offsets_, // start of each group in order, with the total count appended
+    const _CudaAccessorT(int64_t, 1) mask_offsets_, // start of the mask of each group in iou_mask
+    const scalar_t iou_threshold,
+    _CudaAccessorT(bitvec_t, 1) iou_mask_ // flattened masks, the mask of a group has (group size) x (group blocks) flags
+) {
+    using BoxType = typename _IouBox<Iou>::type;
+    const int group = blockIdx.x;
+    const int row_start = blockIdx.y;
+    const int col_start = blockIdx.z;
+    if (row_start > col_start) return; // calculate only blocks in upper triangle part
+
+    const int64_t group_start = group_offsets_[group];
+    const int group_size = group_offsets_[group + 1] - group_start;
+    const int group_blocks = (group_size + FLAG_WIDTH - 1) >> FLAG_BITS;
+    if (col_start >= group_blocks) return; // the grid is sized by the largest group
+
+    const int row_size = min(group_size - (row_start << FLAG_BITS), FLAG_WIDTH);
+    const int col_size = min(group_size - (col_start << FLAG_BITS), FLAG_WIDTH);
+    __shared__ scalar_t block_boxes[FLAG_WIDTH][7]; // at most 7 parameters for a box
+    const int nfields = boxes_.size(1);
+
+    if (threadIdx.x < col_size)
+    {
+        int boxi = order_[group_start + (col_start << FLAG_BITS) + threadIdx.x];
+        for (int i = 0; i < nfields; ++i)
+            block_boxes[threadIdx.x][i] = boxes_[boxi][i];
+    }
+    __syncthreads();
+
+    if (threadIdx.x < row_size)
+    {
+        const int idx = (row_start << FLAG_BITS) + threadIdx.x; // index in the group
+        BoxType bcur = _BoxUtilCuda<scalar_t, BoxType>::make_box(boxes_[order_[group_start + idx]]);
+
+        int64_t flag = 0;
+        int start = (row_start == col_start) ? threadIdx.x + 1 : 0;
+        for (int i = start; i < col_size; i++)
+        {
+            BoxType bcomp = _BoxUtilCuda<scalar_t, BoxType>::make_box(block_boxes[i]);
+            if (bcur.iou(bcomp) > iou_threshold)
+                flag |= 1ULL << i;
+        }
+        iou_mask_[mask_offsets_[group] + (int64_t)idx * group_blocks + col_start] = flag;
+    }
+}
+
+__global__ void nms_batched_collect_kernel(
+    const _CudaAccessorT(bitvec_t, 1) iou_mask_,
+    const _CudaAccessorT(int64_t, 1) order_,
+    const _CudaAccessorT(int64_t, 1) group_offsets_,
+    const _CudaAccessorT(int64_t, 1) mask_offsets_,
+    const _CudaAccessorT(int64_t, 1) block_offsets_, // start of the suppression flags of each group in remv
+    const int64_t max_per_group, // maximum number of kept boxes in each group, 0 means no limit
+    _CudaAccessorT(bitvec_t, 1) remv_, // block suppression flags, need to be filled by zero
+    _CudaAccessorT(bool, 1) suppressed_ // need to be filled by false
+) {
+    // each thread processes a group
+    const int group = blockIdx.x * blockDim.x + threadIdx.x;
+    if (group >= group_offsets_.size(0) - 1) return;
+
+    const int64_t group_start = group_offsets_[group];
+    const int group_size = group_offsets_[group + 1] - group_start;
+    const int group_blocks = (group_size + FLAG_WIDTH - 1) >> FLAG_BITS;
+    const int64_t mask_start = mask_offsets_[group], remv_start = block_offsets_[group];
+
+    int64_t current_count = 0;
+    for (int i = 0; i < group_size; i++)
+    {
+        int block_idx = i >> FLAG_BITS;
+        int thread_idx = i & (FLAG_WIDTH-1);
+        int64_t boxi = order_[group_start + i];
+
+        if (remv_[remv_start + block_idx] & (1ULL << thread_idx)) // already suppressed
+            suppressed_[boxi] = true;
+        else if (max_per_group > 0 && current_count >= max_per_group)
+            suppressed_[boxi] = true; // the group is full
+        else // suppress succeeding blocks
+        {
+            current_count++;
+            for (int j = block_idx; j < group_blocks; j++)
+                remv_[remv_start + j] |= iou_mask_[mask_start + (int64_t)i * group_blocks + j];
+        }
+    }
+}
+
 template <typename scalar_t, IouType Iou, SupressionType Supression>
 void nms2d_cuda_templated(
     const Tensor boxes, const Tensor order, const Tensor scores,
     const float iou_threshold, const float score_threshold, const float supression_param,
-    Tensor suppressed
+    const int64_t max_output, Tensor suppressed
 ) {
     const auto device = boxes.device();
     const int nboxes = boxes.sizes().at(0);
@@ -198,6 +302,7 @@ void nms2d_cuda_templated(
         nms_collect_kernel<scalar_t><<<1, 1>>>(
             iou_mask._cuda_accessor_t(bitvec_t, 2),
             order._cuda_accessor_t(int64_t, 1),
+            max_output,
             suppressed._cuda_accessor_t(bool, 1)
         );
     else
@@ -206,6 +311,7 @@ void nms2d_cuda_templated(
             order._cuda_accessor_t(int64_t, 1),
             scores._cuda_accessor(1),
             score_threshold,
+            max_output,
             suppressed._cuda_accessor_t(bool, 1)
         );
 }
@@ -213,7 +319,8 @@ void nms2d_cuda_templated(
 Tensor nms2d_cuda(
     const Tensor boxes, const Tensor scores,
     const IouType iou_type, const SupressionType supression_type,
-    const float iou_threshold, const float score_threshold, const float supression_param
+    const float iou_threshold, const float score_threshold, const float supression_param,
+    const int64_t max_output
 ) {
     // First filter out boxes with lower scores
     Tensor score_mask = scores > score_threshold;
@@ -228,7 +335,7 @@ Tensor nms2d_cuda(
             nms2d_cuda_templated<scalar_t, Iou, Supression>(
                 boxes_masked, order_masked, scores_masked,
                 iou_threshold, score_threshold, supression_param,
-                suppressed_masked);
+                max_output, suppressed_masked);
         }))
     );
 
@@ -238,3 +345,67 @@ Tensor nms2d_cuda(
     suppressed.index_fill_(0, suppressed_idx, true);
     return suppressed;
 }
+
+Tensor nms2d_batched_cuda(
+    const Tensor boxes, const Tensor scores, const Tensor groups,
+    const IouType iou_type, const float iou_threshold, const float score_threshold,
+    const int64_t max_per_group
+) {
+    // First filter out boxes with lower scores
+    Tensor score_idx = torch::where(scores > score_threshold)[0];
+    Tensor boxes_masked = boxes.index({score_idx});
+    Tensor scores_masked = scores.index({score_idx});
+    Tensor groups_masked = groups.index({score_idx});
+    Tensor suppressed_masked = torch::zeros({boxes_masked.size(0)}, torch::dtype(torch::kBool).device(boxes.device()));
+    if (boxes_masked.size(0) == 0)
+        return score_idx;
+
+    // sort by groups and then by scores
+    Tensor order_masked = scores_masked.argsort(-1, true);
+    Tensor group_order = std::get<1>(groups_masked.index({order_masked}).sort(true, -1, false));
+    order_masked = order_masked.index({group_order});
+
+    // locate the groups in the sorted order. Pairs from different groups are never compared, so each
+    // group has its own suppression mask and the memory is quadratic in the group sizes only.
+    Tensor group_counts = std::get<2>(torch::unique_consecutive(
+        groups_masked.index({order_masked}), false, true));
+    Tensor group_blocks = torch::div(group_counts + (FLAG_WIDTH - 1), FLAG_WIDTH, "floor");
+    Tensor zero = torch::zeros({1}, group_counts.options());
+    Tensor group_offsets = torch::cat({zero, group_counts.cumsum(0)});
+    Tensor mask_offsets = torch::cat({zero, (group_counts * group_blocks).cumsum(0)});
+    Tensor block_offsets = torch::cat({zero, group_blocks.cumsum(0)});
+
+    const int64_t ngroups = group_counts.size(0);
+    const int64_t max_blocks = group_blocks.max().item<int64_t>();
+    const int64_t mask_size = mask_offsets[ngroups].item<int64_t>();
+    TORCH_CHECK(max_blocks <= 65535 && mask_size <= INT32_MAX, "Too many boxes in a group for CUDA NMS");
+    auto bitvec_options = torch::dtype(bitvec_dtype).device(boxes.device());
+    Tensor iou_mask = torch::zeros({mask_size}, bitvec_options);
+    Tensor remv = torch::zeros({block_offsets[ngroups].item<int64_t>()}, bitvec_options);
+
+    // launch NMS kernels
+    AT_DISPATCH_FLOATING_TYPES(boxes.scalar_type(), "nms2d_batched_cuda", _NMS_DISPATCH_IOUTYPE(iou_type, [&] {
+        nms2d_batched_iou_kernel<scalar_t, Iou><<<dim3(ngroups, max_blocks, max_blocks), FLAG_WIDTH>>>(
+            boxes_masked._cuda_accessor(2),
+            order_masked._cuda_accessor_t(int64_t, 1),
+            group_offsets._cuda_accessor_t(int64_t, 1),
+            mask_offsets._cuda_accessor_t(int64_t, 1),
+            (scalar_t) iou_threshold,
+            iou_mask._cuda_accessor_t(bitvec_t, 1)
+        );
+    }));
+    nms_batched_collect_kernel<<<divup(ngroups, THREADS_COUNT), THREADS_COUNT>>>(
+        iou_mask._cuda_accessor_t(bitvec_t, 1),
+        order_masked._cuda_accessor_t(int64_t, 1),
+        group_offsets._cuda_accessor_t(int64_t, 1),
+        mask_offsets._cuda_accessor_t(int64_t, 1),
+        block_offsets._cuda_accessor_t(int64_t, 1),
+        max_per_group,
+        remv._cuda_accessor_t(bitvec_t, 1),
+        suppressed_masked._cuda_accessor_t(bool, 1)
+    );
+
+    // collect kept indices in the sorted order
+    Tensor kept = suppressed_masked.index({order_masked}).logical_not();
+    return score_idx.index({order_masked.index({kept})});
+}
@@ -1,31 +1,130 @@
+#include <algorithm>
+#include <cmath>
+#include <numeric>
 #include <vector>
 #include "d3d/box/utils.h"
-#include "d3d/box/geometry.hpp"
 
 using namespace std;
 using namespace torch;
 
-py::list rbox_2d_crop(Tensor cloud, Tensor boxes)
-{
-    py::list result;
-    auto cloud_ = cloud.accessor<float, 2>();
-    auto boxes_ = boxes.accessor<float, 2>();
+constexpr int64_t CropPointsPerCell = 16; // average number of points in a grid cell
+constexpr int64_t CropMaxGridSize = 4096; // maximum number of cells along each axis
+
+template <typename scalar_t>
+vector<Tensor> rbox_2d_crop_templated(
+    const _CpuAccessor(2) cloud_,
+    const _CpuAccessor(2) boxes_,
+    const _CpuAccessor(2) zranges_,
+    const bool check_z
+) {
+    const int64_t N = cloud_.size(0);
+    const int64_t M = boxes_.size(0);
+
+    // calculate the extent of the point cloud
+    scalar_t min_x = INFINITY, max_x = -INFINITY;
+    scalar_t min_y = INFINITY, max_y = -INFINITY;
+    for (int64_t i = 0; i < N; i++)
+    {
+        min_x = min(min_x, cloud_[i][0]); max_x = max(max_x, cloud_[i][0]);
+        min_y = min(min_y, cloud_[i][1]); max_y = max(max_y, cloud_[i][1]);
+    }
 
-    for (int i = 0; i < boxes_.size(0); i++)
+    // select the grid size so that each cell contains certain number of points in average
+    const scalar_t extent_x = N > 0 ? max_x - min_x : 0, extent_y = N > 0 ? max_y - min_y : 0;
+    const scalar_t cell_size = sqrt(max(extent_x * extent_y, scalar_t(1e-6)) * CropPointsPerCell / max(N, int64_t(1)));
+    const int64_t nx = min(max(int64_t(extent_x / cell_size), int64_t(1)), CropMaxGridSize);
+    const int64_t ny = min(max(int64_t(extent_y / cell_size), int64_t(1)), CropMaxGridSize);
+    const scalar_t cell_x = extent_x > 0 ? extent_x / nx : 1, cell_y = extent_y > 0 ? extent_y / ny : 1;
+    auto cell_index = [&](scalar_t value, scalar_t lower, scalar_t size, int64_t count) -> int64_t
     {
-        Box2f box(boxes_[i][0], boxes_[i][1], boxes_[i][2],
-            boxes_[i][3], boxes_[i][4]);
-        AABox2f aabox = box.bbox();
+        return min(max(int64_t(floor((value - lower) / size)), int64_t(0)), count - 1);
+    };
 
-        vector<int> box_result;
-        for (int j = 0; j < cloud_.size(0); j++)
+    // bin the points into the grid with counting sort
+    vector<int64_t> cell_start(nx * ny + 1, 0), point_cell(N), sorted(N);
+    for (int64_t i = 0; i < N; i++)
+    {
+        point_cell[i] = cell_index(cloud_[i][1], min_y, cell_y, ny) * nx
+                      + cell_index(cloud_[i][0], min_x, cell_x, nx);
+        cell_start[point_cell[i] + 1]++;
+    }
+    partial_sum(cell_start.begin(), cell_start.end(), cell_start.begin());
+    vector<int64_t> cell_fill(cell_start.begin(), cell_start.end() - 1);
+    for (int64_t i = 0; i < N; i++)
+        sorted[cell_fill[point_cell[i]]++] = i;
+
+    // test points in the cells covered by each box
+    vector<vector<int64_t>> results(M);
+    parallel_for(0, M, 0, [&](int64_t begin, int64_t end)
+    {
+        for (int64_t j = begin; j < end; j++)
         {
-            Point2f p(cloud_[j][0], cloud_[j][1]);
-            if (aabox.contains(p) && box.contains(p))
-                box_result.push_back(j);
+            // the axes of the box are (cos r, -sin r) and (sin r, cos r), consistent with Box2 in geometry.hpp
+            const scalar_t bx = boxes_[j][0], by = boxes_[j][1];
+            const scalar_t hw = boxes_[j][2] / 2, hh = boxes_[j][3] / 2;
+            const scalar_t c = cos(boxes_[j][4]), s = sin(boxes_[j][4]);
+            const scalar_t ex = abs(c) * hw + abs(s) * hh, ey = abs(s) * hw + abs(c) * hh;
+            if (N == 0 || bx + ex < min_x || bx - ex > max_x || by + ey < min_y || by - ey > max_y)
+                continue;
+
+            const int64_t ix0 = cell_index(bx - ex, min_x, cell_x, nx), ix1 = cell_index(bx + ex, min_x, cell_x, nx);
+            const int64_t iy0 = cell_index(by - ey, min_y, cell_y, ny), iy1 = cell_index(by + ey, min_y, cell_y, ny);
+            vector<int64_t> &box_result = results[j];
+            for (int64_t iy = iy0; iy <= iy1; iy++)
+                for (int64_t cell = iy * nx + ix0; cell <= iy * nx + ix1; cell++)
+                    for (int64_t k = cell_start[cell]; k < cell_start[cell+1]; k++)
+                    {
+                        const int64_t i = sorted[k];
+                        const scalar_t dx = cloud_[i][0] - bx, dy = cloud_[i][1] - by;
+                        if (abs(dx * c - dy * s) > hw || abs(dx * s + dy * c) > hh)
+                            continue;
+                        if (check_z && (cloud_[i][2] < zranges_[j][0] || cloud_[i][2] > zranges_[j][1]))
+                            continue;
+                        box_result.push_back(i);
+                    }
+            sort(box_result.begin(), box_result.end());
         }
-        result.append(torch::tensor(box_result, torch::kLong));
-    }
+    });
+
+    // collect results in CSR format
+    Tensor offsets = torch::empty({M + 1}, torch::kLong);
+    auto offsets_ = offsets._cpu_accessor_t(int64_t, 1);
+    offsets_[0] = 0;
+    for (int64_t j = 0; j < M; j++)
+        offsets_[j+1] = offsets_[j] + results[j].size();
+
+    Tensor indices = torch::empty({offsets_[M]}, torch::kLong);
+    int64_t* indices_ = indices.data_ptr<int64_t>();
+    parallel_for(0, M, 0, [&](int64_t begin, int64_t end)
+    {
+        for (int64_t j = begin; j < end; j++)
+            copy(results[j].begin(), results[j].end(), indices_ + offsets_[j]);
+    });
+
+    // the smallest box index is kept if the point is in multiple boxes
+    Tensor box_ids = torch::full({N}, -1, torch::kLong);
+    auto box_ids_ = box_ids._cpu_accessor_t(int64_t, 1);
+    for (int64_t j = M - 1; j >= 0; j--)
+        for (int64_t i : results[j])
+            box_ids_[i] = j;
+
+    return {indices, offsets, box_ids};
+}
+
+vector<Tensor> rbox_2d_crop(const Tensor cloud, const Tensor boxes, const Tensor zranges)
+{
+    const bool check_z = zranges.numel() > 0;
+    if (check_z && cloud.size(1) < 3)
+        throw py::value_error("Point cloud should have z coordinates to be checked with z ranges!");
 
+    vector<Tensor> result;
+    AT_DISPATCH_FLOATING_TYPES(cloud.scalar_type(), "rbox_2d_crop", [&] {
+        Tensor zranges_ = check_z ? zranges : torch::zeros({boxes.size(0), 2}, cloud.options());
+        result = rbox_2d_crop_templated<scalar_t>(
+            cloud._cpu_accessor(2),
+            boxes._cpu_accessor(2),
+            zranges_._cpu_accessor(2),
+            check_z);
+    });
     return result;
-}
\ No newline at end of file
+}
@@ -33,3 +33,15 @@ struct _BoxUtilCuda<scalar_t, AABox2f>
         return Box2f(data[0], data[1], data[2], data[3], data[4]).bbox();
     }
 };
+template <typename scalar_t>
+struct _BoxUtilCuda<scalar_t, Box3f>
+{
+    static CUDA_CALLABLE_MEMBER Box3f make_box(const _CudaSubAccessor(1) data)
+    {
+        return Box3f(data[0], data[1], data[2], data[3], data[4], data[5], data[6]);
+    }
+    static CUDA_CALLABLE_MEMBER Box3f make_box(__restrict__ scalar_t* data)
+    {
+        return Box3f(data[0], data[1], data[2], data[3], data[4], data[5], data[6]);
+    }
+};
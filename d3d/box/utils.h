@@ -24,5 +24,13 @@ struct _BoxUtilCpu<scalar_t, AABox2f>
         return Box2f(data[0], data[1], data[2], data[3], data[4]).bbox();
     }
 };
+template <typename scalar_t>
+struct _BoxUtilCpu<scalar_t, Box3f>
+{
+    static Box3f make_box(const _CpuAccessor(1) data)
+    {
+        return Box3f(data[0], data[1], data[2], data[3], data[4], data[5], data[6]);
+    }
+};
 
-py::list rbox_2d_crop(torch::Tensor cloud, torch::Tensor boxes);
+std::vector<torch::Tensor> rbox_2d_crop(const torch::Tensor cloud, const torch::Tensor boxes, const torch::Tensor zranges);
@@ -0,0 +1,162 @@
+import numpy as np
+import numpy.random as npr
+from scipy.spatial.transform import Rotation
+
+from d3d.abstraction import ObjectTarget3DArray
+
+class GlobalTransform:
+    '''
+    Base class of the global transforms. Each transform samples a batch of 4x4 affine matrices,
+    the transforms in a pipeline are composed before they are applied on points and boxes.
+    '''
+    def sample(self, rng, count):
+        '''
+        :param rng: numpy random generator
+        :param count: number of samples
+        :return: affine matrices with shape count x 4 x 4
+        '''
+        raise NotImplementedError()
+
+class GlobalRotation(GlobalTransform):
+    '''
+    Rotate around z-axis with angle uniformly sampled in the range
+    '''
+    def __init__(self, angle_range=(-np.pi/4, np.pi/4)):
+        self.angle_range = angle_range
+
+    def sample(self, rng, count):
+        angles = rng.uniform(self.angle_range[0], self.angle_range[1], count)
+        c, s = np.cos(angles), np.sin(angles)
+        matrices = np.tile(np.eye(4), (count, 1, 1))
+        matrices[:, 0, 0], matrices[:, 0, 1] = c, -s
+        matrices[:, 1, 0], matrices[:, 1, 1] = s, c
+        return matrices
+
+class GlobalScaling(GlobalTransform):
+    '''
+    Scale uniformly in all directions with factor uniformly sampled in the range
+    '''
+    def __init__(self, scale_range=(0.95, 1.05)):
+        self.scale_range = scale_range
+
+    def sample(self, rng, count):
+        scales = rng.uniform(self.scale_range[0], self.scale_range[1], count)
+        matrices = np.tile(np.eye(4), (count, 1, 1))
+        matrices[:, [0, 1, 2], [0, 1, 2]] = scales[:, None]
+        return matrices
+
+class RandomFlip(GlobalTransform):
+    '''
+    Mirror the coordinates along an axis with given probability
+
+    :param axis: 'y' flips the y coordinates (left-right), 'x' flips the x coordinates (front-back)
+    '''
+    def __init__(self, axis='y', prob=0.5):
+        if axis not in ['x', 'y']:
+            raise ValueError("Invalid flip axis %s, valid options are x, y" % axis)
+        self.axis = 0 if axis == 'x' else 1
+        self.prob = prob
+
+    def sample(self, rng, count):
+        flips = rng.uniform(size=count) < self.prob
+        matrices = np.tile(np.eye(4), (count, 1, 1))
+        matrices[:, self.axis, self.axis] = np.where(flips, -1, 1)
+        return matrices
+
+class GlobalTranslation(GlobalTransform):
+    '''
+    Translate with offsets sampled from a normal distribution
+
+    :param std: standard deviations of the offset in x, y, z
+    '''
+    def __init__(self, std=(0.2, 0.2, 0.2)):
+        self.std = np.asarray(std, dtype=float)
+
+    def sample(self, rng, count):
+        matrices = np.tile(np.eye(4), (count, 1, 1))
+        matrices[:, :3, 3] = rng.normal(size=(count, 3)) * self.std
+        return matrices
+
+def transform_points(cloud, matrix):
+    '''
+    Apply an affine transform to the positions (first three columns) of a point cloud, other columns are kept.
+    '''
+    output = np.array(cloud)
+    output[:, :3] = cloud[:, :3].dot(matrix[:3, :3].T) + matrix[:3, 3]
+    return output
+
+def transform_boxes(boxes, matrix):
+    '''
+    Apply an affine transform to boxes with shape N x 7 (x, y, z, l, w, h, yaw), extra columns are kept.
+    The transform should be composed of rotations around z-axis, uniform scaling, flips and translations.
+    '''
+    output = np.array(boxes)
+    if len(boxes) == 0:
+        return output
+
+    output[:, :3] = boxes[:, :3].dot(matrix[:3, :3].T) + matrix[:3, 3]
+    heading = np.stack([np.cos(boxes[:, 6]), np.sin(boxes[:, 6]), np.zeros(len(boxes))], axis=1)
+    heading = heading.dot(matrix[:3, :3].T)
+    output[:, 3:6] = boxes[:, 3:6] * np.cbrt(abs(np.linalg.det(matrix[:3, :3])))
+    output[:, 6] = np.arctan2(heading[:, 1], heading[:, 0])
+    return output
+
+def transform_objects(targets: ObjectTarget3DArray, matrix):
+    '''
+    Apply an affine transform to the objects in place, orientations of all objects are updated in one batch.
+    The transform should be composed of rotations around z-axis, uniform scaling, flips and translations.
+    '''
+    if len(targets) == 0:
+        return targets
+
+    linear = matrix[:3, :3]
+    scale = np.cbrt(abs(np.linalg.det(linear)))
+    orientations = Rotation.from_quat([target.orientation.as_quat() for target in targets])
+    orientations = np.matmul(linear / scale, orientations.as_matrix())
+    if np.linalg.det(linear) < 0: # flip the y-axis of the boxes so that they remain right-handed
+        orientations[:, :, 1] = -orientations[:, :, 1]
+    orientations = Rotation.from_matrix(orientations)
+
+    positions = np.array([target.position for target in targets]).dot(linear.T) + matrix[:3, 3]
+    for i, target in enumerate(targets):
+        target.position = positions[i]
+        target.dimension = target.dimension * scale
+        target.orientation = orientations[i]
+    return targets
+
+class AugmentationPipeline:
+    '''
+    This class applies a sequence of global transforms to a batch of point clouds and their boxes.
+    The transforms of each sample are composed into one affine matrix, so points and boxes are
+    transformed in one step and remain consistent.
+    '''
+    def __init__(self, transforms, seed=None):
+        '''
+        :param transforms: list of GlobalTransform, applied in order
+        :param seed: seed of the random generator, used for reproducible augmentation
+        '''
+        self.transforms = transforms
+        self._rng = npr.default_rng(seed)
+
+    def sample_matrices(self, count):
+        '''
+        Sample the composed affine matrices with shape count x 4 x 4
+        '''
+        matrices = np.tile(np.eye(4), (count, 1, 1))
+        for transform in self.transforms:
+            matrices = np.matmul(transform.sample(self._rng, count), matrices)
+        return matrices
+
+    def __call__(self, clouds, boxes=None):
+        '''
+        :param clouds: list of point clouds with shape N x C (C >= 3)
+        :param boxes: list of boxes with shape M x 7 (x, y, z, l, w, h, yaw), or list of ObjectTarget3DArray
+            which will be transformed in place
+        :return: (transformed clouds, transformed boxes, matrices)
+        '''
+        matrices = self.sample_matrices(len(clouds))
+        clouds = [transform_points(cloud, m) for cloud, m in zip(clouds, matrices)]
+        if boxes is not None:
+            boxes = [transform_objects(b, m) if isinstance(b, ObjectTarget3DArray) else transform_boxes(b, m)
+                     for b, m in zip(boxes, matrices)]
+        return clouds, boxes, matrices
@@ -1,20 +1,36 @@
+import json
+import logging
+import os
 import os.path as osp
+import struct
+import threading
+import time
+import zlib
+from collections import OrderedDict, defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from io import BytesIO
 from multiprocessing import Manager, Pool
+from pathlib import Path
 from typing import Any, List, Optional, Union
-from zipfile import ZipFile
+from zipfile import (ZIP_BZIP2, ZIP_DEFLATED, ZIP_LZMA, ZIP_STORED, ZipFile,
+                     ZipInfo)
 
 import numpy as np
 import numpy.random as npr
 from numpy import ndarray as NdArray
 from PIL.Image import Image
+from scipy.spatial.transform import Rotation, Slerp
 from tqdm import tqdm
 
-from d3d.abstraction import ObjectTarget3DArray, TransformSet
+from d3d.abstraction import ObjectTarget3D, ObjectTarget3DArray, TransformSet
+
+_logger = logging.getLogger("d3d")
 
 
 class DetectionDatasetBase:
     VALID_CAM_NAMES: list
     VALID_LIDAR_NAMES: list
+    _label_cache = None
 
     def __init__(self, base_path, inzip=False, phase="training", trainval_split=1, trainval_random=False):
         """
@@ -81,6 +97,24 @@ class DetectionDatasetBase:
         '''
         pass
 
+    def load_label_cache(self, path):
+        '''
+        Serve lidar_objects from a label cache created by LabelCache.build. Frames that are not in
+        the cache are still loaded from the dataset.
+        '''
+        self._label_cache = LabelCache(path)
+
+    def _cached_objects(self, idx, tag_factory):
+        '''
+        Return objects from the label cache, or None if the frame is not cached
+        '''
+        if self._label_cache is None:
+            return None
+        key = LabelCache.frame_key(self, idx)
+        if key not in self._label_cache:
+            return None
+        return self._label_cache.objects(key, tag_factory)
+
 def _check_frames(names, valid):
     unpack_result = False
     if names is None:
@@ -118,6 +152,528 @@ class ZipCache:
             self._cache_path = path
         return self._cache
 
+class ZipWriter(ZipFile):
+    '''
+    This class is a utility for writing converted archives. The compression method of each
+    member is selected by its modality, which is decided by the top level folder of the member.
+    The method is recorded in each member header, so the archives can be read by ZipFile directly.
+    '''
+    COMPRESSION_METHODS = dict(stored=ZIP_STORED, deflated=ZIP_DEFLATED, bzip2=ZIP_BZIP2, lzma=ZIP_LZMA)
+    MODALITIES = ["lidar", "camera", "radar", "label", "meta"]
+
+    def __init__(self, file, compression=None, **kvargs):
+        '''
+        :param compression: compression methods for each modality. It can be a dict or a string like
+            "lidar=deflated,label=lzma". If only a method name is given, it applies to all modalities.
+            Unspecified modalities are stored without compression.
+        '''
+        super().__init__(file, "w", **kvargs)
+        self._methods = self.parse_compression(compression)
+
+    @classmethod
+    def parse_compression(cls, spec):
+        methods = {m: ZIP_STORED for m in cls.MODALITIES}
+        if not spec:
+            return methods
+
+        if isinstance(spec, str):
+            if '=' not in spec:
+                spec = {m: spec for m in cls.MODALITIES}
+            else:
+                spec = dict(item.split('=', 1) for item in spec.split(','))
+
+        for modality, method in spec.items():
+            modality, method = modality.strip().lower(), method.strip().lower()
+            if modality not in methods:
+                raise ValueError("Invalid modality %s, valid options are %s" %
+                    (modality, ", ".join(cls.MODALITIES)))
+            if method not in cls.COMPRESSION_METHODS:
+                raise ValueError("Invalid compression method %s, valid options are %s" %
+                    (method, ", ".join(cls.COMPRESSION_METHODS)))
+            methods[modality] = cls.COMPRESSION_METHODS[method]
+        return methods
+
+    @staticmethod
+    def modality(name):
+        folder = name.split('/', 1)[0]
+        if folder.startswith(('annotation', 'label')):
+            return "label"
+        elif folder.startswith('lidar'):
+            return "lidar"
+        elif folder.startswith('cam'):
+            return "camera"
+        elif folder.startswith('radar'):
+            return "radar"
+        else:
+            return "meta"
+
+    def open(self, name, mode="r", pwd=None, **kvargs):
+        if mode == "w" and isinstance(name, str):
+            zinfo = ZipInfo(name, date_time=time.localtime(time.time())[:6])
+            zinfo.compress_type = self._methods[self.modality(name)]
+            zinfo.external_attr = 0o600 << 16
+            name = zinfo
+        return super().open(name, mode, pwd, **kvargs)
+
+
+def _scan_archive(path, stats_name):
+    """
+    Read statistics and frame file locations from an archive
+    """
+    fstat = os.stat(path)
+    members = defaultdict(dict)
+    exts = {}
+    with ZipFile(path) as ar:
+        with ar.open(stats_name) as fin:
+            stats = json.loads(fin.read().decode())
+
+        for info in ar.infolist():
+            folder, _, fname = info.filename.rpartition('/')
+            fidx, _, ext = fname.partition('.')
+            if not folder or not fidx.isdigit():
+                continue
+            members[folder][int(fidx)] = (info.header_offset, info.compress_type,
+                info.compress_size, info.file_size)
+            exts[folder] = ext
+
+    tables = {}
+    for folder, items in members.items():
+        table = np.full((max(items) + 1, 4), -1, dtype=np.int64)
+        for fidx, values in items.items():
+            table[fidx] = values
+        tables[folder] = table
+
+    entry = dict(mtime=fstat.st_mtime, size=fstat.st_size, stats=stats, folders=exts)
+    return entry, tables
+
+class ArchiveIndex:
+    '''
+    This class is a utility for indexing the converted archives of a dataset. It stores the statistics
+    of each archive along with the locations of frame files (named as <folder>/<frame index>.<ext>), so
+    that the frames can be read without parsing the zip directories. The index is saved beside the
+    archives, and it's refreshed incrementally based on the modification time and size of the archives.
+    Frame files are read through descriptors cached by each thread, at most MAX_DESCRIPTORS archives are kept
+    open by a thread.
+    '''
+    VERSION = 2
+    MAX_DESCRIPTORS = 8
+    _LOCAL_HEADER = struct.Struct("<4s22xHH")
+
+    def __init__(self, base_path, stats_name, nworkers=8):
+        '''
+        :param base_path: directory containing the archives
+        :param stats_name: name of the member storing the statistics of an archive
+        :param nworkers: number of threads used to scan the archives
+        '''
+        self.base_path = Path(base_path)
+        self._stats_name = stats_name
+        self._nworkers = nworkers
+        self._meta_path = self.base_path / "metadata.json"
+        self._table_path = self.base_path / "metadata.npz"
+
+        self._archives = OrderedDict() # archive name -> index entry
+        self._tables = {} # "<archive name>/<folder>" -> location table
+        self._zip_cache = ZipCache()
+        self._reset_descriptors()
+
+        self.refresh()
+
+    def _reset_descriptors(self):
+        self._local = threading.local() # descriptors of each thread, archive name -> fd in LRU order
+        self._fcaches = [] # descriptor caches of all threads, used by close()
+        self._fcache_lock = threading.Lock()
+
+    def __getstate__(self):
+        # descriptors and opened archives are not shared with other processes
+        state = self.__dict__.copy()
+        for key in ['_local', '_fcaches', '_fcache_lock']:
+            del state[key]
+        state['_zip_cache'] = ZipCache()
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._reset_descriptors()
+
+    @property
+    def stats(self):
+        '''
+        Statistics of each archive, ordered as in the index
+        '''
+        return OrderedDict((name, entry['stats']) for name, entry in self._archives.items())
+
+    def _load_index(self):
+        if not self._meta_path.exists():
+            return OrderedDict(), {}, False
+
+        with open(self._meta_path) as fin:
+            meta_json = json.load(fin, object_pairs_hook=OrderedDict)
+        if meta_json.get("version", None) != self.VERSION or not self._table_path.exists():
+            # keep the order of archives in the metadata of older version, so that frame indices are unchanged
+            return OrderedDict((name, None) for name in meta_json.get("archives", meta_json)), {}, False
+
+        # tables are loaded eagerly so that no file handle is shared by forked workers
+        with np.load(self._table_path) as table_file:
+            tables = {key: table_file[key] for key in table_file.files}
+        return meta_json["archives"], tables, True
+
+    def refresh(self):
+        '''
+        Update the index with archives that are added, removed or modified
+        '''
+        old_archives, old_tables, valid = self._load_index()
+        archives = {p.stem: p for p in self.base_path.iterdir() if p.suffix == ".zip" and p.is_file()}
+
+        stale = []
+        for name, path in archives.items():
+            entry = old_archives.get(name, None)
+            if entry is None:
+                stale.append(name)
+                continue
+            fstat = path.stat()
+            if entry['mtime'] != fstat.st_mtime or entry['size'] != fstat.st_size:
+                stale.append(name)
+
+        order = [name for name in old_archives if name in archives]
+        order += sorted(name for name in archives if name not in old_archives)
+        if valid and not stale and len(order) == len(old_archives):
+            self._archives = old_archives
+            self._tables = old_tables
+            return
+
+        _logger.info("Indexing %d archives in %s...", len(stale), self.base_path)
+        with ThreadPoolExecutor(self._nworkers) as pool:
+            scanned = pool.map(_scan_archive, [archives[name] for name in stale], [self._stats_name] * len(stale))
+            scanned = dict(zip(stale, scanned))
+
+        self._archives = OrderedDict()
+        tables = {}
+        for name in order:
+            if name in scanned:
+                entry, entry_tables = scanned[name]
+            else:
+                entry = old_archives[name]
+                entry_tables = {folder: old_tables[name + '/' + folder] for folder in entry['folders']}
+            self._archives[name] = entry
+            for folder, table in entry_tables.items():
+                tables[name + '/' + folder] = table
+
+        # save index
+        with open(self._table_path, "wb") as fout:
+            np.savez(fout, **tables)
+        with open(self._meta_path, "w") as fout:
+            json.dump(dict(version=self.VERSION, archives=self._archives), fout)
+        self._tables = tables
+
+    def _descriptor(self, name):
+        fcache = getattr(self._local, "fcache", None)
+        if fcache is None:
+            fcache = self._local.fcache = OrderedDict()
+            with self._fcache_lock:
+                self._fcaches.append(fcache)
+
+        fd = fcache.get(name, None)
+        if fd is not None:
+            fcache.move_to_end(name)
+            return fd
+
+        if len(fcache) >= self.MAX_DESCRIPTORS:
+            _, evicted = fcache.popitem(last=False)
+            os.close(evicted)
+        fd = os.open(self.base_path / (name + ".zip"), os.O_RDONLY | getattr(os, "O_BINARY", 0))
+        fcache[name] = fd
+        return fd
+
+    def _read(self, name, offset, size):
+        fd = self._descriptor(name)
+        if hasattr(os, "pread"): # positional read is safe when the descriptor is shared after fork
+            return os.pread(fd, size, offset)
+        os.lseek(fd, offset, os.SEEK_SET)
+        return os.read(fd, size)
+
+    def open(self, name, member):
+        '''
+        Open a member in the archive. Frame files are read directly by their locations, other members
+        are read through ZipFile.
+
+        :param name: name of the archive (without suffix)
+        :param member: name of the member in the archive
+        '''
+        folder, _, fname = member.rpartition('/')
+        fidx, _, ext = fname.partition('.')
+        table = self._tables.get(name + '/' + folder, None) if fidx.isdigit() else None
+
+        if table is not None and self._archives[name]['folders'][folder] == ext:
+            fidx = int(fidx)
+            if fidx >= len(table) or table[fidx, 0] < 0:
+                raise KeyError("There is no item named %r in the archive" % member)
+
+            offset, ctype, csize, _ = table[fidx].tolist()
+            if ctype in (ZIP_STORED, ZIP_DEFLATED):
+                signature, nlen, elen = self._LOCAL_HEADER.unpack(self._read(name, offset, self._LOCAL_HEADER.size))
+                if signature != b"PK\x03\x04":
+                    raise RuntimeError("Archive %s is modified, please refresh the index" % name)
+
+                data = self._read(name, offset + self._LOCAL_HEADER.size + nlen + elen, csize)
+                if ctype == ZIP_DEFLATED:
+                    data = zlib.decompress(data, -zlib.MAX_WBITS)
+                return BytesIO(data)
+
+        ar = self._zip_cache.open(self.base_path / (name + ".zip"))
+        return ar.open(member)
+
+    def close(self):
+        '''
+        Close the descriptors opened by all threads, it should not be called while reading
+        '''
+        with self._fcache_lock:
+            for fcache in self._fcaches:
+                for fd in fcache.values():
+                    os.close(fd)
+                fcache.clear()
+
+class LabelCache:
+    '''
+    This class stores the ground truth objects of a dataset as columnar arrays in a single npz file,
+    so that evaluation doesn't need to parse the labels frame by frame. The objects are indexed by
+    the underlying frame index of the loader (see LabelCache.frame_key), so a cache built on the
+    whole dataset (e.g. trainval_split=1) can be used by any train/val split. Numeric columns are
+    stored in float32.
+    '''
+    VERSION = 1
+
+    def __init__(self, path):
+        with np.load(path) as data:
+            if int(data['version']) != self.VERSION:
+                raise ValueError("Label cache %s is created by an incompatible version, please rebuild it" % path)
+            self.frame = str(data['frame']) or None
+            self._keys = data['keys']
+            self._offsets = data['offsets']
+            self._columns = {k: data[k] for k in ['position', 'dimension', 'orientation', 'tag', 'id']}
+        self._lookup = {k: i for i, k in enumerate(self._keys.tolist())}
+
+    @staticmethod
+    def frame_key(loader, idx):
+        '''
+        Return the underlying frame index of the idx-th frame in the loader
+        '''
+        frames = getattr(loader, "frames", None)
+        return int(frames[idx]) if frames is not None else int(idx)
+
+    @classmethod
+    def build(cls, loader: DetectionDatasetBase, path):
+        '''
+        Extract the ground truth objects of all frames in the loader and save them to path
+
+        :param loader: the dataset loader, its lidar_objects should return objects with raw tags
+        :param path: output path of the npz file
+        '''
+        keys, counts, frame = [], [], None
+        position, dimension, orientation, tag, ids = [], [], [], [], []
+        for idx in tqdm(range(len(loader)), desc="Building label cache"):
+            objects = loader.lidar_objects(idx)
+            frame = frame or objects.frame
+            keys.append(cls.frame_key(loader, idx))
+            counts.append(len(objects))
+            for obj in objects:
+                position.append(obj.position)
+                dimension.append(obj.dimension)
+                orientation.append(obj.orientation.as_quat())
+                tag.append(obj.tag_top.value)
+                ids.append("" if obj.id is None else str(obj.id))
+
+        with open(path, "wb") as fout:
+            np.savez(fout,
+                version=cls.VERSION,
+                frame=frame or "",
+                keys=np.array(keys, dtype=np.int64),
+                offsets=np.concatenate([[0], np.cumsum(counts)]).astype(np.int64),
+                position=np.array(position, dtype=np.float32).reshape(-1, 3),
+                dimension=np.array(dimension, dtype=np.float32).reshape(-1, 3),
+                orientation=np.array(orientation, dtype=np.float32).reshape(-1, 4),
+                tag=np.array(tag, dtype=np.int64),
+                id=np.array(ids, dtype=str)
+            )
+
+    def __len__(self):
+        return len(self._keys)
+
+    def __contains__(self, key):
+        return key in self._lookup
+
+    def arrays(self, key):
+        '''
+        Return the columns of the objects in a frame as a dictionary of arrays
+
+        :param key: underlying frame index
+        '''
+        i = self._lookup[key]
+        start, end = self._offsets[i], self._offsets[i+1]
+        return {k: v[start:end] for k, v in self._columns.items()}
+
+    def objects(self, key, tag_factory):
+        '''
+        Return the objects in a frame as ObjectTarget3DArray
+
+        :param key: underlying frame index
+        :param tag_factory: function to create ObjectTag from the tag value
+        '''
+        columns = self.arrays(key)
+        outputs = ObjectTarget3DArray(frame=self.frame)
+        if len(columns['tag']) == 0:
+            return outputs
+
+        rotations = Rotation.from_quat(columns['orientation'])
+        for i, (tag, oid) in enumerate(zip(columns['tag'].tolist(), columns['id'].tolist())):
+            outputs.append(ObjectTarget3D(columns['position'][i], rotations[i], columns['dimension'][i],
+                tag_factory(tag), id=oid or None))
+        return outputs
+
+class ScenePoses:
+    '''
+    This class stores the timestamps and poses of all frames in a scene as contiguous arrays, and
+    provides vectorized queries on them. Timestamps are expected to be increasing with frame index.
+    '''
+    def __init__(self, timestamps, rotations, translations):
+        '''
+        :param timestamps: timestamps of the frames, with shape N
+        :param rotations: orientations of the frames as a Rotation object with N elements
+        :param translations: positions of the frames, with shape N x 3
+        '''
+        self.timestamps = np.asarray(timestamps, dtype=np.int64)
+        self.rotations = rotations
+        self.translations = np.asarray(translations, dtype=np.float64)
+        self._slerp = None
+
+    def __len__(self):
+        return len(self.timestamps)
+
+    def pose(self, fidx):
+        '''
+        Return (rotation, translation) of frames in the scene
+
+        :param fidx: frame index or an array of frame indices
+        '''
+        return self.rotations[fidx], self.translations[fidx]
+
+    def homogeneous(self, fidx=None):
+        '''
+        Return the poses as 4x4 transformation matrices (with shape N x 4 x 4 for multiple frames)
+        '''
+        if fidx is None:
+            fidx = slice(None)
+        r, t = self.pose(fidx)
+        rt = np.zeros(np.shape(t)[:-1] + (4, 4))
+        rt[..., :3, :3] = r.as_matrix()
+        rt[..., :3, 3] = t
+        rt[..., 3, 3] = 1
+        return rt
+
+    def locate(self, timestamp, side="nearest"):
+        '''
+        Find the frame indices of given timestamps
+
+        :param timestamp: timestamp or an array of timestamps
+        :param side: nearest: index of the closest frame; left: index of the last frame not later
+            than the timestamp; right: index of the first frame not earlier than the timestamp.
+            The indices are clipped into the valid range.
+        '''
+        timestamp = np.asarray(timestamp)
+        last = len(self.timestamps) - 1
+        if last == 0:
+            return np.zeros(timestamp.shape, dtype=np.int64)
+
+        if side == "left":
+            return np.clip(np.searchsorted(self.timestamps, timestamp, side="right") - 1, 0, last)
+        elif side == "right":
+            return np.clip(np.searchsorted(self.timestamps, timestamp, side="left"), 0, last)
+        elif side == "nearest":
+            right = np.clip(np.searchsorted(self.timestamps, timestamp), 1, last)
+            left = right - 1
+            to_left = np.abs(timestamp - self.timestamps[left])
+            to_right = np.abs(self.timestamps[right] - timestamp)
+            return np.where(to_left <= to_right, left, right)
+        else:
+            raise ValueError("Invalid side option %s" % side)
+
+    def interpolate(self, timestamp, extrapolate=False):
+        '''
+        Interpolate the poses at given timestamps. Rotations are interpolated with slerp and the
+        translations are interpolated linearly.
+
+        :param timestamp: timestamp or an array of timestamps
+        :param extrapolate: If False, timestamps out of the scene range raise ValueError, otherwise
+            the poses of the first or the last frame are used (without motion extrapolation).
+        :return: (rotation, translation)
+        '''
+        timestamp = np.asarray(timestamp)
+        lo, hi = self.timestamps[0], self.timestamps[-1]
+        if not extrapolate and (np.any(timestamp < lo) or np.any(timestamp > hi)):
+            raise ValueError("Timestamp out of the range of the scene [%d, %d]" % (lo, hi))
+        if len(self.timestamps) == 1:
+            count = None if timestamp.ndim == 0 else len(timestamp)
+            idx = 0 if count is None else np.zeros(count, dtype=int)
+            return self.pose(idx)
+
+        # timestamps are offset to keep the precision of large values
+        timestamp = np.clip(timestamp, lo, hi) - lo
+        if self._slerp is None:
+            self._slerp = Slerp(self.timestamps - lo, self.rotations)
+        rotation = self._slerp(timestamp)
+        translation = np.stack([np.interp(timestamp, self.timestamps - lo, self.translations[:, i])
+                                for i in range(3)], axis=-1)
+        return rotation, translation
+
+def quantize_cloud(cloud, position_resolution=0.01):
+    '''
+    Quantize a point cloud for compact storage. Positions (first three columns) are stored as int16
+    with given resolution and other channels are stored as uint8, each column has its own scale and
+    offset. Channels with only small integer values (e.g. ring index) are preserved exactly.
+
+    :param cloud: point cloud array with shape N x C (C >= 3)
+    :param position_resolution: quantization step of the positions, the step is enlarged if the
+        extent of the point cloud cannot be represented with int16
+    :return: dictionary of quantized arrays, see dequantize_cloud
+    '''
+    cloud = np.asarray(cloud, dtype=np.float32)
+    if len(cloud) > 0:
+        lo, hi = cloud.min(axis=0), cloud.max(axis=0)
+    else:
+        lo = hi = np.zeros(cloud.shape[1], dtype=np.float32)
+
+    scale = np.empty(cloud.shape[1], dtype=np.float32)
+    offset = np.empty(cloud.shape[1], dtype=np.float32)
+    int16_max = np.iinfo(np.int16).max
+
+    # positions are centered so that the int16 range is fully used
+    offset[:3] = (lo[:3] + hi[:3]) / 2
+    scale[:3] = np.maximum(position_resolution, (hi[:3] - lo[:3]) / (2 * int16_max - 1))
+    position = np.round((cloud[:, :3] - offset[:3]) / scale[:3])
+    position = np.clip(position, -int16_max, int16_max).astype(np.int16)
+
+    # channels are mapped into [0, 255]
+    channels = cloud[:, 3:]
+    is_integer = np.all(channels == np.round(channels), axis=0) & (hi[3:] - lo[3:] <= 255)
+    offset[3:] = lo[3:]
+    scale[3:] = np.where(is_integer | (hi[3:] <= lo[3:]), 1, (hi[3:] - lo[3:]) / 255)
+    channels = np.round((channels - offset[3:]) / scale[3:])
+    channels = np.clip(channels, 0, 255).astype(np.uint8)
+
+    return dict(position=position, channels=channels, scale=scale, offset=offset)
+
+def dequantize_cloud(data, dtype=np.float32):
+    '''
+    Restore point cloud from the output of quantize_cloud.
+    The same operations (value * scale + offset) can be applied on GPU if raw arrays are loaded.
+    '''
+    position, channels = data['position'], data['channels']
+    scale, offset = data['scale'], data['offset']
+
+    cloud = np.empty((len(position), len(scale)), dtype=dtype)
+    np.multiply(position, scale[:3], out=cloud[:, :3], casting='unsafe')
+    np.multiply(channels, scale[3:], out=cloud[:, 3:], casting='unsafe')
+    cloud += offset
+    return cloud
 
 def _wrap_func(func, args, pool, nlock, offset):
     n = -1
@@ -0,0 +1,224 @@
+import logging
+from multiprocessing import Pool
+from pathlib import Path
+
+import numpy as np
+import numpy.random as npr
+import torch
+from tqdm import tqdm
+
+from d3d.box import box2d_from_flu, box2d_iou, box_crop
+from d3d.dataset.base import DetectionDatasetBase, LabelCache
+
+_logger = logging.getLogger("d3d")
+
+_worker_loader = None
+_worker_label_func = None
+
+def _default_label(obj):
+    return obj.tag_top.value
+
+def _init_worker(loader, label_func):
+    global _worker_loader, _worker_label_func
+    _worker_loader = loader
+    _worker_label_func = label_func
+
+def _extract_objects(idx):
+    loader, label_func = _worker_loader, _worker_label_func
+    objects = loader.lidar_objects(idx)
+    if len(objects) == 0:
+        return idx, np.empty((0, 7), dtype=np.float32), np.empty(0, dtype=np.int64), []
+
+    cloud = np.ascontiguousarray(loader.lidar_data(idx, concat=True), dtype=np.float32)
+    boxes = np.array([np.concatenate([obj.position, obj.dimension, [obj.yaw]]) for obj in objects], dtype=np.float32)
+    labels = np.array([label_func(obj) for obj in objects], dtype=np.int64)
+
+    indices, offsets, _ = box_crop(torch.from_numpy(cloud), box2d_from_flu(boxes))
+    indices, offsets = indices.numpy(), offsets.numpy()
+
+    points = []
+    for i, box in enumerate(boxes):
+        inbox = cloud[indices[offsets[i]:offsets[i+1]]]
+        inbox[:, :3] -= box[:3] # points are stored relative to the box center
+        points.append(inbox)
+    return idx, boxes, labels, points
+
+class ObjectDatabase:
+    '''
+    This class stores the point clouds inside every ground truth box of a dataset, which are used
+    for copy-paste augmentation (GT-sampling in SECOND). Points of all objects are stored in a single
+    binary file that is memory-mapped, and the object boxes are stored in columnar arrays.
+
+    # Directory Structure
+    - <database directory>
+        - objects.npz: boxes (x, y, z, l, w, h, yaw), labels, frame keys and point offsets of objects
+        - points.bin: float32 points relative to the box center, concatenated by objects
+    '''
+    VERSION = 1
+
+    def __init__(self, path, min_points=5, seed=None):
+        '''
+        :param path: directory of the database
+        :param min_points: objects with fewer points are not sampled
+        :param seed: seed of the random generator used for sampling
+        '''
+        path = Path(path)
+        with np.load(path / "objects.npz") as data:
+            if int(data['version']) != self.VERSION:
+                raise ValueError("Object database %s is created by an incompatible version, please rebuild it" % path)
+            self.boxes = data['boxes']
+            self.labels = data['labels']
+            self.frames = data['frames']
+            self._offsets = data['offsets']
+            channels = int(data['channels'])
+
+        total = int(self._offsets[-1])
+        if total > 0:
+            self._points = np.memmap(path / "points.bin", dtype=np.float32, mode='r', shape=(total, channels))
+        else:
+            self._points = np.empty((0, channels), dtype=np.float32)
+
+        # group objects by class
+        valid = np.diff(self._offsets) >= min_points
+        self._groups = {}
+        for label in np.unique(self.labels).tolist():
+            self._groups[label] = np.flatnonzero(valid & (self.labels == label))
+        self._rng = npr.default_rng(seed)
+        self._orders = {label: self._rng.permutation(group) for label, group in self._groups.items()}
+        self._cursors = {label: 0 for label in self._groups}
+
+    @classmethod
+    def build(cls, loader: DetectionDatasetBase, path, nworkers=8, label_func=None):
+        '''
+        Extract the points in every ground truth box of the loader and save them to a database
+
+        :param loader: the dataset loader, point clouds are loaded with `lidar_data(idx, concat=True)`,
+            which should be in the same frame as the objects from `lidar_objects(idx)`
+        :param path: output directory of the database
+        :param nworkers: number of worker processes
+        :param label_func: function that converts an object to its integer label. By default the
+            value of the top tag is used. It's sent to the worker processes, so it should be picklable
+            (e.g. a module level function rather than a lambda)
+        '''
+        path = Path(path)
+        path.mkdir(parents=True, exist_ok=True)
+        label_func = label_func or _default_label
+
+        boxes, labels, frames, counts = [], [], [], []
+        channels = None
+        with open(path / "points.bin", "wb") as fout:
+            # the loader is passed to the workers on creation, so it's not pickled for each frame
+            with Pool(nworkers, initializer=_init_worker, initargs=(loader, label_func)) as pool:
+                results = pool.imap(_extract_objects, range(len(loader)), chunksize=4)
+                for idx, frame_boxes, frame_labels, frame_points in tqdm(results, total=len(loader),
+                    desc="Building object database"):
+                    key = LabelCache.frame_key(loader, idx)
+                    for points in frame_points:
+                        if channels is None:
+                            channels = points.shape[1]
+                        elif points.shape[1] != channels:
+                            raise ValueError("Point clouds have inconsistent number of channels")
+                        fout.write(points.tobytes())
+                        counts.append(len(points))
+
+                    boxes.append(frame_boxes)
+                    labels.append(frame_labels)
+                    frames.append(np.full(len(frame_boxes), key, dtype=np.int64))
+
+        with open(path / "objects.npz", "wb") as fout:
+            np.savez(fout,
+                version=cls.VERSION,
+                channels=channels or 0,
+                boxes=np.concatenate(boxes) if boxes else np.empty((0, 7), dtype=np.float32),
+                labels=np.concatenate(labels) if labels else np.empty(0, dtype=np.int64),
+                frames=np.concatenate(frames) if frames else np.empty(0, dtype=np.int64),
+                offsets=np.concatenate([[0], np.cumsum(counts, dtype=np.int64)])
+            )
+        _logger.info("Object database with %d objects is saved to %s", len(counts), path)
+
+    def __len__(self):
+        return len(self.labels)
+
+    def class_count(self, label):
+        '''
+        Return the number of objects that can be sampled in a class
+        '''
+        return len(self._groups.get(label, []))
+
+    def points(self, oidx, absolute=True):
+        '''
+        Return the points of an object
+
+        :param absolute: If False, the points are relative to the box center
+        '''
+        points = np.array(self._points[self._offsets[oidx]:self._offsets[oidx+1]])
+        if absolute:
+            points[:, :3] += self.boxes[oidx, :3]
+        return points
+
+    def _draw(self, label, count):
+        '''
+        Draw objects of a class without replacement, the order is reshuffled after all the objects are drawn
+        '''
+        group = self._groups.get(label, None)
+        if group is None or len(group) == 0:
+            return np.empty(0, dtype=np.int64)
+
+        drawn = []
+        while count > 0:
+            order, cursor = self._orders[label], self._cursors[label]
+            take = min(count, len(order) - cursor)
+            drawn.append(order[cursor:cursor + take])
+            count -= take
+            if cursor + take == len(order):
+                self._orders[label] = self._rng.permutation(group)
+                self._cursors[label] = 0
+            else:
+                self._cursors[label] = cursor + take
+        return np.concatenate(drawn)
+
+    def sample(self, sample_counts, existing_boxes=None, existing_labels=None):
+        '''
+        Sample objects from the database with class balance. Sampled objects that collide with
+        existing boxes or previously accepted samples (BEV IoU > 0) are dropped.
+
+        :param sample_counts: dictionary of label -> expected number of objects of the class in the frame
+        :param existing_boxes: boxes (x, y, z, l, w, h, yaw) in the frame, with shape N x 7
+        :param existing_labels: labels of the existing boxes. If given, the number of existing objects
+            is subtracted from the expected number of each class
+        :return: (object indices, boxes, labels, points, offsets). The points of all sampled objects are
+            concatenated, points of the i-th object are points[offsets[i]:offsets[i+1]]
+        '''
+        if existing_boxes is None:
+            existing_boxes = np.empty((0, 7), dtype=np.float32)
+        existing_boxes = np.asarray(existing_boxes, dtype=np.float32).reshape(-1, 7)
+
+        candidates = []
+        for label, count in sample_counts.items():
+            if existing_labels is not None:
+                count -= int(np.sum(np.asarray(existing_labels) == label))
+            if count > 0:
+                candidates.append(self._draw(label, count))
+        candidates = np.concatenate(candidates) if candidates else np.empty(0, dtype=np.int64)
+
+        if len(candidates) > 0:
+            # collision check with one batched IoU computation
+            cboxes = self.boxes[candidates]
+            ious = box2d_iou(box2d_from_flu(cboxes), box2d_from_flu(np.concatenate([existing_boxes, cboxes])),
+                method="bev").numpy()
+            ious[:, len(existing_boxes):][np.diag_indices(len(candidates))] = 0
+
+            accepted = np.zeros(len(candidates), dtype=bool)
+            for i in range(len(candidates)):
+                collided = np.any(ious[i, :len(existing_boxes)] > 0) or \
+                    np.any(ious[i, len(existing_boxes):][accepted] > 0)
+                accepted[i] = not collided
+            candidates = candidates[accepted]
+
+        counts = np.diff(self._offsets)[candidates]
+        offsets = np.concatenate([[0], np.cumsum(counts)])
+        if len(candidates) > 0:
+            points = np.concatenate([self.points(oidx) for oidx in candidates.tolist()])
+        else:
+            points = np.empty((0, self._points.shape[1]), dtype=np.float32)
+        return candidates, self.boxes[candidates], self.labels[candidates], points, offsets
@@ -4,9 +4,11 @@ import shutil
 import subprocess
 import tempfile
 from enum import Enum, auto
+from multiprocessing import Pool
 from zipfile import ZipFile
 
 import numpy as np
+from addict import Dict as edict
 from scipy.spatial.transform import Rotation
 
 from d3d.abstraction import (ObjectTag, ObjectTarget3D, ObjectTarget3DArray,
@@ -154,6 +156,9 @@ class KittiObjectLoader(DetectionDatasetBase):
         '''
         Return list of converted ground truth targets. Objects labelled as `DontCare` are removed
         '''
+        cached = self._cached_objects(idx, lambda value: ObjectTag(value, KittiObjectClass))
+        if cached is not None:
+            return cached
         return self._generate_objects(self.lidar_label(idx), self.calibration_data(idx, raw=True))
 
     def identity(self, idx):
@@ -245,49 +250,47 @@ class KittiObjectLoader(DetectionDatasetBase):
 
         return objects
 
-def _line_box_intersect(p0, p1, width, height):
-    # p0: inlier point
-    # p1: outlier point
-    k = (p1[1] - p0[1]) / (p1[0] - p0[0])
-    
-    # find which border
-    case = None
-    if p1[0] < p0[0]:
-        if p1[1] < p0[1]:
-            k0 = p0[1] / p0[0]
-            case = 2 if k > k0 else 3
-        else:
-            k0 = - (height - p0[1]) / p0[0]
-            case = 3 if k > k0 else 0
-    else:
-        if p1[1] < p0[1]:
-            k0 = - p0[1] / (width - p0[0])
-            case = 1 if k > k0 else 2
-        else:
-            k0 = (height - p0[1]) / (width - p0[0])
-            case = 0 if k > k0 else 1
-
-    # do intersection
-    if case == 0: # y > height border
-        x = p0[0] + (height - p0[1]) / k
-        y = height
-    elif case == 1: # x > width border
-        x = width
-        y = p0[1] + (width - p0[0]) * k
-    elif case == 2: # y < 0 border
-        x = p1[0] + (-p1[1]) / k
-        y = 0
-    elif case == 3: # x < 0 border
-        x = 0
-        y = p1[1] + (-p1[0]) * k
-
-    assert 0 <= x <= width, "x = %.2f" % x
-    assert 0 <= y <= height, "y = %.2f" % y
-    return (x, y)
+# edges of the box corners, the corners are in the order of ObjectTarget3D.corners
+_BoxEdges = np.array([(0, 1), (2, 3), (4, 5), (6, 7),
+                      (0, 4), (1, 5), (2, 6), (3, 7),
+                      (0, 2), (1, 3), (4, 6), (5, 7)])
+_BoxCorners = np.array(np.meshgrid([-0.5, 0.5], [-0.5, 0.5], [-0.5, 0.5])).T.reshape(-1, 3)
 
-def dump_detection_output(detections: ObjectTarget3DArray, calib:TransformSet, raw_calib: dict):
+def _clip_edges(p0, p1, width, height):
     '''
-    Save the detection in KITTI output format. We need raw calibration for R0_rect
+    Intersect the segments from inlier points p0 to outlier points p1 with the image borders in batch
+    '''
+    delta = p1 - p0
+    upper = np.array([width, height])
+    with np.errstate(divide='ignore', invalid='ignore'):
+        # the segment leaves the image at the border crossed first
+        t = np.where(delta > 0, (upper - p0) / delta, np.where(delta < 0, -p0 / delta, np.inf))
+        t = np.clip(np.min(t, axis=-1, keepdims=True), 0, 1)
+        return np.clip(p0 + t * delta, 0, upper)
+
+def label_columns(label):
+    '''
+    Convert the label data (from KittiObjectLoader.lidar_label) into columnar arrays in camera coordinates, which
+    can be used by d3d.benchmarks.KittiObjectBenchmark. Objects labelled as `DontCare` are kept.
+    '''
+    values = np.array([row[1:15] for row in label], dtype=np.float64).reshape(-1, 14)
+    return edict(
+        label=np.array([row[0].value for row in label], dtype=np.int32),
+        truncation=values[:, 0],
+        occlusion=values[:, 1],
+        alpha=values[:, 2],
+        bbox=values[:, 3:7],
+        dimension=values[:, 7:10], # height, width, length
+        location=values[:, 10:13], # bottom center
+        rotation_y=values[:, 13],
+        score=np.array([row[15] if len(row) > 15 else 1 for row in label], dtype=np.float64)
+    )
+
+def object_columns(detections: ObjectTarget3DArray, calib: TransformSet, raw_calib: dict):
+    '''
+    Convert the detections into columnar arrays of KITTI label fields in camera coordinates, the 2D boxes are
+    calculated by projecting the boxes onto the image. Boxes outside the image are removed. We need raw
+    calibration for R0_rect
     '''
     # get intrinsics
     assert detections.frame == "velo"
@@ -298,58 +301,123 @@ def dump_detection_output(detections: ObjectTarget3DArray, calib:TransformSet, r
     meta = calib.intrinsics_meta['cam2']
     width, height = meta.width, meta.height
 
-    # process detections
-    output_lines = []
-    output_format = "%s 0 0 0" + " %.2f" * 12
-    for box in detections:
-        # calculate bounding box 2D
-        uv, mask, dmask = calib.project_points_to_camera(box.corners,
-            frame_to="cam2", frame_from="velo", remove_outlier=False, return_dmask=True)
-        if len(uv[mask]) < 1: continue # ignore boxes that is outside the image
-
-        bdpoints = []
-        pairs = [(0, 1), (2, 3), (4, 5), (6, 7), # box lines
-                 (0, 4), (1, 5), (2, 6), (3, 7),
-                 (0, 2), (1, 3), (4, 6), (5, 7)]
-        inlier = [i in mask for i in range(len(uv))]
-        for i, j in pairs:
-            if not inlier[i] and not inlier[j]:
-                continue
-            if i not in dmask or j not in dmask: # only calculate for points ahead
-                continue
-            if not inlier[i]:
-                bdpoints.append(_line_box_intersect(uv[j], uv[i], width, height))
-            if not inlier[j]:
-                bdpoints.append(_line_box_intersect(uv[i], uv[j], width, height))
-
-        uv = np.array(uv[mask].tolist() + bdpoints)
-        umin, vmin = np.min(uv, axis=0)
-        umax, vmax = np.max(uv, axis=0)
-
-        # calculate position in original 3D frame
-        l,w,h = box.dimension
-        position = RRect.as_matrix().dot(HR.as_matrix().dot(box.position) + HT)
-        position[1] += h/2
-        orientation = box.orientation * Rotation.from_euler("x", np.pi/2)
-        orientation = RRect * HR * orientation
-        yaw = orientation.as_euler("YZX")[0]
-
-        output_values = (box.tag_name,)
-        output_values += (umin, vmin, umax, vmax)
-        output_values += (h, w, l)
-        output_values += tuple(position.tolist())
-        output_values += (yaw, box.tag_score)
-        output_lines.append(output_format % output_values)
-    
-    return "\n".join(output_lines)
-        
+    if len(detections) == 0:
+        empty = np.empty((0, 3))
+        return edict(label=np.empty(0, dtype=np.int32), truncation=np.empty(0), occlusion=np.empty(0),
+            alpha=np.empty(0), bbox=np.empty((0, 4)), dimension=empty, location=empty, rotation_y=np.empty(0),
+            score=np.empty(0))
+
+    positions = np.array([box.position for box in detections], dtype=np.float64)
+    dimensions = np.array([box.dimension for box in detections], dtype=np.float64)
+    orientations = Rotation.from_quat([box.orientation.as_quat() for box in detections])
+
+    # project the corners of all boxes at once
+    corners = (_BoxCorners[None] * dimensions[:, None]) @ orientations.as_matrix().transpose(0, 2, 1)
+    corners = corners + positions[:, None]
+    uv, mask, dmask = calib.project_points_to_camera(corners.reshape(-1, 3),
+        frame_to="cam2", frame_from="velo", remove_outlier=False, return_dmask=True)
+    uv = uv.reshape(-1, 8, 2)
+    inlier = np.zeros(uv.shape[0] * 8, dtype=bool)
+    inlier[mask] = True
+    inlier = inlier.reshape(-1, 8)
+    ahead = np.zeros(uv.shape[0] * 8, dtype=bool)
+    ahead[dmask] = True
+    ahead = ahead.reshape(-1, 8)
+
+    # calculate bounding box 2D from the inlier corners and the intersections of edges with image borders
+    inlier_uv = np.where(inlier[..., None], uv, np.nan)
+    i, j = _BoxEdges[:, 0], _BoxEdges[:, 1]
+    clipped = ahead[:, i] & ahead[:, j] & (inlier[:, i] != inlier[:, j]) # only calculate for points ahead
+    p0 = np.where(inlier[:, i, None], uv[:, i], uv[:, j])
+    p1 = np.where(inlier[:, i, None], uv[:, j], uv[:, i])
+    bdpoints = np.where(clipped[..., None], _clip_edges(p0, p1, width, height), np.nan)
+    points = np.concatenate([inlier_uv, bdpoints], axis=1)
+
+    selected = np.any(inlier, axis=1) # ignore boxes that is outside the image
+    points = points[selected]
+    with np.errstate(invalid='ignore'):
+        bbox = np.concatenate([np.nanmin(points, axis=1), np.nanmax(points, axis=1)], axis=1)
+
+    # calculate position in original 3D frame
+    l, w, h = dimensions[selected].T
+    location = (positions[selected].dot(HR.as_matrix().T) + HT).dot(RRect.as_matrix().T)
+    location[:, 1] += h/2
+    orientation = orientations[selected] * Rotation.from_euler("x", np.pi/2)
+    orientation = RRect * HR * orientation
+    rotation_y = orientation.as_euler("YZX")[:, 0]
+    alpha = rotation_y - np.arctan2(location[:, 0], location[:, 2]) # observation angle
+
+    label = [KittiObjectClass[box.tag_name].value for box, s in zip(detections, selected) if s]
+    score = [box.tag_score for box, s in zip(detections, selected) if s]
+    return edict(
+        label=np.array(label, dtype=np.int32),
+        truncation=np.zeros(len(label)),
+        occlusion=np.zeros(len(label)),
+        alpha=np.arctan2(np.sin(alpha), np.cos(alpha)),
+        bbox=bbox,
+        dimension=np.stack([h, w, l], axis=1),
+        location=location,
+        rotation_y=rotation_y,
+        score=np.array(score, dtype=np.float64)
+    )
+
+def dump_detection_output(detections: ObjectTarget3DArray, calib:TransformSet, raw_calib: dict):
+    '''
+    Save the detection in KITTI output format. We need raw calibration for R0_rect
+    '''
+    columns = object_columns(detections, calib, raw_calib)
+    names = [KittiObjectClass(value).name for value in columns.label.tolist()]
+    values = np.column_stack([columns.alpha, columns.bbox, columns.dimension, columns.location,
+        columns.rotation_y, columns.score])
+
+    output_format = "%s 0 0" + " %.2f" * 13
+    return "\n".join(output_format % ((name,) + tuple(row)) for name, row in zip(names, values.tolist()))
+
+_worker_loader = None
+_worker_path = None
+
+def _init_worker(loader, output_path):
+    global _worker_loader, _worker_path
+    _worker_loader = loader
+    _worker_path = output_path
+
+def _dump_frame(frame):
+    idx, detections = frame
+    loader = _worker_loader
+    output = dump_detection_output(detections, loader.calibration_data(idx), loader.calibration_data(idx, raw=True))
+    with open(osp.join(_worker_path, "%06d.txt" % loader.identity(idx)[1]), "w") as fout:
+        fout.write(output)
+    return idx
+
+def dump_detection_outputs(loader: KittiObjectLoader, detections, output_path, nworkers=8, chunksize=16):
+    '''
+    Save the detections of many frames into result files of KITTI format (one file per frame), the files are
+    generated and written in a process pool.
+
+    :param loader: the dataset loader, calibrations are loaded in the workers
+    :param detections: iterable of (index in loader, ObjectTarget3DArray). Frames without detections should
+        also be included with an empty array, since the official evaluator requires files for all frames
+    :param output_path: output directory of the result files
+    :param nworkers: number of worker processes
+    :return: number of written files
+    '''
+    if not osp.exists(output_path):
+        os.makedirs(output_path)
+
+    count = 0
+    with Pool(nworkers, initializer=_init_worker, initargs=(loader, output_path)) as pool:
+        for _ in pool.imap_unordered(_dump_frame, detections, chunksize=chunksize):
+            count += 1
+    return count
+
 
 def execute_official_evaluator(exec_path, label_path, result_path, output_path, model_name=None, show_output=True):
     '''
     Execute official evaluator from KITTI devkit
     :param model_name: unique name of your model. KITTI tool requires sha1 as model name, but that's not mandatory.
 
-    Note: to install prerequisites `sudo apt install gnuplot texlive-extra-utils
+    Note: to install prerequisites `sudo apt install gnuplot texlive-extra-utils`. The same numbers can be
+    calculated in memory by d3d.benchmarks.KittiObjectBenchmark without these prerequisites
     '''
     model_name = model_name or "noname"
 
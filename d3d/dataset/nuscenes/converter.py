@@ -8,7 +8,6 @@ import shutil
 import tarfile
 import tempfile
 import time
-import zipfile
 from collections import defaultdict
 from multiprocessing import Pool, Value
 from pathlib import Path, PurePath
@@ -16,6 +15,8 @@ from pathlib import Path, PurePath
 import numpy as np
 from tqdm import tqdm
 
+from d3d.dataset.base import ZipWriter, quantize_cloud
+
 
 def _load_dict(item):
     token = int(item.pop('token'), 16)
@@ -35,14 +36,18 @@ def _load_table(path):
         return kvdata
 
 class KeyFrameConverter:
-    def __init__(self, input_meta_path, input_blob_paths, output_path):
+    def __init__(self, input_meta_path, input_blob_paths, output_path, compression=None, quantize=False):
         '''
         :param local_map_range: Range of generated local map in meters, range <= 0 means not to output map
+        :param compression: compression methods for each modality, see ZipWriter for details
+        :param quantize: store lidar point clouds as quantized arrays, see quantize_cloud for details
         '''
         assert isinstance(input_blob_paths, list), "blobs path should be a list"
         self.meta_path = Path(input_meta_path)
         self.blob_paths = [Path(p) for p in input_blob_paths]
         self.output_path = Path(output_path)
+        self.compression = compression
+        self.quantize = quantize
 
         # nuscenes tables
         self.sample_table = None
@@ -85,13 +90,15 @@ class KeyFrameConverter:
             log = self.log_table[data['log_token']]
             self.scene_map_table[stoken] = log_map_table[data['log_token']]
 
-            self.ohandles[stoken] = zipfile.ZipFile(self.output_path / ("%s.zip" % data['name']), "w")
+            self.ohandles[stoken] = ZipWriter(self.output_path / ("%s.zip" % data['name']),
+                compression=self.compression)
             with self.ohandles[stoken].open("scene/stats.json", "w") as fout:
                 meta = dict(
                     nbr_samples=data['nbr_samples'],
                     description=data['description'],
                     token=hex(stoken)[2:],
-                    map=self.scene_map_table[stoken]
+                    map=self.scene_map_table[stoken],
+                    lidar_format="quantized" if self.quantize else "raw"
                 )
                 meta.update(log)
                 fout.write(json.dumps(meta).encode())
@@ -256,8 +263,13 @@ class KeyFrameConverter:
 
                 # save sample data and pose
                 token, scene, sensor, order, ext = self.filename_table[fname]
-                with self.ohandles[scene].open("%s/%03d.%s" % (sensor, order, ext), "w") as fout:
-                    shutil.copyfileobj(blob_file.extractfile(tinfo), fout)
+                if self.quantize and sensor.startswith("lidar"):
+                    cloud = np.frombuffer(blob_file.extractfile(tinfo).read(), dtype=np.float32)
+                    with self.ohandles[scene].open("%s/%03d.npz" % (sensor, order), "w") as fout:
+                        np.savez(fout, **quantize_cloud(cloud.reshape(-1, 5)))
+                else:
+                    with self.ohandles[scene].open("%s/%03d.%s" % (sensor, order, ext), "w") as fout:
+                        shutil.copyfileobj(blob_file.extractfile(tinfo), fout)
                 if sensor == "lidar_top": # here we choose the pose of lidar as the pose of the key frame
                     ptoken = self.sample_data_table[token]["ego_pose_token"]
                     pose = self.ego_pose_table[ptoken]
@@ -314,7 +326,7 @@ class KeyFrameConverter:
             if self.temp_dir is not None:
                 shutil.rmtree(self.temp_dir)
 
-def convert_dataset_inpath(input_path, output_path, debug=False, mini=False):
+def convert_dataset_inpath(input_path, output_path, debug=False, mini=False, compression=None, quantize=False):
     input_path, output_path = Path(input_path), Path(output_path)
     if mini: # convert mini dataset
         phase_path = output_path / "trainval"
@@ -323,7 +335,7 @@ def convert_dataset_inpath(input_path, output_path, debug=False, mini=False):
 
         mini_archive = next(input_path.glob("*-mini.*"))
         KeyFrameConverter(input_meta_path=mini_archive, input_blob_paths=[mini_archive],
-            output_path=phase_path).convert(debug)
+            output_path=phase_path, compression=compression, quantize=quantize).convert(debug)
     else:
         # convert trainval dataset
         print("Processing trainval datasets...")
@@ -334,7 +346,7 @@ def convert_dataset_inpath(input_path, output_path, debug=False, mini=False):
         trainval_meta = next(input_path.glob("*-trainval_meta.*"))
         trainval_blobs = list(p for p in input_path.glob("*blobs*") if 'trainval' in p.name)
         KeyFrameConverter(input_meta_path=trainval_meta, input_blob_paths=trainval_blobs,
-            output_path=phase_path).convert(debug)
+            output_path=phase_path, compression=compression, quantize=quantize).convert(debug)
 
         # convert test dataset
         print("Processing test datasets")
@@ -345,7 +357,7 @@ def convert_dataset_inpath(input_path, output_path, debug=False, mini=False):
         test_meta = next(input_path.glob("*-test_meta.*"))
         test_blobs = list(p for p in input_path.glob("*blobs*") if 'test' in p.name)
         KeyFrameConverter(input_meta_path=test_meta, input_blob_paths=test_blobs,
-            output_path=phase_path).convert(debug)
+            output_path=phase_path, compression=compression, quantize=quantize).convert(debug)
 
 def main():
     from argparse import ArgumentParser
@@ -365,6 +377,12 @@ def main():
         help="Convert all data frames. By default only key frames are preserved.")
     parser.add_argument('-u', '--unzip', action="store_true",
         help="Convert the result into directory rather than zip files")
+    parser.add_argument('-c', '--compression', type=str, default=None,
+        help="Compression method for each modality, e.g. \"lidar=deflated,label=lzma\". "
+             "Valid modalities are lidar, camera, radar, label and meta, valid methods are "
+             "stored, deflated, bzip2 and lzma. Data is stored without compression by default.")
+    parser.add_argument('-q', '--quantize-lidar', dest="quantize", action="store_true",
+        help="Store lidar point clouds as quantized arrays (1cm position resolution, 8-bit channels)")
     args = parser.parse_args()
 
     if args.unzip: # XXX: implement this
@@ -375,7 +393,9 @@ def main():
         #      Canbus extension and Vector map should be included when converting all frames
         raise NotImplementedError("Converting all frames is not implemented")
 
-    convert_dataset_inpath(args.input, args.output or args.input, debug=args.debug, mini=args.mini)
+    ZipWriter.parse_compression(args.compression) # check the argument before conversion
+    convert_dataset_inpath(args.input, args.output or args.input,
+        debug=args.debug, mini=args.mini, compression=args.compression, quantize=args.quantize)
 
 if __name__ == "__main__":
     main()
@@ -15,7 +15,8 @@ from scipy.spatial.transform import Rotation
 
 from d3d.abstraction import (ObjectTag, ObjectTarget3D, ObjectTarget3DArray,
                              TransformSet)
-from d3d.dataset.base import DetectionDatasetBase, ZipCache, _check_frames
+from d3d.dataset.base import (ArchiveIndex, DetectionDatasetBase, ScenePoses,
+                              _check_frames, dequantize_cloud)
 
 _logger = logging.getLogger("d3d")
 
@@ -173,34 +174,15 @@ class NuscenesObjectLoader(DetectionDatasetBase):
         self.base_path = Path(base_path) / ("trainval" if phase in ["training", "validation"] else "test")
         self.phase = phase
         self._load_metadata()
+        self._poses = {} # scene name -> ScenePoses, loaded on first access
 
         # split trainval
         total_count = sum(v.nbr_samples for v in self._metadata.values())
         self._split_trainval(phase, total_count, trainval_split, trainval_random)
 
-        self._zip_cache = ZipCache()
-
     def _load_metadata(self):
-        meta_path = self.base_path / "metadata.json"
-        if not meta_path.exists():
-            _logger.info("Creating metadata of Nuscenes dataset (%s)...", self.phase)
-            metadata = {}
-
-            for archive in self.base_path.iterdir():
-                if archive.is_dir() or archive.suffix != ".zip":
-                    continue
-
-                with zipfile.ZipFile(archive) as ar:
-                    with ar.open("scene/stats.json") as fin:
-                        metadata[archive.stem] = json.loads(fin.read().decode())
-            with open(meta_path, "w") as fout:
-                json.dump(metadata, fout)
-
-        with open(meta_path) as fin:
-            self._metadata = OrderedDict()
-            meta_json = json.load(fin)
-            for k, v in meta_json.items():
-                self._metadata[k] = edict(v)
+        self._index = ArchiveIndex(self.base_path, "scene/stats.json")
+        self._metadata = OrderedDict((k, edict(v)) for k, v in self._index.stats.items())
 
     def __len__(self):
         return len(self.frames)
@@ -218,26 +200,40 @@ class NuscenesObjectLoader(DetectionDatasetBase):
 
     def _locate_file(self, idx, folders, suffix):
         fname, fidx = self._locate_frame(idx)
-        ar = self._zip_cache.open(self.base_path / (fname + ".zip"))
         if isinstance(folders, list):
-            return [ar.open("%s/%03d.%s" % (f, fidx, suffix)) for f in folders]
+            return [self._index.open(fname, "%s/%03d.%s" % (f, fidx, suffix)) for f in folders]
         else:
-            return ar.open("%s/%03d.%s" % (folders, fidx, suffix))
+            return self._index.open(fname, "%s/%03d.%s" % (folders, fidx, suffix))
 
     def map_data(self, idx):
         # XXX: see https://jdhao.github.io/2019/02/23/crop_rotated_rectangle_opencv/ for image cropping
         raise NotImplementedError()
 
-    def lidar_data(self, idx, names='lidar_top', concat=False):
+    def lidar_data(self, idx, names='lidar_top', concat=False, dequantize=True):
+        '''
+        :param dequantize: If the point cloud is stored quantized and this flag is set to False, the
+            raw quantized arrays will be returned (see d3d.dataset.base.quantize_cloud) without frame conversion.
+        '''
         if isinstance(names, str):
             names = [names]
         if names != self.VALID_LIDAR_NAMES:
             raise ValueError("There's only one lidar in Nuscenes dataset")
 
-        with self._locate_file(idx, "lidar_top", "pcd") as fin:
-            buffer = fin.read()
-        scan = np.frombuffer(buffer, dtype=np.float32)
-        scan = np.copy(scan.reshape(-1, 5)) # (x, y, z, intensity, ring index)
+        fname, _ = self._locate_frame(idx)
+        if self._metadata[fname].get("lidar_format", "raw") == "quantized":
+            with self._locate_file(idx, "lidar_top", "npz") as fin:
+                buffer = fin.read()
+            data = edict(dict(np.load(BytesIO(buffer))))
+            if not dequantize:
+                if concat:
+                    raise ValueError("Quantized point cloud cannot be converted to base frame")
+                return data
+            scan = dequantize_cloud(data)
+        else:
+            with self._locate_file(idx, "lidar_top", "pcd") as fin:
+                buffer = fin.read()
+            scan = np.frombuffer(buffer, dtype=np.float32)
+            scan = np.copy(scan.reshape(-1, 5)) # (x, y, z, intensity, ring index)
 
         if concat: # convert lidar to base frame
             calib = self.calibration_data(idx)
@@ -263,6 +259,16 @@ class NuscenesObjectLoader(DetectionDatasetBase):
             return list(map(edict, json.loads(fin.read().decode())))
 
     def lidar_objects(self, idx, convert_tag=False):
+        def create_tag(tag):
+            if convert_tag:
+                return ObjectTag(tag.to_detection(), NuscenesDetectionClass)
+            else:
+                return ObjectTag(tag, NuscenesObjectClass)
+
+        cached = self._cached_objects(idx, lambda value: create_tag(NuscenesObjectClass(value)))
+        if cached is not None:
+            return cached
+
         labels = self.lidar_label(idx)
         outputs = ObjectTarget3DArray(frame="ego")
 
@@ -272,10 +278,7 @@ class NuscenesObjectLoader(DetectionDatasetBase):
             tag = NuscenesObjectClass.parse(label.category)
             for attr in label.attribute:
                 tag = tag | NuscenesObjectClass.parse(attr)
-            if convert_tag:
-                tag = ObjectTag(tag.to_detection(), NuscenesDetectionClass)
-            else:
-                tag = ObjectTag(tag, NuscenesObjectClass)
+            tag = create_tag(tag)
 
             # caculate relative pose
             r = Rotation.from_quat(label.rotation[1:] + [label.rotation[0]])
@@ -293,9 +296,8 @@ class NuscenesObjectLoader(DetectionDatasetBase):
     def calibration_data(self, idx):
         fname, _ = self._locate_frame(idx)
         calib_params = TransformSet("ego")
-        ar = self._zip_cache.open(self.base_path / (fname + ".zip"))
 
-        with ar.open("scene/calib.json") as fin:
+        with self._index.open(fname, "scene/calib.json") as fin:
             calib_data = json.loads(fin.read().decode())
             for frame, calib in calib_data.items():
                 # set intrinsics
@@ -324,16 +326,34 @@ class NuscenesObjectLoader(DetectionDatasetBase):
         scene, fidx = self._locate_frame(idx)
         return self.phase, scene, fidx
 
+    def _load_scene_poses(self, scene):
+        if scene not in self._poses:
+            timestamps, rotations, translations = [], [], []
+            for fidx in range(self._metadata[scene].nbr_samples):
+                with self._index.open(scene, "timestamp/%03d.txt" % fidx) as fin:
+                    timestamps.append(int(fin.read()))
+                with self._index.open(scene, "pose/%03d.json" % fidx) as fin:
+                    data = json.loads(fin.read().decode())
+                rotations.append(data['rotation'][1:] + [data['rotation'][0]])
+                translations.append(data['translation'])
+            self._poses[scene] = ScenePoses(timestamps, Rotation.from_quat(rotations), translations)
+        return self._poses[scene]
+
+    def scene_poses(self, idx):
+        '''
+        Return the timestamps and poses of all frames in the scene containing the frame.
+        See d3d.dataset.base.ScenePoses for the supported queries, the frame indices there are within the scene.
+        '''
+        scene, _ = self._locate_frame(idx)
+        return self._load_scene_poses(scene)
+
     def timestamp(self, idx):
-        with self._locate_file(idx, "timestamp", "txt") as fin:
-            return int(fin.read())
+        scene, fidx = self._locate_frame(idx)
+        return int(self._load_scene_poses(scene).timestamps[fidx])
 
     def pose(self, idx):
         '''
         Return (rotation, translation)
         '''
-        with self._locate_file(idx, "pose", "json") as fin:
-            data = json.loads(fin.read().decode())
-        r = Rotation.from_quat(data['rotation'][1:] + [data['rotation'][0]])
-        t = np.array(data['translation'])
-        return r, t
+        scene, fidx = self._locate_frame(idx)
+        return self._load_scene_poses(scene).pose(fidx)
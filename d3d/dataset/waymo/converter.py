@@ -7,7 +7,6 @@ import os
 import shutil
 import tarfile
 import tempfile
-import zipfile
 
 import numpy as np
 from tqdm import tqdm
@@ -16,7 +15,7 @@ os.environ['TF_CPP_MIN_LOG_LEVEL'] = '3' # disable logging
 os.environ['CUDA_VISIBLE_DEVICES'] = '-1' # disable GPU usage
 
 import tensorflow as tf
-from d3d.dataset.base import NumberPool
+from d3d.dataset.base import NumberPool, ZipWriter, quantize_cloud
 from waymo_open_dataset import dataset_pb2, label_pb2
 from waymo_open_dataset.utils import (frame_utils, range_image_utils,
                                       transform_utils)
@@ -120,7 +119,7 @@ def add_property(proto, dict, name):
     if proto.HasField(name):
         dict[name] = getattr(proto, name)
 
-def save_context(frame, frame_count, output_zip):
+def save_context(frame, frame_count, output_zip, quantize=False):
     # save stats
     with output_zip.open("context/stats.json", "w") as fout:
         stats = {}
@@ -139,6 +138,7 @@ def save_context(frame, frame_count, output_zip):
             stats['camera_object_counts'][label_name_map[objcount.type]] = objcount.count
 
         stats['frame_count'] = frame_count
+        stats['lidar_format'] = "quantized" if quantize else "raw"
         fout.write(json.dumps(stats).encode())
 
     # save calibrations
@@ -178,7 +178,15 @@ def save_image(frame, frame_idx, output_zip):
         with output_zip.open("camera_%s/%04d.jpg" % (camera_name_map[image.name], frame_idx), "w") as fout:
             fout.write(image.image)
 
-def save_point_cloud(frame, frame_idx, output_zip):
+def _save_cloud(cloud, name, output_zip, quantize):
+    if quantize:
+        with output_zip.open(name + ".npz", "w") as fout:
+            np.savez(fout, **quantize_cloud(cloud))
+    else:
+        with output_zip.open(name + ".npy", "w") as fout:
+            np.save(fout, cloud)
+
+def save_point_cloud(frame, frame_idx, output_zip, quantize=False):
     range_images, camera_projections, range_image_top_pose =\
         frame_utils.parse_range_image_and_camera_projection(frame)
     points, cp_points, channels = convert_range_image_to_point_cloud(
@@ -189,11 +197,9 @@ def save_point_cloud(frame, frame_idx, output_zip):
     for i in range(5):
         name = lidar_name_map[i+1]
         cloud = np.hstack((points[i], channels[i]))
-        with output_zip.open("lidar_%s/%04d.npy" % (name, frame_idx), "w") as fout:
-            np.save(fout, cloud)
+        _save_cloud(cloud, "lidar_%s/%04d" % (name, frame_idx), output_zip, quantize)
         cloud_ri2 = np.hstack((points_ri2[i], channels_ri2[i]))
-        with output_zip.open("lidar_%s_ri2/%04d.npy" % (name, frame_idx), "w") as fout:
-            np.save(fout, cloud_ri2)
+        _save_cloud(cloud_ri2, "lidar_%s_ri2/%04d" % (name, frame_idx), output_zip, quantize)
 
 def save_labels(frame, frame_idx, output_zip):
     # labels in lidar frame
@@ -231,7 +237,7 @@ def save_labels(frame, frame_idx, output_zip):
 
     # no_label_zones are ignored
 
-def convert_tfrecord(ntqdm, input_file, output_path, delele_input=True):
+def convert_tfrecord(ntqdm, input_file, output_path, delele_input=True, compression=None, quantize=False):
     dataset = tf.data.TFRecordDataset(input_file, compression_type='')
     archive = None
 
@@ -247,14 +253,14 @@ def convert_tfrecord(ntqdm, input_file, output_path, delele_input=True):
         if archive is None:
             if not os.path.exists(output_path):
                 os.makedirs(output_path)
-            archive = zipfile.ZipFile(os.path.join(output_path, frame.context.name + ".zip"), "w")
+            archive = ZipWriter(os.path.join(output_path, frame.context.name + ".zip"), compression=compression)
 
         save_timestamp(frame, idx, archive)
         save_image(frame, idx, archive)
-        save_point_cloud(frame, idx, archive)
+        save_point_cloud(frame, idx, archive, quantize=quantize)
         save_labels(frame, idx, archive)
         save_pose(frame, idx, archive)
-    save_context(frame, idx, archive) # save metadata at last
+    save_context(frame, idx, archive, quantize=quantize) # save metadata at last
 
     if archive is not None:
         archive.close()
@@ -263,7 +269,7 @@ def convert_tfrecord(ntqdm, input_file, output_path, delele_input=True):
 
     return idx
 
-def convert_dataset_inpath(input_path, output_path, nworkers=8, debug=False):
+def convert_dataset_inpath(input_path, output_path, nworkers=8, debug=False, compression=None, quantize=False):
     pool = NumberPool(processes=nworkers, offset=1)
     temp_dir = tempfile.mkdtemp()
     total_records = 0
@@ -282,7 +288,8 @@ def convert_dataset_inpath(input_path, output_path, nworkers=8, debug=False):
 
                 tarf.extract(member, temp_dir)
                 pool.apply_async(convert_tfrecord,
-                    (os.path.join(temp_dir, member.name), os.path.join(output_path, phase))
+                    (os.path.join(temp_dir, member.name), os.path.join(output_path, phase),
+                     True, compression, quantize)
                 )
                 total_records += 1
 
@@ -315,12 +322,20 @@ def main():
         help="Number of parallet workers to convert tfrecord")
     parser.add_argument('-u', '--unzip', action="store_true",
         help="Convert the result into directory rather than zip files")
+    parser.add_argument('-c', '--compression', type=str, default=None,
+        help="Compression method for each modality, e.g. \"lidar=deflated,label=lzma\". "
+             "Valid modalities are lidar, camera, radar, label and meta, valid methods are "
+             "stored, deflated, bzip2 and lzma. Data is stored without compression by default.")
+    parser.add_argument('-q', '--quantize-lidar', dest="quantize", action="store_true",
+        help="Store lidar point clouds as quantized arrays (1cm position resolution, 8-bit channels)")
     args = parser.parse_args()
 
     if args.unzip: # XXX: implement this
         raise NotImplementedError("Converting into directories is not implemented")
 
-    convert_dataset_inpath(args.input, args.output or args.input, nworkers=args.workers, debug=args.debug)
+    ZipWriter.parse_compression(args.compression) # check the argument before conversion
+    convert_dataset_inpath(args.input, args.output or args.input,
+        nworkers=args.workers, debug=args.debug, compression=args.compression, quantize=args.quantize)
 
 if __name__ == "__main__":
     main()
@@ -6,12 +6,12 @@ import os.path as osp
 import shutil
 import subprocess
 import tempfile
-import zipfile
 import tarfile
 from pathlib import Path
 from collections import OrderedDict
 from enum import Enum
 from io import BytesIO
+from multiprocessing import Pool
 
 import numpy as np
 from addict import Dict as edict
@@ -20,7 +20,8 @@ from scipy.spatial.transform import Rotation
 
 from d3d.abstraction import (ObjectTag, ObjectTarget3D, ObjectTarget3DArray,
                              TransformSet)
-from d3d.dataset.base import DetectionDatasetBase, ZipCache, _check_frames
+from d3d.dataset.base import (ArchiveIndex, DetectionDatasetBase, ScenePoses,
+                              _check_frames, dequantize_cloud)
 
 _logger = logging.getLogger("d3d")
 
@@ -62,30 +63,11 @@ class WaymoObjectLoader(DetectionDatasetBase):
         self.base_path = Path(base_path) / phase
         self.phase = phase
         self._load_metadata()
-
-        self._zip_cache = ZipCache()
+        self._poses = {} # context name -> ScenePoses, loaded on first access
 
     def _load_metadata(self):
-        meta_path = self.base_path / "metadata.json"
-        if not meta_path.exists():
-            _logger.info("Creating metadata of Waymo dataset (%s)...", self.phase)
-            metadata = {}
-
-            for archive in self.base_path.iterdir():
-                if archive.is_dir() or archive.suffix != ".zip":
-                    continue
-
-                with zipfile.ZipFile(archive) as ar:
-                    with ar.open("context/stats.json") as fin:
-                        metadata[archive.stem] = json.loads(fin.read().decode())
-            with open(meta_path, "w") as fout:
-                json.dump(metadata, fout)
-
-        with open(meta_path) as fin:
-            self._metadata = OrderedDict()
-            meta_json = json.load(fin)
-            for k, v in meta_json.items():
-                self._metadata[k] = edict(v)
+        self._index = ArchiveIndex(self.base_path, "context/stats.json")
+        self._metadata = OrderedDict((k, edict(v)) for k, v in self._index.stats.items())
 
     def __len__(self):
         return sum(v.frame_count for v in self._metadata.values())
@@ -99,24 +81,37 @@ class WaymoObjectLoader(DetectionDatasetBase):
 
     def _locate_file(self, idx, folders, suffix):
         fname, fidx = self._locate_frame(idx)
-        ar = self._zip_cache.open(self.base_path / (fname + ".zip"))
         if isinstance(folders, list):
-            return [ar.open("%s/%04d.%s" % (f, fidx, suffix)) for f in folders]
+            return [self._index.open(fname, "%s/%04d.%s" % (f, fidx, suffix)) for f in folders]
         else:
-            return ar.open("%s/%04d.%s" % (folders, fidx, suffix))
+            return self._index.open(fname, "%s/%04d.%s" % (folders, fidx, suffix))
 
-    def lidar_data(self, idx, names=None, concat=False):
+    def lidar_data(self, idx, names=None, concat=False, dequantize=True):
         """
         :param names: frame names of lidar to be loaded
         :param concat: concatenate the points together. If concatenated, point cloud will be in vehicle frame (FLU)
+        :param dequantize: If the point clouds are stored quantized and this flag is set to False, the raw
+            quantized arrays (see d3d.dataset.base.quantize_cloud) will be returned in vehicle frame
 
         XXX: support return ri2 data
         """
         unpack_result, names = _check_frames(names, self.VALID_LIDAR_NAMES)
 
-        handles = self._locate_file(idx, names, "npy")
-        outputs = [np.load(BytesIO(h.read())) for h in handles]
-        map(lambda h: h.close(), handles)
+        fname, _ = self._locate_frame(idx)
+        if self._metadata[fname].get("lidar_format", "raw") == "quantized":
+            handles = self._locate_file(idx, names, "npz")
+            outputs = [edict(dict(np.load(BytesIO(h.read())))) for h in handles]
+            map(lambda h: h.close(), handles)
+
+            if not dequantize:
+                if concat:
+                    raise ValueError("Quantized point clouds cannot be concatenated")
+                return outputs[0] if unpack_result else outputs
+            outputs = [dequantize_cloud(data) for data in outputs]
+        else:
+            handles = self._locate_file(idx, names, "npy")
+            outputs = [np.load(BytesIO(h.read())) for h in handles]
+            map(lambda h: h.close(), handles)
 
         if concat:
             outputs = np.vstack(outputs)
@@ -163,6 +158,10 @@ class WaymoObjectLoader(DetectionDatasetBase):
             return outputs
 
     def lidar_objects(self, idx):
+        cached = self._cached_objects(idx, lambda value: ObjectTag(value, WaymoObjectClass))
+        if cached is not None:
+            return cached
+
         labels = self.lidar_label(idx)
         outputs = ObjectTarget3DArray(frame="vehicle") # or frame=None
 
@@ -181,10 +180,9 @@ class WaymoObjectLoader(DetectionDatasetBase):
     def calibration_data(self, idx):
         fname, _ = self._locate_frame(idx)
         calib_params = TransformSet("vehicle")
-        ar = self._zip_cache.open(self.base_path / (fname + ".zip"))
 
         # load camera calibration
-        with ar.open("context/calib_cams.json") as fin:
+        with self._index.open(fname, "context/calib_cams.json") as fin:
             calib_cams = json.loads(fin.read().decode())
             for frame, calib in calib_cams.items():
                 frame = "camera_" + frame
@@ -195,7 +193,7 @@ class WaymoObjectLoader(DetectionDatasetBase):
                 calib_params.set_extrinsic(transform, frame_from=frame)
 
         # load lidar calibration
-        with ar.open("context/calib_lidars.json") as fin:
+        with self._index.open(fname, "context/calib_lidars.json") as fin:
             calib_lidars = json.loads(fin.read().decode())
             for frame, calib in calib_lidars.items():
                 frame = "lidar_" + frame
@@ -209,51 +207,128 @@ class WaymoObjectLoader(DetectionDatasetBase):
         fname, fidx = self._locate_frame(idx)
         return self.phase, fname, fidx
 
+    def _load_scene_poses(self, context):
+        if context not in self._poses:
+            count = self._metadata[context].frame_count
+            timestamps = np.empty(count, dtype=np.int64)
+            transforms = np.empty((count, 4, 4))
+            for fidx in range(count):
+                with self._index.open(context, "timestamp/%04d.txt" % fidx) as fin:
+                    timestamps[fidx] = int(fin.read().decode())
+                with self._index.open(context, "pose/%04d.npy" % fidx) as fin:
+                    transforms[fidx] = np.load(BytesIO(fin.read()))
+            rotations = Rotation.from_matrix(transforms[:, :3, :3])
+            self._poses[context] = ScenePoses(timestamps, rotations, transforms[:, :3, 3])
+        return self._poses[context]
+
+    def scene_poses(self, idx):
+        """
+        Return the timestamps and poses of all frames in the sequence containing the frame.
+        See d3d.dataset.base.ScenePoses for the supported queries, the frame indices there are within the sequence.
+        """
+        fname, _ = self._locate_frame(idx)
+        return self._load_scene_poses(fname)
+
     def timestamp(self, idx):
-        with self._locate_file(idx, "timestamp", "txt") as fin:
-            return int(fin.read().decode())
+        fname, fidx = self._locate_frame(idx)
+        return int(self._load_scene_poses(fname).timestamps[fidx])
+
+    def pose(self, idx):
+        """
+        Return (rotation, translation) of the vehicle in the global frame
+        """
+        fname, fidx = self._locate_frame(idx)
+        return self._load_scene_poses(fname).pose(fidx)
 
-def dump_detection_output(detections: ObjectTarget3DArray, context: str, timestamp: int):
+def _detection_columns(detections):
     '''
-    :param detections: detection result
-    :param ids: auxiliary information for output, each item contains context name and timestamp
+    Convert detections into columnar arrays (position, dimension, yaw, label, score). Dicts of these arrays are
+    returned as is.
+    '''
+    if isinstance(detections, dict):
+        return detections
+    if len(detections) == 0:
+        return dict(position=np.empty((0, 3)), dimension=np.empty((0, 3)), yaw=np.empty(0),
+            label=np.empty(0, dtype=int), score=np.empty(0))
+
+    orientations = Rotation.from_quat([target.orientation.as_quat() for target in detections])
+    return dict(
+        position=np.array([target.position for target in detections]),
+        dimension=np.array([target.dimension for target in detections]),
+        yaw=orientations.as_euler("ZYX")[:, 0],
+        label=np.array([target.tag_top.value for target in detections]),
+        score=np.array([target.tag.scores[0] for target in detections])
+    )
+
+def dump_detection_output(detections, context: str, timestamp: int):
+    '''
+    :param detections: detection result, ObjectTarget3DArray or dict of columnar arrays with keys position,
+        dimension, yaw, label (values of WaymoObjectClass) and score
+    :param context: context name of the frame
+    :param timestamp: timestamp of the frame in microseconds
     '''
     from waymo_open_dataset import label_pb2
     from waymo_open_dataset.protos import metrics_pb2
 
-    label_map = {
-        WaymoObjectClass.Unknown: label_pb2.Label.TYPE_UNKNOWN,
-        WaymoObjectClass.Vehicle: label_pb2.Label.TYPE_VEHICLE,
-        WaymoObjectClass.Pedestrian: label_pb2.Label.TYPE_PEDESTRIAN,
-        WaymoObjectClass.Sign: label_pb2.Label.TYPE_SIGN,
-        WaymoObjectClass.Cyclist: label_pb2.Label.TYPE_CYCLIST
-    }
-
+    # WaymoObjectClass shares values with label_pb2.Label.Type
+    columns = _detection_columns(detections)
     waymo_array = metrics_pb2.Objects()
-    for target in detections:
-        waymo_target = metrics_pb2.Object()
-
-        # convert box parameters
-        box = label_pb2.Label.Box()
-        box.center_x = target.position[0]
-        box.center_y = target.position[1]
-        box.center_z = target.position[2]
-        box.length = target.dimension[0]
-        box.width = target.dimension[1]
-        box.height = target.dimension[2]
-        box.heading = target.yaw
-        waymo_target.object.box.CopyFrom(box)
-
-        # convert label
-        waymo_target.object.type = label_map[target.tag_top]
-        waymo_target.score = target.tag.scores[0]
-
-        waymo_target.context_name = context
-        waymo_target.frame_timestamp_micros = timestamp
-        waymo_array.objects.append(waymo_target)
+    for (x, y, z), (l, w, h), yaw, label, score in zip(np.asarray(columns['position']).tolist(),
+        np.asarray(columns['dimension']).tolist(), np.asarray(columns['yaw']).tolist(),
+        np.asarray(columns['label']).tolist(), np.asarray(columns['score']).tolist()):
+
+        box = label_pb2.Label.Box(center_x=x, center_y=y, center_z=z, length=l, width=w, height=h, heading=yaw)
+        waymo_array.objects.add(object=label_pb2.Label(box=box, type=label), score=score,
+            context_name=context, frame_timestamp_micros=timestamp)
 
     return waymo_array
 
+def _write_shard(path, frames):
+    # serialized Objects can be concatenated, which is the same as merging them
+    with open(path, "wb") as fout:
+        for detections, context, timestamp in frames:
+            fout.write(dump_detection_output(detections, context, timestamp).SerializeToString())
+    return path
+
+def dump_detection_shards(frames, output_path, nworkers=8, shard_size=1024):
+    '''
+    Convert the detections of many frames into binary protobuf files (metrics_pb2.Objects) in a process pool.
+    Frames are streamed into shards with about shard_size objects, and only a limited number of shards are
+    pending at the same time, so that the whole submission is never kept in memory.
+
+    :param frames: iterable of (detections, context name, timestamp), see dump_detection_output
+    :param output_path: output directory of the shards
+    :param nworkers: number of worker processes
+    :param shard_size: minimum number of objects in a shard (except the last one)
+    :return: list of paths to the shards
+    '''
+    if not osp.exists(output_path):
+        os.makedirs(output_path)
+
+    shards, pending = [], []
+    with Pool(nworkers) as pool:
+        def submit(chunk):
+            path = osp.join(output_path, "%05x.bin" % len(shards))
+            pending.append(pool.apply_async(_write_shard, (path, chunk)))
+            shards.append(path)
+            if len(pending) > 2 * nworkers: # wait for the workers to catch up
+                pending.pop(0).get()
+
+        chunk, count = [], 0
+        for detections, context, timestamp in frames:
+            detections = _detection_columns(detections)
+            chunk.append((detections, context, timestamp))
+            count += len(detections['score'])
+            if count >= shard_size:
+                submit(chunk)
+                chunk, count = [], 0
+        if chunk:
+            submit(chunk)
+
+        for result in pending:
+            result.get()
+    return shards
+
 def execute_official_evaluator(exec_path, label_path, result_path, output_path, model_name=None, show_output=True):
     '''
     Execute compute_detection_metrics_main from waymo_open_dataset
@@ -261,48 +336,42 @@ def execute_official_evaluator(exec_path, label_path, result_path, output_path,
     '''
     raise NotImplementedError()
 
-def create_submission(exec_path, result_path, output_path, meta_path, model_name=None):
+def create_submission(exec_path, result_path, output_path, meta_path, model_name=None, shard_bytes=1 << 26):
     '''
     Execute create_submission from waymo_open_dataset
     :param exec_path: path to create_submission
-    :param result_path: path (or list of path) to detection result in binary protobuf
+    :param result_path: path (or list of path) to directories of detection results in binary protobuf, e.g. created
+        by dump_detection_shards or files from dump_detection_output
     :param meta_path: path to the metadata file (example: waymo_open_dataset/metrics/tools/submission.txtpb)
     :param output_path: output path for the created submission archive
+    :param shard_bytes: results are combined into input files of about this size
     '''
     temp_path = tempfile.mkdtemp() + '/'
     model_name = model_name or "noname"
     cwd_path = temp_path + 'input' # change input directory
     os.mkdir(cwd_path)
 
-    # combine single results
+    # combine single results. Serialized Objects are concatenated into shards, which is the same as merging
+    # them, so the results are streamed without parsing
     if isinstance(result_path, str):
         result_path = [result_path]
     else:
         assert isinstance(result_path, (list, tuple))
-    input_files, counter = [], 0
     print("Combining outputs into %s..." % temp_path)
+    counter, fout = 0, None
     for rpath in result_path:
-        from waymo_open_dataset.protos.metrics_pb2 import Objects
-        
-        # merge objects
-        combined_objects = Objects()
-        for f in os.listdir(rpath):
-            with open(osp.join(rpath, f), "rb") as fin:
-                objects = Objects()
-                objects.ParseFromString(fin.read())
-                combined_objects.MergeFrom(objects)
-            
-            if len(combined_objects.objects) > 1024: # create binary file every 1024 objects
-                with open(osp.join(cwd_path, "%x.bin" % counter), "wb") as fout:
-                    fout.write(combined_objects.SerializeToString())
-                combined_objects = Objects()
+        for f in sorted(os.listdir(rpath)):
+            if fout is None:
+                fout = open(osp.join(cwd_path, "%x.bin" % counter), "wb")
                 counter += 1
-
-    # write remaining objects
-    if len(combined_objects.objects) > 0:
-        with open(osp.join(cwd_path, "%x.bin" % counter), "wb") as fout:
-            fout.write(combined_objects.SerializeToString())
-    input_files = ','.join(os.listdir(cwd_path))
+            with open(osp.join(rpath, f), "rb") as fin:
+                shutil.copyfileobj(fin, fout)
+            if fout.tell() >= shard_bytes:
+                fout.close()
+                fout = None
+    if fout is not None:
+        fout.close()
+    input_files = ','.join(sorted(os.listdir(cwd_path)))
 
     # create submissions
     print("Creating submission...")
@@ -315,8 +384,7 @@ def create_submission(exec_path, result_path, output_path, meta_path, model_name
 
     # create tarball
     print("Clean up...")
-    if cwd_path != result_path: # remove combined files before zipping
-        shutil.rmtree(cwd_path)
+    shutil.rmtree(cwd_path) # remove combined files before zipping
     if not os.path.exists(output_path):
         os.makedirs(output_path)
     with tarfile.open(osp.join(output_path, model_name + ".tgz"), "w:gz") as tar:
@@ -1,20 +1,37 @@
-import gc
+import collections
+import functools
+import inspect
+import json
 import os
+import sys
+import threading
 import time
+import tracemalloc
 import weakref
 import logging
+import multiprocessing
 
+import numpy as np
 import torch
+from addict import Dict as edict
 
-_timers = {}
 _logger = logging.getLogger('d3d.profiler')
+
+def _synchronize():
+    '''
+    Wait for the CUDA kernels so that their time is counted, it's skipped if CUDA is not used in the process
+    '''
+    if torch.cuda.is_available() and torch.cuda.is_initialized():
+        torch.cuda.synchronize()
+
+_timers = {}
 def tap_time(name, clear=True, report=True):
     '''
     This function start a timer with certain name. The second call of this function with
     same name will stop the timer and report the time.
     '''
 
-    torch.cuda.synchronize()
+    _synchronize()
     if name not in _timers:
         _timers[name] = time.time()
         return 0
@@ -26,42 +43,456 @@ def tap_time(name, clear=True, report=True):
             _logger.debug("Elapsed time for %s: %.4f", name, elapse)
         return elapse
 
-class TensorRef:
-    def __init__(self, tensor):
-        self._ref = weakref.ref(tensor)
-        self._summary = f"<Tensor, type={type(tensor).__name__}, shape={list(tensor.shape)}, device={tensor.device}>"
-    def __hash__(self):
-        return hash(self._ref)
-    def __eq__(self, other):
-        return self._ref() is other
+# ========== Hierarchical profiler ==========
+
+_enabled = False
+_synchronized = True
+_durations = {} # scope path -> list of elapsed times
+_durations_lock = threading.Lock()
+_local = threading.local() # stack of (path, start time) of the active scopes in each thread
+_spans = None # ring buffer of (path, start, elapsed, pid, tid) if tracing
+_pid = os.getpid()
+
+def _after_fork():
+    # spans of the parent process are not exported again by the child
+    global _pid
+    _pid = os.getpid()
+    if _spans is not None:
+        _spans.clear()
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_after_fork)
+
+def enable(synchronize=True, trace=False, trace_capacity=1 << 20):
+    '''
+    Enable the profiler. Scopes and instrumented functions do nothing but calling the function when it's disabled.
+
+    :param synchronize: synchronize CUDA at the boundaries of scopes (only if CUDA is used), so that the
+        time of the asynchronous kernels is counted in the scope launching them
+    :param trace: record the spans of the scopes, see trace_events and save_trace
+    :param trace_capacity: max number of spans kept in the buffer, the oldest spans are dropped when it's full
+    '''
+    global _enabled, _synchronized, _spans
+    _enabled = True
+    _synchronized = synchronize
+    if trace:
+        if _spans is None or _spans.maxlen != trace_capacity:
+            _spans = collections.deque(_spans or (), maxlen=trace_capacity)
+    else:
+        _spans = None
+
+def disable():
+    global _enabled
+    _enabled = False
+
+def is_enabled():
+    return _enabled
+
+def reset():
+    '''
+    Clear the recorded statistics
+    '''
+    with _durations_lock:
+        _durations.clear()
+    if _spans is not None:
+        _spans.clear()
+
+def _stack():
+    stack = getattr(_local, "stack", None)
+    if stack is None:
+        stack = _local.stack = []
+    return stack
+
+class scope:
+    '''
+    Context manager (or decorator) that records the time of a named scope. Scopes can be nested, and the
+    statistics are recorded by the path of the scope, e.g. "train/forward/nms". The state of each entry is kept
+    in the thread, so a scope object can be entered recursively or from several threads.
+    '''
+    def __init__(self, name):
+        self.name = name
+
+    def __enter__(self):
+        stack = _stack()
+        parent = stack[-1][0] if stack else None
+        if not _enabled:
+            stack.append((parent, None)) # not recorded, the children are attached to the parent
+            return self
+
+        path = parent + "/" + self.name if parent else self.name
+        if _synchronized:
+            _synchronize()
+        stack.append((path, time.perf_counter()))
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        path, start = _stack().pop()
+        if start is None:
+            return
+        if _synchronized:
+            _synchronize()
+        elapsed = time.perf_counter() - start
+        with _durations_lock:
+            _durations.setdefault(path, []).append(elapsed)
+        if _spans is not None:
+            _spans.append((path, start, elapsed, _pid, threading.get_ident()))
+
+    def __call__(self, func):
+        return profile(self.name)(func)
+
+def profile(name=None):
+    '''
+    Decorator that records the time of the function calls in a scope, the qualified name of the function is
+    used as the scope name by default
+    '''
+    def decorator(func):
+        scope_name = name or func.__qualname__
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if not _enabled:
+                return func(*args, **kwargs)
+            with scope(scope_name):
+                return func(*args, **kwargs)
+        wrapper._d3d_profiled = True
+        return wrapper
+    return decorator
+
+def _instrument_class(cls, prefix):
+    for attr, value in list(vars(cls).items()):
+        if (attr.startswith("_") and attr != "__call__") or not inspect.isfunction(value):
+            continue
+        if getattr(value, "_d3d_profiled", False):
+            continue
+        setattr(cls, attr, profile(prefix + attr)(value))
+
+def instrument(target, prefix=None):
+    '''
+    Record the time of the public functions of a module or the public methods of a class in place. For
+    a module, the public classes defined in it are also instrumented. Note that references imported before
+    the instrumentation (e.g. by `from d3d.box import box2d_iou`) are not affected.
+
+    :param prefix: prefix of the scope names, by default the name of the module or class is used
+    '''
+    if inspect.isclass(target):
+        for cls in target.__mro__[::-1]: # inherited methods are instrumented in their own classes
+            if cls.__module__.startswith("d3d.") or cls is target:
+                _instrument_class(cls, (prefix or cls.__name__) + ".")
+    elif inspect.ismodule(target):
+        prefix = (prefix or target.__name__) + "."
+        for attr, value in list(vars(target).items()):
+            if attr.startswith("_") or getattr(value, "__module__", None) != target.__name__:
+                continue
+            if inspect.isclass(value):
+                _instrument_class(value, prefix + attr + ".")
+            elif inspect.isfunction(value) and not getattr(value, "_d3d_profiled", False):
+                setattr(target, attr, profile(prefix + attr)(value))
+    else:
+        raise ValueError("Only modules and classes can be instrumented!")
+
+def instrument_defaults():
+    '''
+    Instrument the dataset loaders and the entry points of the compiled operators
+    '''
+    import d3d.box
+    import d3d.math
+    import d3d.point
+    import d3d.voxel
+    from d3d.dataset.kitti.object import KittiObjectLoader
+    from d3d.dataset.nuscenes.loader import NuscenesObjectLoader
+    from d3d.dataset.waymo.loader import WaymoObjectLoader
+
+    for target in [d3d.box, d3d.math, d3d.point, d3d.voxel, KittiObjectLoader, NuscenesObjectLoader, WaymoObjectLoader]:
+        instrument(target)
+
+def statistics():
+    '''
+    Return the statistics of the recorded scopes, in dictionary of scope path -> (count, total, mean, p50, p90,
+    p99, max). The time is in seconds
+    '''
+    with _durations_lock:
+        durations = {path: np.array(values) for path, values in _durations.items()}
+
+    result = {}
+    for path in sorted(durations, key=lambda path: path.split("/")): # children follow their parents
+        values = durations[path]
+        p50, p90, p99 = np.percentile(values, [50, 90, 99])
+        result[path] = edict(count=len(values), total=values.sum(), mean=values.mean(),
+            p50=p50, p90=p90, p99=p99, max=values.max())
+    return result
+
+def report():
+    '''
+    Print the statistics of the recorded scopes as a table (into returned string), the time is in milliseconds
+    '''
+    lines = ["%-48s %8s %10s %9s %9s %9s %9s %9s" % ("Scope", "Count", "Total", "Mean", "P50", "P90", "P99", "Max")]
+    for path, stats in statistics().items():
+        name = "  " * path.count("/") + path.rsplit("/", 1)[-1] # indent by the depth
+        lines.append("%-48s %8d %10.1f %9.3f %9.3f %9.3f %9.3f %9.3f" % (name, stats.count, stats.total * 1e3,
+            stats.mean * 1e3, stats.p50 * 1e3, stats.p90 * 1e3, stats.p99 * 1e3, stats.max * 1e3))
+    return "\n".join(lines)
+
+def trace_events():
+    '''
+    Return the recorded spans of this process in Trace Event format (complete events with time in microseconds)
+    '''
+    if _spans is None:
+        return []
+
+    thread_names = {thread.ident: thread.name for thread in threading.enumerate()}
+    events, threads = [], set()
+    for path, start, elapsed, pid, tid in list(_spans):
+        events.append(dict(name=path.rsplit("/", 1)[-1], cat="d3d", ph="X", ts=start * 1e6, dur=elapsed * 1e6,
+            pid=pid, tid=tid, args=dict(path=path)))
+        threads.add((pid, tid))
+
+    # metadata for readable names in the viewer
+    events.append(dict(name="process_name", ph="M", pid=_pid, tid=0,
+        args=dict(name="%s (%d)" % (multiprocessing.current_process().name, _pid))))
+    for pid, tid in threads:
+        if tid in thread_names:
+            events.append(dict(name="thread_name", ph="M", pid=pid, tid=tid, args=dict(name=thread_names[tid])))
+    return events
+
+def save_trace(path, events=None):
+    '''
+    Save the spans as a JSON trace file, which can be viewed in chrome://tracing or https://ui.perfetto.dev.
+    The timestamps are from a monotonic clock, so traces saved by different processes can be merged with
+    merge_traces (e.g. each worker saves its own trace before exiting).
+
+    :param events: events to save, the spans recorded in this process by default
+    '''
+    with open(path, "w") as fout:
+        json.dump(dict(traceEvents=trace_events() if events is None else events, displayTimeUnit="ms"), fout)
+
+def merge_traces(paths, output_path):
+    '''
+    Merge trace files saved by save_trace into one file
+    '''
+    events = []
+    for path in paths:
+        with open(path) as fin:
+            events.extend(json.load(fin)["traceEvents"])
+    save_trace(output_path, events)
+
+# ========== Memory tracker ==========
+
+try:
+    from torch.utils._python_dispatch import TorchDispatchMode
+    from torch.utils._pytree import tree_flatten
+except ImportError: # tensors are not tracked with old versions of pytorch
+    TorchDispatchMode = None
+
+_torch_path = os.path.dirname(torch.__file__)
+
+def _creation_site():
+    '''Return the location of the first caller frame outside pytorch and this module'''
+    frame = sys._getframe(2)
+    while frame is not None and (frame.f_code.co_filename.startswith(_torch_path) or
+        frame.f_code.co_filename == __file__):
+        frame = frame.f_back
+    if frame is None:
+        return "<unknown>"
+    return "%s:%d" % (frame.f_code.co_filename, frame.f_lineno)
+
+class _TensorRecord:
+    __slots__ = ("seq", "shape", "dtype", "device", "nbytes", "site", "ref")
+
     def __str__(self):
-        return self._summary
-    def released(self):
-        return self._ref() is None
+        return f"<Tensor, shape={list(self.shape)}, dtype={self.dtype}, device={self.device}, site={self.site}>"
+
+if TorchDispatchMode is not None:
+    class _AllocationMode(TorchDispatchMode):
+        '''Record the tensors returned by the operators, outputs of in-place and view operators are skipped'''
+        def __init__(self, tracker):
+            super().__init__()
+            self.tracker = tracker
+
+        def __torch_dispatch__(self, func, types, args=(), kwargs=None):
+            outputs = func(*args, **(kwargs or {}))
+            # tensor._is_view() is not set yet at this level, so aliasing outputs are found from the schema
+            if not func._schema.is_mutable and not any(ret.alias_info for ret in func._schema.returns):
+                for tensor in tree_flatten(outputs)[0]:
+                    if isinstance(tensor, torch.Tensor):
+                        self.tracker._record(tensor)
+            return outputs
 
-_tensors = set()
-def tap_tensors(report=False):
+def _group_records(records):
+    groups = {}
+    for record in records:
+        key = (tuple(record.shape), record.dtype, record.device, record.site)
+        group = groups.get(key)
+        if group is None:
+            group = groups[key] = edict(shape=key[0], dtype=key[1], device=key[2], site=key[3], count=0, nbytes=0)
+        group.count += 1
+        group.nbytes += record.nbytes
+    return sorted(groups.values(), key=lambda g: g.nbytes, reverse=True)
+
+class MemoryTracker:
     '''
-    Used for memory leak debugging
+    Track the memory growth between stages without scanning the heap. Tensors are recorded when they are
+    created by pytorch operators (in the thread that starts the tracker) and dropped by weak reference
+    callbacks when released. Python allocations are compared with tracemalloc snapshots, and the CUDA
+    allocator statistics are reported if CUDA is used.
+
+    Example:
+        tracker = MemoryTracker()
+        with tracker:
+            ...
+            print(tracker.summary(tracker.tap("forward")))
     '''
-    tensor_new = [obj for obj in gc.get_objects() if torch.is_tensor(obj) and obj not in _tensors]
-    tensor_del = [obj for obj in _tensors if obj.released()]
+    def __init__(self, tensors=True, python=True, top=10):
+        '''
+        :param tensors: track the tensors created by pytorch operators (requires pytorch with TorchDispatchMode)
+        :param python: track python allocations with tracemalloc, which slows down the program
+        :param top: number of groups reported in the summary
+        '''
+        if tensors and TorchDispatchMode is None:
+            _logger.warning("Tensors are not tracked since TorchDispatchMode is not supported by pytorch %s",
+                torch.__version__)
+            tensors = False
+        self._track_tensors = tensors
+        self._track_python = python
+        self._top = top
 
-    if report:
-        _logger.debug(f'========== {len(tensor_new)} new tensors, {len(tensor_del)} released tensors ==========')
-
-    if len(tensor_new) > 50:
-        _logger.debug("(Tensor list suppressed)")
-        report = False # prevent list being too long
-        
-    for tensor in tensor_new:
-        ref = TensorRef(tensor)
-        if report:
-            _logger.debug("+" + str(ref))
-        _tensors.add(ref)
-    for ref in tensor_del:
-        if report:
-            _logger.debug("-" + str(ref))
-        _tensors.remove(ref)
+        self._mode = None
+        self._seq = 0
+        self._tap_seq = 0 # last sequence number before the previous tap
+        self._live = {} # seq -> record of alive tensors
+        self._created = [] # records created since last tap
+        self._released = [] # records created before last tap and released since then
+        self._snapshot = None
+        self._stop_tracemalloc = False
+        self._cuda_allocated = 0
+
+    def _record(self, tensor):
+        self._seq += 1
+        record = _TensorRecord()
+        record.seq = self._seq
+        record.shape = tuple(tensor.shape)
+        record.dtype = tensor.dtype
+        record.device = tensor.device
+        record.nbytes = tensor.numel() * tensor.element_size()
+        record.site = _creation_site()
+        record.ref = weakref.ref(tensor, functools.partial(self._release, record.seq))
+        self._live[record.seq] = record
+        self._created.append(record)
+
+    def _release(self, seq, ref):
+        record = self._live.pop(seq, None)
+        if record is not None and record.seq <= self._tap_seq:
+            self._released.append(record)
+
+    def start(self):
+        if self._track_tensors:
+            self._mode = _AllocationMode(self)
+            self._mode.__enter__()
+        if self._track_python:
+            self._stop_tracemalloc = not tracemalloc.is_tracing()
+            if self._stop_tracemalloc:
+                tracemalloc.start()
+            self._snapshot = tracemalloc.take_snapshot().filter_traces([
+                tracemalloc.Filter(False, tracemalloc.__file__), tracemalloc.Filter(False, __file__)])
+        if torch.cuda.is_available() and torch.cuda.is_initialized():
+            self._cuda_allocated = torch.cuda.memory_allocated()
+        return self
+
+    def stop(self):
+        if self._mode is not None:
+            self._mode.__exit__(None, None, None)
+            self._mode = None
+        if self._snapshot is not None:
+            if self._stop_tracemalloc:
+                tracemalloc.stop()
+            self._snapshot = None
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stop()
 
-    return tensor_new, tensor_del
+    def live_tensors(self):
+        '''Return the groups of the tracked tensors that are still alive'''
+        return _group_records(list(self._live.values()))
+
+    def tap(self, stage=None):
+        '''
+        Report the growth since the previous tap (or the start)
+
+        :param stage: name of the stage, only used in the summary
+        :return: tensors created and released (grouped by shape, dtype, device and creation site), python
+            allocation differences of the top lines and CUDA allocator statistics
+        '''
+        result = edict(stage=stage)
+        created = [record for record in self._created if record.seq in self._live]
+        result.tensors_new = _group_records(created)
+        result.tensors_released = _group_records(self._released)
+        self._created, self._released = [], []
+        self._tap_seq = self._seq
+
+        if self._snapshot is not None:
+            # allocations of the tracker itself are excluded
+            snapshot = tracemalloc.take_snapshot().filter_traces([
+                tracemalloc.Filter(False, tracemalloc.__file__), tracemalloc.Filter(False, __file__)])
+            stats = snapshot.compare_to(self._snapshot, "lineno")
+            result.python_diff = sum(stat.size_diff for stat in stats)
+            result.python = [edict(site=str(stat.traceback), size_diff=stat.size_diff, count_diff=stat.count_diff)
+                for stat in stats[:self._top] if stat.size_diff != 0]
+            self._snapshot = snapshot
+
+        if torch.cuda.is_available() and torch.cuda.is_initialized():
+            allocated = torch.cuda.memory_allocated()
+            result.cuda = edict(allocated=allocated, allocated_diff=allocated - self._cuda_allocated,
+                reserved=torch.cuda.memory_reserved(), peak=torch.cuda.max_memory_allocated())
+            self._cuda_allocated = allocated
+        return result
+
+    def summary(self, result):
+        '''
+        Print the result of tap (into returned string)
+        '''
+        lines = ["========== Memory growth%s ==========" % (" of " + result.stage if result.stage else "")]
+        for title, groups, sign in [("New tensors", result.tensors_new, "+"),
+                                    ("Released tensors", result.tensors_released, "-")]:
+            lines.append("%s: %d tensors, %.2f MB" % (title, sum(g.count for g in groups),
+                sum(g.nbytes for g in groups) / 2**20))
+            for g in groups[:self._top]:
+                lines.append("\t%s%d x %s %s on %s (%.2f MB) at %s" % (sign, g.count, list(g.shape),
+                    str(g.dtype).replace("torch.", ""), g.device, g.nbytes / 2**20, g.site))
+        if "python" in result:
+            lines.append("Python allocations: %+.2f MB" % (result.python_diff / 2**20))
+            for stat in result.python:
+                lines.append("\t%+.2f MB (%+d blocks) at %s" % (stat.size_diff / 2**20, stat.count_diff, stat.site))
+        if "cuda" in result:
+            lines.append("CUDA allocated: %.2f MB (%+.2f MB), reserved: %.2f MB, peak: %.2f MB" % (
+                result.cuda.allocated / 2**20, result.cuda.allocated_diff / 2**20,
+                result.cuda.reserved / 2**20, result.cuda.peak / 2**20))
+        return "\n".join(lines)
+
+_tracker = None
+def tap_tensors(report=False, stop=False):
+    '''
+    Used for memory leak debugging. The first call starts tracking tensors created in the current thread,
+    each following call returns the groups of tensors created and released since the previous call.
+    See MemoryTracker for more options
+
+    :param report: log the summary of the growth
+    :param stop: stop tracking after this call, the next call starts tracking again. It should be called
+        in the thread that started the tracking
+    :return: (created, released) lists of tensor groups, each group is a dict with shape, dtype, device,
+        site (creation site), count and nbytes, sorted by nbytes in descending order. Both lists are empty
+        for the call that starts the tracking
+    '''
+    global _tracker
+    if _tracker is None:
+        if not stop:
+            _tracker = MemoryTracker(python=False).start()
+        return [], []
+
+    result = _tracker.tap()
+    if report:
+        _logger.debug(_tracker.summary(result))
+    if stop:
+        _tracker.stop()
+        _tracker = None
+    return result.tensors_new, result.tensors_released
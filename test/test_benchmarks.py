@@ -0,0 +1,291 @@
+import unittest
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import scipy.stats as sps
+from scipy.spatial.transform import Rotation
+
+from d3d.abstraction import ObjectTag, ObjectTarget3D, ObjectTarget3DArray
+from d3d.benchmarks import (BenchmarkStats, KittiObjectBenchmark, ObjectBenchmark, _gaussian_logpdf,
+                            _vonmises_logpdf, get_stats_parallel)
+from d3d.box import box2d_from_flu, box2d_iou
+from d3d.dataset.kitti.object import KittiObjectClass, label_columns
+
+def make_target(x, y, yaw, label=KittiObjectClass.Car, score=1, dimension=(4, 1, 1.5)):
+    return ObjectTarget3D([x, y, 0], Rotation.from_euler("z", yaw), dimension,
+        ObjectTag(label, KittiObjectClass, score))
+
+def random_frame(rng, ngt=60, ndt=80, extent=40):
+    # half of the detections are noisy copies of the ground truths, labels include a class not evaluated
+    labels = [KittiObjectClass.Car, KittiObjectClass.Pedestrian, KittiObjectClass.Van]
+    gt_boxes = ObjectTarget3DArray([make_target(*rng.uniform(-extent, extent, 2), rng.uniform(-np.pi, np.pi),
+        label=labels[rng.integers(3)], dimension=rng.uniform([3, 1.5, 1.5], [5, 2.5, 2])) for _ in range(ngt)])
+    dt_boxes = ObjectTarget3DArray()
+    for i in range(ndt):
+        if i < ndt // 2:
+            gt = gt_boxes[rng.integers(ngt)]
+            x, y = gt.position[:2] + rng.normal(0, 0.5, 2)
+            yaw, label, dimension = gt.yaw + rng.normal(0, 0.2), gt.tag_top, gt.dimension
+        else:
+            x, y = rng.uniform(-extent, extent, 2)
+            yaw, label, dimension = rng.uniform(-np.pi, np.pi), labels[rng.integers(3)], (4, 2, 1.5)
+        dt_boxes.append(make_target(x, y, yaw, label=label, score=rng.uniform(0.01, 1), dimension=dimension))
+    return gt_boxes, dt_boxes
+
+def reference_counts(gt_boxes, dt_boxes, classes, assignment, thresholds, gt_valid=None):
+    '''
+    Count the statistics of each class and score threshold from the detection -> ground truth assignment.
+    Ground truths that are not valid are not counted, neither are the detections assigned to them.
+    '''
+    if gt_valid is None:
+        gt_valid = np.ones(len(gt_boxes), dtype=bool)
+    scores = np.array([t.tag_score for t in dt_boxes], dtype=np.float32)
+    dt_loc = np.searchsorted(thresholds, scores, side='left')
+    counts = {name: np.zeros((len(classes), len(thresholds)), dtype=int) for name in ["ndt", "tp", "fp", "fn"]}
+    counts["ngt"] = np.zeros(len(classes), dtype=int)
+    for c, k in enumerate(classes):
+        counts["ngt"][c] = sum(t.tag_top == k and v for t, v in zip(gt_boxes, gt_valid))
+        for i in range(len(thresholds)):
+            counts["tp"][c, i] = sum(dt_boxes[d].tag_top == k and dt_loc[d] > i and gt_valid[g]
+                for d, g in assignment.items())
+            counts["fp"][c, i] = sum(t.tag_top == k and dt_loc[d] > i and d not in assignment
+                for d, t in enumerate(dt_boxes))
+    counts["ndt"] = counts["tp"] + counts["fp"]
+    counts["fn"] = counts["ngt"][:, None] - counts["tp"]
+    return counts
+
+def reference_iou_assignment(gt_boxes, dt_boxes, classes, min_overlap):
+    '''
+    Matching of the original ObjectBenchmark.get_stats: each ground truth (in index order) picks the detection
+    of the same class with the highest score whose IoU is larger than the threshold, and takes it if it's not
+    taken by previous ground truths
+    '''
+    iou = box2d_iou(box2d_from_flu(gt_boxes.to_numpy()[:, :7]), box2d_from_flu(dt_boxes.to_numpy()[:, :7]),
+        method="bev").numpy()
+    order = np.argsort([t.tag_score for t in dt_boxes])[::-1]
+    assignment = {}
+    for g, gt in enumerate(gt_boxes):
+        if gt.tag_top not in classes:
+            continue
+        for d in order:
+            if dt_boxes[d].tag_top == gt.tag_top and iou[g, d] > min_overlap:
+                if d not in assignment:
+                    assignment[d] = g
+                break
+    return assignment
+
+def assert_counts(stats, counts, cell=(0, 0, 0)):
+    for name, values in counts.items():
+        assert np.array_equal(getattr(stats, name)[cell], values), name
+
+def assert_stats_equal(stats1, stats2):
+    assert np.array_equal(stats1.classes, stats2.classes)
+    for name in ["ngt", "ndt", "tp", "fp", "fn"]:
+        assert np.array_equal(getattr(stats1, name), getattr(stats2, name)), name
+    for name in BenchmarkStats.ACCURACIES:
+        assert np.allclose(stats1.acc_sums[name], stats2.acc_sums[name]), name
+
+def kitti_row(label, bbox, x, occlusion=0, alpha=0, score=None):
+    # label, truncation, occlusion, alpha, bbox, dimension (h, w, l), location, rotation_y (and score)
+    row = [label, 0, occlusion, alpha] + list(bbox) + [1.5, 1.6, 3.9, x, 1.7, 20, 0]
+    return row if score is None else row + [score]
+
+class TestObjectBenchmark(unittest.TestCase):
+    def test_iou_yaw_direction(self):
+        # the detection is shifted along the heading of the ground truth, they only overlap if the
+        # yaw angles (counter-clockwise in FLU) are converted correctly for box2d functions
+        gt_boxes = ObjectTarget3DArray([make_target(0, 0, np.pi/4)])
+        dt_boxes = ObjectTarget3DArray([make_target(1, 1, np.pi/4 + 0.1, score=0.9)])
+
+        benchmark = ObjectBenchmark(KittiObjectClass.Car, 0.3)
+        benchmark.add_stats(benchmark.get_stats(gt_boxes, dt_boxes))
+        assert benchmark.tp(0.5)[KittiObjectClass.Car] == 1
+        assert benchmark.fp(0.5)[KittiObjectClass.Car] == 0
+        assert np.isclose(benchmark.acc_iou(0.5)[KittiObjectClass.Car], 0.42205, atol=1e-4)
+
+    def test_distance_matching(self):
+        # compare with the greedy matching of nuScenes: detections are matched from the best score
+        # to the closest unmatched ground truth of the same class within the distance threshold
+        rng = np.random.default_rng(0)
+        classes = [KittiObjectClass.Car, KittiObjectClass.Pedestrian]
+        thresholds = np.linspace(0, 1, 10, endpoint=False, dtype=np.float32)
+        for max_dist in [0.5, 1, 2, 4]:
+            benchmark = ObjectBenchmark(classes, max_dist, pr_sample_count=10, pr_sample_scale="lin",
+                criterion="distance")
+            for _ in range(5):
+                gt_boxes, dt_boxes = random_frame(rng)
+                gt_xy = np.array([t.position[:2] for t in gt_boxes])
+                assignment = {}
+                for d in np.argsort([t.tag_score for t in dt_boxes])[::-1]:
+                    if dt_boxes[d].tag_top not in classes:
+                        continue
+                    dist = np.linalg.norm(gt_xy - dt_boxes[d].position[:2], axis=1)
+                    dist[[t.tag_top != dt_boxes[d].tag_top for t in gt_boxes]] = np.inf
+                    dist[list(assignment.values())] = np.inf
+                    if np.min(dist) < max_dist:
+                        assignment[d] = int(np.argmin(dist))
+
+                stats = benchmark.get_stats(gt_boxes, dt_boxes)
+                assert_counts(stats, reference_counts(gt_boxes, dt_boxes, classes, assignment, thresholds))
+                for c, k in enumerate(classes):
+                    pairs = [(d, g) for d, g in assignment.items() if dt_boxes[d].tag_top == k]
+                    dist = sum(np.linalg.norm(gt_boxes[g].position - dt_boxes[d].position) for d, g in pairs)
+                    assert np.isclose(stats.acc_sums["dist"][0, 0, 0, c, 0], dist)
+
+    def test_logpdf(self):
+        rng = np.random.default_rng(0)
+        x = rng.uniform(0, np.pi, 200)
+        kappa = 10 ** rng.uniform(-3, 3, 200)
+        expected = [sps.vonmises.logpdf(xi, ki) for xi, ki in zip(x, kappa)]
+        assert np.allclose(_vonmises_logpdf(x, kappa), expected)
+
+        mean = rng.normal(size=(50, 3))
+        x = mean + rng.normal(size=(50, 3))
+        sqrt_cov = rng.normal(size=(50, 3, 3))
+        cov = sqrt_cov @ sqrt_cov.transpose(0, 2, 1) + np.eye(3) * 0.1
+        cov[0] = np.diag([1, 0, 1]) # singular covariance gives -inf
+        expected = [sps.multivariate_normal.logpdf(x[i], mean[i], cov[i]) for i in range(1, 50)]
+        logpdf = _gaussian_logpdf(x, mean, cov)
+        assert logpdf[0] == -np.inf
+        assert np.allclose(logpdf[1:], expected)
+
+    def test_stats_merge(self):
+        rng = np.random.default_rng(0)
+        classes = [KittiObjectClass.Car, KittiObjectClass.Pedestrian]
+        benchmark = ObjectBenchmark(classes, [[0.5], [0.3]], distance_ranges=[(0, 20), (20, 100)])
+        frames = [random_frame(rng) for _ in range(4)]
+        stats = [benchmark.get_stats(*frame) for frame in frames]
+
+        restored = BenchmarkStats.from_bytes(stats[0].to_bytes())
+        assert_stats_equal(restored, stats[0])
+
+        total = BenchmarkStats(restored.classes, restored.tp.shape[4], restored.tp.shape[:3])
+        for s in stats:
+            total += s
+            benchmark.add_stats(s)
+        assert_stats_equal(total, benchmark.total_stats())
+        assert_stats_equal(stats[0] + stats[1] + stats[2] + stats[3], total)
+        assert np.array_equal(total.ngt, sum(s.ngt for s in stats))
+
+        with self.assertRaises(ValueError):
+            total += BenchmarkStats(restored.classes, restored.tp.shape[4])
+
+        assert_stats_equal(get_stats_parallel(benchmark, frames, nworkers=2, chunksize=1), total)
+
+    def test_threads(self):
+        # the matching runs without the GIL, frames matched in threads give the same statistics
+        rng = np.random.default_rng(2)
+        classes = [KittiObjectClass.Car, KittiObjectClass.Pedestrian]
+        frames = [random_frame(rng, ngt=200, ndt=300, extent=80) for _ in range(8)]
+        for benchmark in [ObjectBenchmark(classes, [[0.3], [0.5]]),
+            ObjectBenchmark(classes, [[1], [2]], criterion="distance")]:
+            with ThreadPoolExecutor(4) as executor:
+                stats = list(executor.map(lambda frame: benchmark.get_stats(*frame), frames))
+            for frame, s in zip(frames, stats):
+                assert_stats_equal(s, benchmark.get_stats(*frame))
+
+    def test_single_threshold(self):
+        rng = np.random.default_rng(0)
+        classes = [KittiObjectClass.Car, KittiObjectClass.Pedestrian]
+        thresholds = np.linspace(0, 1, 10, endpoint=False, dtype=np.float32)
+        benchmark = ObjectBenchmark(classes, 0.3, pr_sample_count=10, pr_sample_scale="lin")
+        for _ in range(5):
+            gt_boxes, dt_boxes = random_frame(rng)
+            assignment = reference_iou_assignment(gt_boxes, dt_boxes, classes, 0.3)
+            assert len(assignment) > 0
+            stats = benchmark.get_stats(gt_boxes, dt_boxes)
+            assert stats.tp.shape[:3] == (1, 1, 1)
+            assert_counts(stats, reference_counts(gt_boxes, dt_boxes, classes, assignment, thresholds))
+
+    def test_multiple_thresholds(self):
+        # one pass over several thresholds and difficulty levels is the same as evaluating them separately,
+        # ground truths with higher difficulty are ignored together with the detections matched to them
+        rng = np.random.default_rng(1)
+        classes = [KittiObjectClass.Car, KittiObjectClass.Pedestrian]
+        thresholds = np.linspace(0, 1, 10, endpoint=False, dtype=np.float32)
+        overlaps = [0.1, 0.3, 0.5]
+        levels = [0, 1]
+        benchmark = ObjectBenchmark(classes, [[v] for v in overlaps], pr_sample_count=10, pr_sample_scale="lin",
+            difficulty_levels=levels)
+        for _ in range(3):
+            gt_boxes, dt_boxes = random_frame(rng)
+            difficulty = rng.integers(3, size=len(gt_boxes))
+            stats = benchmark.get_stats(gt_boxes, dt_boxes, difficulty)
+            assert stats.tp.shape[:3] == (len(overlaps), 1, len(levels))
+            for t, overlap in enumerate(overlaps):
+                assignment = reference_iou_assignment(gt_boxes, dt_boxes, classes, overlap)
+                for l, level in enumerate(levels):
+                    counts = reference_counts(gt_boxes, dt_boxes, classes, assignment, thresholds,
+                        gt_valid=difficulty <= level)
+                    assert_counts(stats, counts, cell=(t, 0, l))
+
+    def test_summary(self):
+        # the report covers every threshold, distance range and difficulty level
+        rng = np.random.default_rng(3)
+        classes = [KittiObjectClass.Car, KittiObjectClass.Pedestrian]
+        benchmark = ObjectBenchmark(classes, [[0.3], [0.5]], distance_ranges=[(0, 20), (20, 100)],
+            difficulty_levels=[0, 1])
+        for _ in range(3):
+            gt_boxes, dt_boxes = random_frame(rng)
+            benchmark.add_stats(benchmark.get_stats(gt_boxes, dt_boxes, rng.integers(2, size=len(gt_boxes))))
+
+        for o, r, d in np.ndindex(2, 2, 2):
+            ap = benchmark.ap(o, r, d)
+            precision = benchmark.precision(overlap_idx=o, range_idx=r, difficulty_idx=d)
+            recall = benchmark.recall(overlap_idx=o, range_idx=r, difficulty_idx=d)
+            for k in [c.value for c in classes]:
+                p, rc = np.array(precision[k]), np.array(recall[k])
+                assert 0 <= ap[k] <= 1
+                assert np.isclose(ap[k], np.sum((rc[:-1] - rc[1:]) * (p[:-1] + p[1:]) / 2))
+
+        summary = benchmark.summary()
+        assert summary.count("Results for") == 16
+        assert "Results for Car (overlap 0.3, range 0-20m, difficulty 0):" in summary
+        assert "Results for Pedestrian (overlap 0.5, range 20-100m, difficulty 1):" in summary
+        assert "Results for Car:" in ObjectBenchmark(classes, 0.5).summary()
+
+class TestKittiObjectBenchmark(unittest.TestCase):
+    def test_handcrafted_frames(self):
+        C = KittiObjectClass
+        gt1 = [
+            kitti_row(C.Car, [100, 100, 200, 200], 0),
+            kitti_row(C.Car, [300, 100, 400, 200], 5, occlusion=1), # ignored in easy
+            kitti_row(C.Van, [500, 100, 600, 200], 10), # neighbor class of Car
+            kitti_row(C.DontCare, [700, 100, 800, 200], -1000),
+            kitti_row(C.Car, [1500, 100, 1600, 200], 15) # missed
+        ]
+        dt1 = [
+            kitti_row(C.Car, [100, 100, 200, 200], 0, score=0.9),
+            kitti_row(C.Car, [300, 100, 400, 200], 5, alpha=np.pi/2, score=0.8),
+            kitti_row(C.Car, [500, 100, 600, 200], 10, score=0.92), # assigned to the Van, not a FP
+            kitti_row(C.Car, [710, 110, 790, 190], 20, score=0.93), # inside DontCare area, not a FP
+            kitti_row(C.Car, [1100, 100, 1200, 120], 25, score=0.99), # lower than min height, not a FP
+            kitti_row(C.Car, [1300, 100, 1400, 200], 30, score=0.95) # false positive
+        ]
+        gt2 = [kitti_row(C.Car, [100, 100, 200, 200], 0)]
+        dt2 = [kitti_row(C.Car, [100, 100, 200, 200], 0, score=0.85)]
+
+        benchmark = KittiObjectBenchmark(C.Car, metrics=("bbox",))
+        benchmark.add_frame(label_columns(gt1), label_columns(dt1))
+        benchmark.add_frame(label_columns(gt2), label_columns(dt2))
+
+        # moderate: score thresholds 0.9, 0.85, 0.8 give (tp, fp) = (1, 1), (2, 1), (3, 1), and orientation
+        # similarities 1, 2, 2.5 (the second detection in the first frame has 90 degree error), so the
+        # interpolated precisions are 0.75, 0.75, 0.75 and the AOS are 2/3, 2/3, 0.625
+        ap = benchmark.ap("bbox", "moderate", sample_points=40)[C.Car]
+        assert np.isclose(ap, 0.75 * 2 / 40 * 100)
+        ap = benchmark.ap("bbox", "moderate", sample_points=11)[C.Car]
+        assert np.isclose(ap, 0.75 / 11 * 100)
+        aos = benchmark.aos("moderate", sample_points=40)[C.Car]
+        assert np.isclose(aos, (2/3 + 0.625) / 40 * 100)
+        aos = benchmark.aos("moderate", sample_points=11)[C.Car]
+        assert np.isclose(aos, 2/3 / 11 * 100)
+
+        # easy: the occluded car is ignored, score thresholds 0.9, 0.85 give (tp, fp) = (1, 1), (2, 1)
+        ap = benchmark.ap("bbox", "easy", sample_points=40)[C.Car]
+        assert np.isclose(ap, 2 / 3 / 40 * 100)
+        aos = benchmark.aos("easy", sample_points=40)[C.Car]
+        assert np.isclose(aos, 2 / 3 / 40 * 100)
+
+if __name__ == "__main__":
+    TestObjectBenchmark().test_iou_yaw_direction()
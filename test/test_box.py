@@ -2,7 +2,7 @@ import unittest
 
 import numpy as np
 import torch
-from d3d.box import box2d_iou, box2d_nms, box2d_crop
+from d3d.box import box2d_iou, box2d_iou_sparse, box2d_iou_loss, box2d_iou_paired, box2d_nms, box2d_nms_batched, box2d_crop, box_crop
 
 sq2 = np.sqrt(2)
 d90 = np.pi / 4
@@ -96,6 +96,106 @@ class TestBoxModule(unittest.TestCase):
         ious = box2d_iou(boxes.cuda(), boxes.cuda(), method="rbox")
         assert np.allclose(ious.cpu().numpy() - np.eye(5), 0, atol=1e-6)
 
+    def test_iou_3d_boxes(self):
+        boxes1 = torch.tensor([
+            [0, 0, 0, 2, 2, 2, 0],
+            [0, 0, 0, 2, 2, 2, d90]
+        ], dtype=torch.float)
+        boxes2 = torch.tensor([
+            [0, 0, 0, 2, 2, 2, d90],
+            [0, 0, 1, 2, 2, 2, 0],
+            [1, 0, 1, 2, 2, 2, 0],
+            [0, 0, 3, 2, 2, 2, 0]
+        ], dtype=torch.float)
+
+        bev_ious_expected = torch.tensor([
+            [1/sq2, 1, 1/3, 1],
+            [1, 1/sq2, 0.2963, 1/sq2]
+        ], dtype=torch.float)
+        ious = box2d_iou(boxes1, boxes2, method="bev")
+        assert torch.allclose(ious, bev_ious_expected, atol=1e-4)
+
+        ious_expected = torch.tensor([
+            [1/sq2, 1/3, 1/7, 0],
+            [1, 0.2612, 0.1290, 0]
+        ], dtype=torch.float)
+        ious = box2d_iou(boxes1, boxes2, method="box3d")
+        assert torch.allclose(ious, ious_expected, atol=1e-4)
+        ious = box2d_iou(boxes1.cuda(), boxes2.cuda(), method="box3d")
+        assert torch.allclose(ious, ious_expected.cuda(), atol=1e-4)
+
+    def test_iou_sparse(self):
+        n, m = 2000, 300
+        boxes1 = torch.cat([torch.rand(n, 3)*100, torch.rand(n, 3)*4 + 1, torch.rand(n, 1)*6 - 3], dim=1)
+        boxes2 = torch.cat([torch.rand(m, 3)*100, torch.rand(m, 3)*4 + 1, torch.rand(m, 1)*6 - 3], dim=1)
+
+        for method in ['box', 'bev', 'box3d']:
+            ious_expected = box2d_iou(boxes1, boxes2, method=method)
+            ious = box2d_iou_sparse(boxes1, boxes2, method=method, as_tensor=True)
+            assert torch.allclose(ious.to_dense(), ious_expected, atol=1e-6)
+            assert len(ious.values()) == torch.sum(ious_expected > 0)
+
+            indices, values = box2d_iou_sparse(boxes1.cuda(), boxes2.cuda(), method=method)
+            assert torch.equal(indices.cpu(), ious.indices())
+            assert torch.allclose(values.cpu(), ious.values(), atol=1e-6)
+
+        # large sparse box sets, and a single box which makes a grid with one cell
+        n, m = 20000, 1000
+        boxes1 = torch.cat([torch.rand(n, 2)*1000, torch.rand(n, 2)*4 + 1, torch.rand(n, 1)*6 - 3], dim=1)
+        boxes2 = torch.cat([torch.rand(m, 2)*1000, torch.rand(m, 2)*4 + 1, torch.rand(m, 1)*6 - 3], dim=1)
+        for b2 in [boxes2, torch.tensor([[500, 500, 300, 200, 0.5]])]:
+            indices, values = box2d_iou_sparse(boxes1, b2, method="rbox")
+            indices_cuda, values_cuda = box2d_iou_sparse(boxes1.cuda(), b2.cuda(), method="rbox")
+            assert torch.equal(indices_cuda.cpu(), indices)
+            assert torch.allclose(values_cuda.cpu(), values, atol=1e-6)
+
+    def test_iou_loss(self):
+        n = 100
+        boxes1 = torch.cat([torch.rand(n, 2)*4, torch.rand(n, 2)*3 + 0.5, torch.rand(n, 1)*6 - 3], dim=1).double()
+        boxes2 = torch.cat([torch.rand(n, 2)*4, torch.rand(n, 2)*3 + 0.5, torch.rand(n, 1)*6 - 3], dim=1).double()
+
+        # box2d_iou is calculated in float precision while the paired IoU is calculated in double
+        ious_expected = torch.diag(box2d_iou(boxes1, boxes2, method="rbox"))
+        assert torch.allclose(box2d_iou_paired(boxes1, boxes2), ious_expected, atol=1e-5)
+        assert torch.allclose(box2d_iou_paired(boxes1.cuda(), boxes2.cuda()).cpu(), ious_expected, atol=1e-5)
+
+        for loss_type in ['iou', 'giou', 'diou']: # alpha in CIoU is not differentiated
+            boxes1.requires_grad_(True)
+            boxes2.requires_grad_(True)
+            assert torch.autograd.gradcheck(lambda b1, b2: box2d_iou_loss(b1, b2, loss_type), (boxes1, boxes2))
+
+            losses = box2d_iou_loss(boxes1.detach(), boxes2.detach(), loss_type)
+            assert torch.allclose(box2d_iou_loss(boxes1.detach().cuda(), boxes2.detach().cuda(), loss_type).cpu(), losses)
+
+    def test_ciou_loss(self):
+        # intersection [0, 1] x [-1, 1], union 10, enclosing box [-1, 2] x [-2, 2]
+        boxes1 = torch.tensor([[0, 0, 2, 2, 0]], dtype=torch.double)
+        boxes2 = torch.tensor([[1, 0, 4, 2, np.pi/2]], dtype=torch.double)
+        v = 4 / np.pi**2 * (np.arctan(2) - np.arctan(1))**2
+        alpha = v / (1 - 0.2 + v)
+        expected = torch.tensor([1 - 0.2 + 1 / 25 + alpha * v], dtype=torch.double)
+        assert torch.allclose(box2d_iou_loss(boxes1, boxes2, "ciou"), expected)
+        assert torch.allclose(box2d_iou_loss(boxes1.cuda(), boxes2.cuda(), "ciou").cpu(), expected)
+
+        n = 100
+        boxes1 = torch.cat([torch.rand(n, 2)*4, torch.rand(n, 2)*3 + 0.5, torch.rand(n, 1)*6 - 3], dim=1).double()
+        boxes2 = torch.cat([torch.rand(n, 2)*4, torch.rand(n, 2)*3 + 0.5, torch.rand(n, 1)*6 - 3], dim=1).double()
+
+        def alpha_v(b1, b2):
+            v = 4 / np.pi**2 * (torch.atan(b2[:, 2] / b2[:, 3]) - torch.atan(b1[:, 2] / b1[:, 3]))**2
+            return v / (1 - box2d_iou_paired(b1, b2) + v), v
+        alpha0, _ = alpha_v(boxes1, boxes2)
+
+        def ciou_loss(xywh1, xywh2):
+            # alpha is not differentiated, so the correction keeps it fixed at alpha0 in the numerical gradient
+            b1, b2 = torch.cat([xywh1, boxes1[:, 4:]], dim=1), torch.cat([xywh2, boxes2[:, 4:]], dim=1)
+            alpha, v = alpha_v(b1, b2)
+            return box2d_iou_loss(b1, b2, "ciou") + ((alpha0 - alpha) * v).detach()
+
+        xywh1 = boxes1[:, :4].clone().requires_grad_(True)
+        xywh2 = boxes2[:, :4].clone().requires_grad_(True)
+        assert torch.autograd.gradcheck(ciou_loss, (xywh1, xywh2))
+
     def test_nms(self):
         boxes = torch.tensor([
             [1, 1, 2, 2, 0],
@@ -133,6 +233,76 @@ class TestBoxModule(unittest.TestCase):
         result = box2d_nms(boxes.cuda(), scores.cuda(), iou_method="rbox", iou_threshold=0.3)
         assert result.shape[0] == n
 
+    def test_nms_parity(self):
+        n = 1000
+        boxes = torch.cat([torch.rand(n, 2)*200, torch.rand(n, 1)*20 + 10,
+            torch.rand(n, 1)*30 + 5, torch.rand(n, 1)*2 - 1], dim=1)
+        scores = torch.rand(n)
+
+        for iou in ['box', 'rbox']:
+            # greedy suppression with the full iou matrix
+            ious = box2d_iou(boxes, boxes, method=iou)
+            mask_expected = torch.ones(n, dtype=torch.bool)
+            for i in scores.argsort(descending=True).tolist():
+                if mask_expected[i]:
+                    overlap = (ious[i] > 0.3) & (scores < scores[i])
+                    mask_expected[overlap] = False
+
+            mask = box2d_nms(boxes, scores, iou_method=iou, iou_threshold=0.3)
+            assert torch.all(mask == mask_expected)
+
+    def test_nms_limits(self):
+        n = 1000
+        boxes = torch.cat([torch.rand(n, 2)*200, torch.rand(n, 1)*20 + 10,
+            torch.rand(n, 1)*30 + 5, torch.rand(n, 1)*2 - 1], dim=1)
+        scores = torch.rand(n)
+
+        for supression in ['hard', 'linear', 'gaussian']:
+            for device in ['cpu', 'cuda']:
+                b, s = boxes.to(device), scores.to(device)
+                mask = box2d_nms(b, s, iou_method="rbox", supression_method=supression,
+                    iou_threshold=0.3, score_threshold=0.1, supression_param=0.5)
+                mask_limited = box2d_nms(b, s, iou_method="rbox", supression_method=supression,
+                    iou_threshold=0.3, score_threshold=0.1, supression_param=0.5, max_output=20)
+                assert torch.sum(mask_limited) == 20
+                if supression == 'hard': # top boxes are kept in hard nms
+                    kept, = torch.where(mask)
+                    kept = kept[s[kept].argsort(descending=True)[:20]]
+                    assert torch.all(mask_limited[kept])
+
+        mask = box2d_nms(boxes, scores, iou_method="rbox", iou_threshold=0.3, pre_nms_top_n=100)
+        top_idx = scores.topk(100).indices
+        assert torch.equal(mask[top_idx], box2d_nms(boxes[top_idx], scores[top_idx], iou_method="rbox", iou_threshold=0.3))
+        assert torch.sum(mask) == torch.sum(mask[top_idx])
+
+    def test_nms_batched(self):
+        n = 2000
+        boxes = torch.cat([torch.rand(n, 2)*200, torch.rand(n, 1)*20 + 10,
+            torch.rand(n, 1)*30 + 5, torch.rand(n, 1)*2 - 1], dim=1)
+        scores = torch.rand(n)
+        batch_indices = torch.randint(3, (n,))
+        class_indices = torch.randint(4, (n,))
+
+        for max_per_group in [0, 10]:
+            kept_expected = []
+            for b in range(3):
+                for c in range(4):
+                    group, = torch.where((batch_indices == b) & (class_indices == c))
+                    mask = box2d_nms(boxes[group], scores[group], iou_method="rbox", iou_threshold=0.3)
+                    kept = group[mask]
+                    kept = kept[scores[kept].argsort(descending=True)]
+                    if max_per_group > 0:
+                        kept = kept[:max_per_group]
+                    kept_expected.append(kept)
+            kept_expected = torch.cat(kept_expected)
+
+            kept = box2d_nms_batched(boxes, scores, batch_indices, class_indices,
+                iou_method="rbox", iou_threshold=0.3, max_per_group=max_per_group)
+            assert torch.equal(kept, kept_expected)
+            kept = box2d_nms_batched(boxes.cuda(), scores.cuda(), batch_indices.cuda(), class_indices.cuda(),
+                iou_method="rbox", iou_threshold=0.3, max_per_group=max_per_group)
+            assert torch.equal(kept.cpu(), kept_expected)
+
     def test_softnms(self):
         boxes = torch.tensor([
             [1, 1, 2, 2, 0],
@@ -183,5 +353,33 @@ class TestBoxModule(unittest.TestCase):
         assert torch.all(result[0] == exp_box1)
         assert torch.all(result[1] == exp_box2)
 
+    def test_box_crop_csr(self):
+        cloud = torch.rand(1000, 3) * 4 - 2
+        boxes = torch.tensor([
+            [0, 0, 0, 1, 1, 1, 0],
+            [0, 0, 0, 1, 1, 2, d90],
+            [5, 5, 0, 1, 1, 1, 0]],
+            dtype=torch.float)
+
+        indices, offsets, box_ids = box_crop(cloud, boxes)
+        abs_cloud = torch.abs(cloud)
+        exp_box1, = torch.where(torch.all(abs_cloud < 0.5, 1))
+        exp_box2, = torch.where((abs_cloud[:,0] + abs_cloud[:,1] < sq2/2) & (abs_cloud[:,2] <= 1))
+
+        assert len(offsets) == 4
+        assert torch.all(indices[offsets[0]:offsets[1]] == exp_box1)
+        assert torch.all(indices[offsets[1]:offsets[2]] == exp_box2)
+        assert offsets[2] == offsets[3]
+
+        exp_ids = torch.full((1000,), -1, dtype=torch.long)
+        exp_ids[exp_box2] = 1
+        exp_ids[exp_box1] = 0
+        assert torch.all(box_ids == exp_ids)
+
+        # z ranges with BEV boxes
+        zranges = torch.tensor([[-0.5, 0.5], [-1, 1], [-0.5, 0.5]])
+        indices2, offsets2, _ = box_crop(cloud.double(), boxes[:, [0, 1, 3, 4, 6]], zranges)
+        assert torch.all(indices2 == indices) and torch.all(offsets2 == offsets)
+
 if __name__ == "__main__":
     TestBoxModule().test_softnms()
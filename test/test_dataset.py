@@ -1,15 +1,39 @@
+import importlib.util
 import os
+import pickle
 import random
+import sys
+import tarfile
+import tempfile
 import unittest
+from io import BytesIO
+from PIL import Image
+from unittest import mock
 
 import numpy as np
+from addict import Dict as edict
 import pcl
 from matplotlib import pyplot as plt
 import time
+from concurrent.futures import ThreadPoolExecutor
+from scipy.spatial.transform import Rotation
 
+from d3d.abstraction import ObjectTag, ObjectTarget3D, ObjectTarget3DArray
+from d3d.dataset.base import (ArchiveIndex, DetectionDatasetBase, LabelCache,
+                              ScenePoses, ZipWriter, dequantize_cloud,
+                              quantize_cloud)
+from d3d.dataset.augmentation import (AugmentationPipeline, GlobalRotation,
+                                      GlobalScaling, GlobalTranslation,
+                                      RandomFlip, transform_boxes,
+                                      transform_objects, transform_points)
+from d3d.dataset.database import ObjectDatabase
 from d3d.dataset.kitti.object import (KittiObjectClass, KittiObjectLoader,
-                                      dump_detection_output)
-from d3d.dataset.waymo.loader import WaymoObjectLoader
+                                      dump_detection_output,
+                                      dump_detection_outputs, object_columns)
+from d3d.dataset.waymo import loader as waymo_loader
+from d3d.dataset.waymo.loader import (WaymoObjectClass, WaymoObjectLoader,
+                                      _detection_columns, create_submission,
+                                      dump_detection_shards)
 from d3d.dataset.nuscenes.loader import NuscenesObjectClass, NuscenesObjectLoader, NuscenesDetectionClass
 from d3d.vis.pcl import visualize_detections as pcl_vis
 from d3d.vis.image import visualize_detections as img_vis
@@ -21,6 +45,7 @@ waymo_location = os.environ['WAYMO'] if 'WAYMO' in os.environ else None
 nuscenes_location = os.environ['NUSCENES'] if 'NUSCENES' in os.environ else None
 inzip = os.environ['INZIP'] if 'INZIP' in os.environ else True
 selection = int(os.environ['INDEX']) if 'INDEX' in os.environ else None
+has_waymo = importlib.util.find_spec("waymo_open_dataset") is not None
 
 class CommonMixin:
     def test_point_cloud_projection(self):
@@ -191,5 +216,614 @@ class TestNuscenesDataset(unittest.TestCase, CommonMixin):
         assert NuscenesObjectClass.movable_object_trafficcone.to_detection() == NuscenesDetectionClass.traffic_cone
         assert NuscenesObjectClass.animal.to_detection() == NuscenesDetectionClass.ignore
 
+class TestQuantizedCloud(unittest.TestCase):
+    def check_round_trip(self, cloud):
+        data = quantize_cloud(cloud)
+        with BytesIO() as buffer: # same as the storage in converters
+            np.savez(buffer, **data)
+            buffer.seek(0)
+            with np.load(buffer) as data:
+                restored = dequantize_cloud(data)
+                scale = data['scale']
+
+        assert restored.shape == cloud.shape and restored.dtype == np.float32
+        # errors are bounded by half of the quantization step (with float32 rounding)
+        error = np.abs(restored - cloud)
+        tolerance = scale / 2 + 1e-5 * np.maximum(1, np.abs(cloud).max(axis=0, initial=0))
+        assert np.all(error <= tolerance)
+        return restored, scale
+
+    def test_round_trip(self):
+        rng = np.random.default_rng(0)
+        n = 10000
+        cloud = np.concatenate([
+            rng.uniform([-80, -80, -3], [80, 80, 5], (n, 3)), # positions
+            rng.uniform(0, 1, (n, 1)), # intensity
+            rng.integers(0, 64, (n, 1)), # ring index
+            np.full((n, 1), 7) # constant channel
+        ], axis=1).astype(np.float32)
+        restored, scale = self.check_round_trip(cloud)
+        assert np.all(scale[:3] == np.float32(0.01))
+        assert np.isclose(scale[3], np.ptp(cloud[:, 3]) / 255)
+        assert np.all(restored[:, 4:] == cloud[:, 4:]) # integer channels are preserved exactly
+
+        # the step is enlarged when the extent cannot be represented with the resolution
+        cloud[:, 0] *= 10
+        _, scale = self.check_round_trip(cloud)
+        assert scale[0] > 0.01 and np.all(scale[1:3] == np.float32(0.01))
+
+        # empty cloud
+        restored, _ = self.check_round_trip(np.empty((0, 4), dtype=np.float32))
+        assert restored.shape == (0, 4)
+
+class TestScenePoses(unittest.TestCase):
+    def setUp(self):
+        # large timestamps in microseconds as in the datasets
+        self.base = 1_600_000_000_000_000
+        self.yaws = np.array([0, 0.2, 0.6, 1.2])
+        self.translations = np.array([[0, 0, 0], [1, 0, 0], [3, 2, 0], [6, 2, 1]], dtype=float)
+        self.poses = ScenePoses(self.base + np.array([0, 100, 300, 600]),
+            Rotation.from_euler("z", self.yaws[:, None]), self.translations)
+
+    def test_frame_index(self):
+        assert len(self.poses) == 4
+        r, t = self.poses.pose(2)
+        assert np.isclose(r.as_euler("zyx")[0], 0.6) and np.all(t == [3, 2, 0])
+        r, t = self.poses.pose([3, 1])
+        assert np.allclose(r.as_euler("zyx")[:, 0], [1.2, 0.2]) and np.all(t == self.translations[[3, 1]])
+
+        rt = self.poses.homogeneous()
+        assert rt.shape == (4, 4, 4)
+        assert np.allclose(rt[1, :3, :3], Rotation.from_euler("z", 0.2).as_matrix())
+        assert np.all(rt[:, :3, 3] == self.translations) and np.all(rt[:, 3] == [0, 0, 0, 1])
+        assert np.allclose(self.poses.homogeneous(3), rt[3])
+
+    def test_locate(self):
+        timestamps = self.base + np.array([-50, 0, 40, 50, 60, 100, 250, 600, 700])
+        assert np.all(self.poses.locate(timestamps) == [0, 0, 0, 0, 1, 1, 2, 3, 3])
+        assert np.all(self.poses.locate(timestamps, side="left") == [0, 0, 0, 0, 0, 1, 1, 3, 3])
+        assert np.all(self.poses.locate(timestamps, side="right") == [0, 0, 1, 1, 1, 1, 2, 3, 3])
+        assert self.poses.locate(self.base + 280) == 2
+        with self.assertRaises(ValueError):
+            self.poses.locate(self.base, side="middle")
+
+        single = ScenePoses([self.base], Rotation.from_euler("z", [[0.1]]), [[1, 2, 3]])
+        assert np.all(single.locate(self.base + np.array([-10, 0, 10])) == 0)
+
+    def test_interpolate(self):
+        # at the frames
+        r, t = self.poses.interpolate(self.base + np.array([0, 100, 300, 600]))
+        assert np.allclose(r.as_euler("zyx")[:, 0], self.yaws) and np.allclose(t, self.translations)
+
+        # between the frames
+        r, t = self.poses.interpolate(self.base + 200)
+        assert np.isclose(r.as_euler("zyx")[0], 0.4) and np.allclose(t, [2, 1, 0])
+        r, t = self.poses.interpolate(self.base + np.array([50, 400]))
+        assert np.allclose(r.as_euler("zyx")[:, 0], [0.1, 0.8]) and np.allclose(t, [[0.5, 0, 0], [4, 2, 1/3]])
+
+        # out of range
+        with self.assertRaises(ValueError):
+            self.poses.interpolate(self.base + 700)
+        r, t = self.poses.interpolate(self.base + np.array([-100, 700]), extrapolate=True)
+        assert np.allclose(r.as_euler("zyx")[:, 0], [0, 1.2]) and np.allclose(t, self.translations[[0, 3]])
+
+class SyntheticLoader(DetectionDatasetBase):
+    '''
+    Loader with a car at (10i, 0) and a pedestrian at (0, 10) in the i-th frame, the pedestrians of
+    all frames overlap each other. Every object has 20 points inside, and the first frame has an
+    extra pedestrian with only 2 points. The frame 4 is empty.
+    '''
+    def __init__(self, nframes=4, frames=None):
+        self.frames = np.arange(nframes) if frames is None else np.asarray(frames)
+
+    def __len__(self):
+        return len(self.frames)
+
+    def lidar_objects(self, idx):
+        cached = self._cached_objects(idx, lambda value: ObjectTag(value, KittiObjectClass))
+        if cached is not None:
+            return cached
+
+        fidx = int(self.frames[idx])
+        objects = ObjectTarget3DArray(frame="vehicle")
+        if fidx == 4:
+            return objects
+
+        objects.append(ObjectTarget3D([10 * fidx, 0, 0], Rotation.from_euler("z", 0.5), [4, 1.8, 1.5],
+            ObjectTag(KittiObjectClass.Car, KittiObjectClass), id="car%d" % fidx))
+        objects.append(ObjectTarget3D([0, 10, 0], Rotation.from_euler("z", 0.3 * fidx), [0.8, 0.6, 1.7],
+            ObjectTag(KittiObjectClass.Pedestrian, KittiObjectClass)))
+        if fidx == 0:
+            objects.append(ObjectTarget3D([-20, -20, 0], Rotation.from_euler("z", 0), [0.8, 0.6, 1.7],
+                ObjectTag(KittiObjectClass.Pedestrian, KittiObjectClass)))
+        return objects
+
+    def lidar_data(self, idx, names=None, concat=False):
+        rng = np.random.default_rng(self.frames[idx])
+        cloud = []
+        for obj in self.lidar_objects(idx):
+            dim = np.asarray(obj.dimension)
+            count = 2 if obj.position[0] < -10 else 20
+            local = rng.uniform(-0.4, 0.4, (count, 3)) * dim
+            # points just beside the box, which are included if the yaw is flipped
+            local = np.concatenate([local, [[0.45, 0.5, 0], [0.45, -0.5, 0], [-0.45, 0.5, 0], [-0.45, -0.5, 0]]
+                * dim + [[0, 0.3, 0], [0, -0.3, 0], [0, 0.3, 0], [0, -0.3, 0]]])
+            cloud.append(obj.orientation.apply(local) + obj.position)
+        cloud = np.concatenate(cloud)
+        return np.hstack([cloud, rng.uniform(size=(len(cloud), 1))]).astype(np.float32)
+
+class TestObjectDatabase(unittest.TestCase):
+    def setUp(self):
+        self.tempdir = tempfile.TemporaryDirectory()
+        ObjectDatabase.build(SyntheticLoader(), self.tempdir.name, nworkers=2)
+        self.db = ObjectDatabase(self.tempdir.name, seed=0)
+
+    def tearDown(self):
+        self.tempdir.cleanup()
+
+    def test_build(self):
+        car, ped = KittiObjectClass.Car.value, KittiObjectClass.Pedestrian.value
+        assert len(self.db) == 9
+        assert self.db.class_count(car) == 4
+        assert self.db.class_count(ped) == 4 # the sparse pedestrian is excluded
+        assert np.all(self.db.frames == [0, 0, 0, 1, 1, 2, 2, 3, 3])
+
+        for oidx in range(len(self.db)):
+            box = self.db.boxes[oidx]
+            points = self.db.points(oidx, absolute=False)
+            assert len(points) == (2 if box[0] < -10 else 20)
+            local = Rotation.from_euler("z", box[6]).inv().apply(points[:, :3])
+            assert np.all(np.abs(local) <= box[3:6] / 2)
+            assert np.allclose(self.db.points(oidx)[:, :3], points[:, :3] + box[:3])
+
+    def test_sample(self):
+        car, ped = KittiObjectClass.Car.value, KittiObjectClass.Pedestrian.value
+
+        # number of existing objects is subtracted
+        for _ in range(4):
+            candidates, boxes, labels, points, offsets = self.db.sample({car: 3}, existing_labels=[car, ped])
+            assert len(candidates) == 2 and len(np.unique(candidates)) == 2
+            assert np.all(labels == car)
+            assert np.all(boxes == self.db.boxes[candidates])
+            assert offsets[-1] == len(points) == 40
+
+        # sampled objects colliding with previous samples are dropped
+        candidates, _, labels, _, _ = self.db.sample({car: 2, ped: 3})
+        assert np.sum(labels == car) == 2
+        assert np.sum(labels == ped) == 1
+
+        # sampled objects colliding with existing boxes are dropped
+        existing = self.db.boxes[self.db.labels == car]
+        candidates, _, _, points, offsets = self.db.sample({car: 4, ped: 1}, existing_boxes=existing)
+        assert np.all(self.db.labels[candidates] == ped)
+        assert len(candidates) == 1 and len(offsets) == 2
+
+        # a box touching the first car only if yaw is in FLU, a fresh database is used so that
+        # each draw is a permutation of all cars
+        db = ObjectDatabase(self.tempdir.name, seed=1)
+        corner = Rotation.from_euler("z", 0.5).apply([2, 0.9, 0])
+        existing = [[corner[0] + 0.3, corner[1] + 0.3, 0, 1, 1, 1.5, 0]]
+        for _ in range(4):
+            candidates, _, _, _, _ = db.sample({car: 4}, existing_boxes=existing)
+            assert 0 not in candidates.tolist() and len(candidates) == 3
+
+class TestLabelCache(unittest.TestCase):
+    def test_round_trip(self):
+        with tempfile.TemporaryDirectory() as tempdir:
+            path = os.path.join(tempdir, "labels.npz")
+            LabelCache.build(SyntheticLoader(nframes=5), path)
+            cache = LabelCache(path)
+            assert len(cache) == 5 and 4 in cache and 5 not in cache
+            assert cache.frame == "vehicle"
+
+            # the cache of the whole dataset serves a split, frames not in the cache are loaded from the dataset
+            frames = [3, 4, 0, 5]
+            loader, cached_loader = SyntheticLoader(frames=frames), SyntheticLoader(frames=frames)
+            cached_loader.load_label_cache(path)
+            assert cached_loader._cached_objects(1, None) is not None
+            assert cached_loader._cached_objects(3, None) is None
+
+            for idx in range(len(frames)):
+                expected, objects = loader.lidar_objects(idx), cached_loader.lidar_objects(idx)
+                assert objects.frame == expected.frame and len(objects) == len(expected)
+                for obj, exp in zip(objects, expected):
+                    assert obj.tag_top == exp.tag_top and obj.id == exp.id
+                    assert np.allclose(obj.position, exp.position)
+                    assert np.allclose(obj.dimension, exp.dimension)
+                    assert np.isclose(obj.yaw, exp.yaw, atol=1e-6)
+
+class TestArchiveIndex(unittest.TestCase):
+    def setUp(self):
+        self.tempdir = tempfile.TemporaryDirectory()
+        self.names = ["a", "b", "c"]
+        for name in self.names:
+            with ZipWriter(os.path.join(self.tempdir.name, name + ".zip"), "lidar=deflated") as ar:
+                ar.writestr("stats.json", '{"name": "%s"}' % name)
+                for i in range(10):
+                    with ar.open("lidar/%d.bin" % i, "w") as fout:
+                        fout.write(self.content(name, "lidar", i))
+                    with ar.open("camera/%d.txt" % i, "w") as fout:
+                        fout.write(self.content(name, "camera", i))
+
+    def tearDown(self):
+        self.tempdir.cleanup()
+
+    @staticmethod
+    def content(name, folder, i):
+        return ("%s/%s/%d" % (name, folder, i)).encode() * (i + 1)
+
+    def check_read(self, index, name, folder, i):
+        ext = "bin" if folder == "lidar" else "txt"
+        with index.open(name, "%s/%d.%s" % (folder, i, ext)) as fin:
+            assert fin.read() == self.content(name, folder, i)
+
+    def test_interleaved_read(self):
+        index = ArchiveIndex(self.tempdir.name, "stats.json")
+        assert list(index.stats) == self.names
+        index.MAX_DESCRIPTORS = 2 # descriptors are evicted when reading three archives
+
+        # each archive is opened only once when switching between two archives
+        with mock.patch("d3d.dataset.base.os.open", side_effect=os.open) as os_open:
+            for i in range(10):
+                for folder in ["lidar", "camera"]:
+                    self.check_read(index, "a", folder, i)
+                    self.check_read(index, "b", folder, i)
+            assert os_open.call_count == 2
+        for i in range(10):
+            for name in self.names:
+                self.check_read(index, name, "lidar", i)
+
+        # concurrent reads from threads, each thread keeps its own descriptors
+        tasks = [(name, folder, i) for i in range(10) for name in self.names for folder in ["lidar", "camera"]]
+        with ThreadPoolExecutor(4) as pool:
+            for _ in range(10):
+                list(pool.map(lambda task: self.check_read(index, *task), tasks))
+        index.close()
+
+        # the index can be sent to other processes and it's reopened after close
+        for idx in [index, pickle.loads(pickle.dumps(index))]:
+            for name, folder, i in tasks:
+                self.check_read(idx, name, folder, i)
+            idx.close()
+
+class TestAugmentation(unittest.TestCase):
+    def setUp(self):
+        rng = np.random.default_rng(0)
+        n = 20
+        self.boxes = np.concatenate([
+            rng.uniform([-40, -40, -2], [40, 40, 1], (n, 3)), # positions
+            rng.uniform([3, 1, 1], [6, 2, 2], (n, 3)), # dimensions, length is always larger than width
+            rng.uniform(-np.pi, np.pi, (n, 1)), # yaw
+            np.arange(n)[:, None] # extra column
+        ], axis=1)
+
+        # sample points inside each box (FLU body coordinate, counter-clockwise yaw)
+        self.points, self.point_box = [], []
+        for i, box in enumerate(self.boxes):
+            local = rng.uniform(-0.45, 0.45, (50, 3)) * box[3:6]
+            c, s = np.cos(box[6]), np.sin(box[6])
+            rotation = np.array([[c, -s, 0], [s, c, 0], [0, 0, 1]])
+            self.points.append(local.dot(rotation.T) + box[:3])
+            self.point_box.append(np.full(50, i))
+        self.points = np.concatenate(self.points)
+        self.point_box = np.concatenate(self.point_box)
+        self.cloud = np.concatenate([self.points, rng.uniform(size=(len(self.points), 1))], axis=1)
+
+    def check_inside(self, points, boxes):
+        offsets = points - boxes[self.point_box, :3]
+        yaw = boxes[self.point_box, 6]
+        c, s = np.cos(yaw), np.sin(yaw)
+        local = np.stack([c * offsets[:, 0] + s * offsets[:, 1],
+                          -s * offsets[:, 0] + c * offsets[:, 1],
+                          offsets[:, 2]], axis=1)
+        assert np.all(np.abs(local) <= boxes[self.point_box, 3:6] / 2)
+
+    def make_pipeline(self, seed, flip_prob=0.5):
+        return AugmentationPipeline([
+            GlobalRotation(), RandomFlip('y', flip_prob), RandomFlip('x', flip_prob),
+            GlobalScaling(), GlobalTranslation()
+        ], seed=seed)
+
+    def test_seed(self):
+        matrices = self.make_pipeline(42).sample_matrices(10)
+        assert matrices.shape == (10, 4, 4)
+        assert np.array_equal(matrices, self.make_pipeline(42).sample_matrices(10))
+        assert not np.allclose(matrices, self.make_pipeline(43).sample_matrices(10))
+
+        # samples in the same batch are different, and the last row is kept
+        assert not np.allclose(matrices[0], matrices[1])
+        assert np.allclose(matrices[:, 3], [0, 0, 0, 1])
+
+    def test_points_in_boxes(self):
+        self.check_inside(self.points, self.boxes)
+
+        # single flips negate the yaw (y) or mirror it to the back (x)
+        flip_y = RandomFlip('y', 1).sample(np.random.default_rng(0), 1)[0]
+        flip_x = RandomFlip('x', 1).sample(np.random.default_rng(0), 1)[0]
+        for matrix, expected in [(flip_y, -self.boxes[:, 6]), (flip_x, np.pi - self.boxes[:, 6])]:
+            boxes = transform_boxes(self.boxes, matrix)
+            assert np.allclose(np.cos(boxes[:, 6]), np.cos(expected))
+            assert np.allclose(np.sin(boxes[:, 6]), np.sin(expected))
+            self.check_inside(transform_points(self.points, matrix), boxes)
+
+        # composed transforms, about a quarter of the samples are flipped in each direction
+        clouds, boxes, matrices = self.make_pipeline(0)([self.cloud] * 16, [self.boxes] * 16)
+        assert np.any(np.linalg.det(matrices[:, :3, :3]) < 0) and np.any(np.linalg.det(matrices[:, :3, :3]) > 0)
+        for cloud, box, matrix in zip(clouds, boxes, matrices):
+            assert np.array_equal(cloud[:, 3], self.cloud[:, 3]) and np.array_equal(box[:, 7], self.boxes[:, 7])
+            assert np.allclose(box[:, 3:6], self.boxes[:, 3:6] * np.cbrt(abs(np.linalg.det(matrix[:3, :3]))))
+            self.check_inside(cloud[:, :3], box)
+
+        # empty boxes
+        assert transform_boxes(np.empty((0, 7)), matrices[0]).shape == (0, 7)
+
+    def test_objects(self):
+        def make_objects():
+            objects = ObjectTarget3DArray(frame="vehicle")
+            for box in self.boxes:
+                objects.append(ObjectTarget3D(box[:3], Rotation.from_euler("z", box[6]), box[3:6],
+                    ObjectTag(KittiObjectClass.Car, KittiObjectClass)))
+            return objects
+
+        matrices = self.make_pipeline(1).sample_matrices(16)
+        for matrix in matrices:
+            expected = transform_boxes(self.boxes, matrix)
+            objects = make_objects()
+            assert transform_objects(objects, matrix) is objects
+            actual = objects.to_numpy()
+            assert np.allclose(actual[:, :6], expected[:, :6])
+            assert np.allclose(np.cos(actual[:, 6]), np.cos(expected[:, 6]))
+            assert np.allclose(np.sin(actual[:, 6]), np.sin(expected[:, 6]))
+
+            # orientations stay right-handed rotations around z-axis
+            for obj in objects:
+                assert np.isclose(np.linalg.det(obj.orientation.as_matrix()), 1)
+                assert np.allclose(obj.orientation.as_matrix()[2], [0, 0, 1])
+
+        # the pipeline dispatches object arrays and numpy boxes with the same matrices
+        _, (objects, boxes), _ = self.make_pipeline(2)([self.cloud] * 2, [make_objects(), self.boxes])
+        _, (expected, _), _ = self.make_pipeline(2)([self.cloud] * 2, [self.boxes] * 2)
+        assert np.allclose(objects.to_numpy()[:, :6], expected[:, :6])
+        assert len(transform_objects(ObjectTarget3DArray(), matrices[0])) == 0
+
+def _line_box_intersect(p0, p1, width, height):
+    # reference of the 2D box clipping, intersect the segment from inlier p0 to outlier p1 with the border
+    k = (p1[1] - p0[1]) / (p1[0] - p0[0])
+    if p1[0] < p0[0]:
+        if p1[1] < p0[1]:
+            case = 2 if k > p0[1] / p0[0] else 3
+        else:
+            case = 3 if k > -(height - p0[1]) / p0[0] else 0
+    else:
+        if p1[1] < p0[1]:
+            case = 1 if k > -p0[1] / (width - p0[0]) else 2
+        else:
+            case = 0 if k > (height - p0[1]) / (width - p0[0]) else 1
+
+    if case == 0:
+        return p0[0] + (height - p0[1]) / k, height
+    elif case == 1:
+        return width, p0[1] + (width - p0[0]) * k
+    elif case == 2:
+        return p1[0] - p1[1] / k, 0
+    else:
+        return 0, p1[1] - p1[0] * k
+
+def _reference_object_columns(detections, calib, raw_calib):
+    # per-box conversion of the detections into KITTI label fields
+    Tr = raw_calib['Tr_velo_to_cam'].reshape(3, 4)
+    RRect = Rotation.from_matrix(raw_calib['R0_rect'].reshape(3, 3))
+    HR, HT = Rotation.from_matrix(Tr[:,:3]), Tr[:,3]
+    width, height = calib.intrinsics_meta['cam2'].width, calib.intrinsics_meta['cam2'].height
+    pairs = [(0, 1), (2, 3), (4, 5), (6, 7), (0, 4), (1, 5), (2, 6), (3, 7), (0, 2), (1, 3), (4, 6), (5, 7)]
+
+    rows = []
+    for box in detections:
+        uv, mask, dmask = calib.project_points_to_camera(box.corners,
+            frame_to="cam2", frame_from="velo", remove_outlier=False, return_dmask=True)
+        if len(uv[mask]) < 1:
+            continue
+
+        inlier = [i in mask for i in range(len(uv))]
+        points = uv[mask].tolist()
+        for i, j in pairs:
+            if inlier[i] == inlier[j] or i not in dmask or j not in dmask:
+                continue
+            points.append(_line_box_intersect(uv[j], uv[i], width, height) if inlier[j]
+                else _line_box_intersect(uv[i], uv[j], width, height))
+        points = np.array(points)
+
+        l, w, h = box.dimension
+        position = RRect.as_matrix().dot(HR.as_matrix().dot(box.position) + HT)
+        position[1] += h/2
+        orientation = RRect * HR * box.orientation * Rotation.from_euler("x", np.pi/2)
+        yaw = orientation.as_euler("YZX")[0]
+        alpha = yaw - np.arctan2(position[0], position[2])
+        rows.append(edict(label=KittiObjectClass[box.tag_name].value, alpha=np.arctan2(np.sin(alpha), np.cos(alpha)),
+            bbox=np.concatenate([points.min(axis=0), points.max(axis=0)]), dimension=[h, w, l],
+            location=position, rotation_y=yaw, score=box.tag_score))
+    return rows
+
+def _make_kitti_testing(path, nframes, image_size=(1242, 375)):
+    # testing split of KITTI with calibrations and blank images only
+    raw_calib = dict(
+        P2=[721.5, 0, 609.6, 44.86, 0, 721.5, 172.9, 0.2164, 0, 0, 1, 0.002746],
+        R0_rect=Rotation.from_euler("xyz", [0.01, -0.008, 0.005]).as_matrix().ravel(),
+        Tr_velo_to_cam=[0.0075, -1, -0.0006, -0.004, 0.0148, 0.0007, -1, -0.0763, 1, 0.0075, 0.0148, -0.2718],
+        Tr_imu_to_velo=[1, 0, 0, -0.81, 0, 1, 0, 0.32, 0, 0, 1, -0.8])
+    raw_calib['P0'] = raw_calib['P1'] = raw_calib['P3'] = raw_calib['P2']
+
+    for folder in ["calib", "image_2"]:
+        os.makedirs(os.path.join(path, "testing", folder))
+    for idx in range(nframes):
+        with open(os.path.join(path, "testing", "calib", "%06d.txt" % idx), "w") as fout:
+            for key, value in raw_calib.items():
+                fout.write("%s: %s\n" % (key, " ".join("%.12e" % v for v in np.ravel(value))))
+        Image.new("RGB", image_size).save(os.path.join(path, "testing", "image_2", "%06d.png" % idx))
+    return KittiObjectLoader(path, inzip=False, phase="testing")
+
+class TestKittiDetectionOutput(unittest.TestCase):
+    def setUp(self):
+        self.tempdir = tempfile.TemporaryDirectory()
+        self.loader = _make_kitti_testing(self.tempdir.name, 3)
+
+    def tearDown(self):
+        self.tempdir.cleanup()
+
+    def make_objects(self):
+        objects = ObjectTarget3DArray(frame="velo")
+        for i, (position, yaw, label) in enumerate([
+            ([15, 0, -1], 0.3, KittiObjectClass.Car), # inside the image
+            ([8, 7, -1], 0.5, KittiObjectClass.Car), # crossing the left border
+            ([10, -6.5, -1.5], -0.2, KittiObjectClass.Van), # crossing the right border
+            ([6, 1, -2.5], 1.2, KittiObjectClass.Pedestrian), # crossing the bottom border
+            ([1.2, 0, -0.5], 0.1, KittiObjectClass.Car), # partly behind the camera
+            ([-10, 0, -1], 0, KittiObjectClass.Car), # behind the camera
+            ([5, 30, -1], 0.7, KittiObjectClass.Cyclist), # outside the image
+        ]):
+            dimension = [0.8, 0.6, 1.7] if label == KittiObjectClass.Pedestrian else [4, 1.8, 1.5]
+            objects.append(ObjectTarget3D(position, Rotation.from_euler("z", yaw), dimension,
+                ObjectTag(label, KittiObjectClass, scores=0.9 - 0.1 * i)))
+        return objects
+
+    def test_object_columns(self):
+        objects = self.make_objects()
+        calib, raw_calib = self.loader.calibration_data(0), self.loader.calibration_data(0, raw=True)
+        columns = object_columns(objects, calib, raw_calib)
+        expected = _reference_object_columns(objects, calib, raw_calib)
+        assert len(expected) == 5 and len(columns.label) == 5
+
+        for i, row in enumerate(expected):
+            assert columns.label[i] == row.label
+            assert np.allclose(columns.bbox[i], row.bbox)
+            assert np.allclose(columns.dimension[i], row.dimension)
+            assert np.allclose(columns.location[i], row.location)
+            assert np.isclose(columns.rotation_y[i], row.rotation_y)
+            assert np.isclose(columns.alpha[i], row.alpha)
+            assert np.isclose(columns.score[i], row.score)
+        assert np.all(columns.truncation == 0) and np.all(columns.occlusion == 0)
+
+        # the clipped boxes touch the image borders
+        width, height = calib.intrinsics_meta['cam2'].width, calib.intrinsics_meta['cam2'].height
+        assert np.all(columns.bbox >= 0) and np.all(columns.bbox[:, [2, 3]] <= [width, height])
+        assert columns.bbox[1, 0] == 0 and columns.bbox[2, 2] == width and columns.bbox[3, 3] == height
+
+        empty = object_columns(ObjectTarget3DArray(frame="velo"), calib, raw_calib)
+        assert empty.bbox.shape == (0, 4) and len(empty.label) == 0
+        assert dump_detection_output(ObjectTarget3DArray(frame="velo"), calib, raw_calib) == ""
+
+    def test_dump_outputs(self):
+        frames = [(0, self.make_objects()), (1, ObjectTarget3DArray(frame="velo")), (2, ObjectTarget3DArray(self.make_objects()[:2], frame="velo"))]
+        output_path = os.path.join(self.tempdir.name, "results")
+        assert dump_detection_outputs(self.loader, iter(frames), output_path, nworkers=2, chunksize=1) == 3
+        assert sorted(os.listdir(output_path)) == ["000000.txt", "000001.txt", "000002.txt"]
+
+        for idx, objects in frames:
+            with open(os.path.join(output_path, "%06d.txt" % idx)) as fin:
+                assert fin.read() == dump_detection_output(objects,
+                    self.loader.calibration_data(idx), self.loader.calibration_data(idx, raw=True))
+
+def _count_shard(path, frames):
+    # replaces the protobuf writer of waymo shards, records the number of objects of each frame
+    with open(path, "w") as fout:
+        fout.write(" ".join(str(len(detections['score'])) for detections, _, _ in frames))
+    return path
+
+class TestWaymoSubmission(unittest.TestCase):
+    def setUp(self):
+        rng = np.random.default_rng(0)
+        self.objects = ObjectTarget3DArray(frame="vehicle")
+        for i, label in enumerate([WaymoObjectClass.Vehicle, WaymoObjectClass.Pedestrian,
+            WaymoObjectClass.Cyclist, WaymoObjectClass.Sign, WaymoObjectClass.Unknown]):
+            orientation = Rotation.from_euler("ZYX", [rng.uniform(-np.pi, np.pi), 0.02 * i, -0.01 * i])
+            self.objects.append(ObjectTarget3D(rng.uniform(-50, 50, 3), orientation, rng.uniform(0.5, 5, 3),
+                ObjectTag(label, WaymoObjectClass, scores=rng.uniform())))
+
+    def make_frames(self, counts):
+        return [(self.objects[:count], "context%d" % i, 1000 * i) for i, count in enumerate(counts)]
+
+    def test_detection_columns(self):
+        columns = _detection_columns(self.objects)
+        for i, target in enumerate(self.objects):
+            assert np.allclose(columns['position'][i], target.position)
+            assert np.allclose(columns['dimension'][i], target.dimension)
+            assert np.isclose(columns['yaw'][i], target.yaw)
+            assert columns['label'][i] == target.tag_top.value
+            assert np.isclose(columns['score'][i], target.tag.scores[0])
+
+        empty = _detection_columns(ObjectTarget3DArray())
+        assert all(len(values) == 0 for values in empty.values())
+        assert empty['position'].shape == (0, 3)
+        assert _detection_columns(columns) is columns
+
+    def test_shards(self):
+        counts = [3, 0, 5, 2, 1, 4, 5, 0, 2]
+        with tempfile.TemporaryDirectory() as tempdir, \
+            mock.patch("d3d.dataset.waymo.loader._write_shard", _count_shard):
+            # one worker so that the number of pending shards is bounded
+            shards = dump_detection_shards(iter(self.make_frames(counts)), tempdir, nworkers=1, shard_size=4)
+            assert shards == sorted(shards) and len(set(shards)) == len(shards)
+
+            written = []
+            for path in shards:
+                with open(path) as fin:
+                    written.append([int(c) for c in fin.read().split()])
+
+        # frames are kept in order, and a shard is closed as soon as it has shard_size objects
+        assert sum(written, []) == counts
+        assert written == [[3, 0, 5], [2, 1, 4], [5], [0, 2]]
+
+    @unittest.skipIf(not has_waymo, "waymo_open_dataset not installed")
+    def test_concatenated_shards(self):
+        from waymo_open_dataset.protos import metrics_pb2
+
+        frames = self.make_frames([5, 3, 0, 4, 1])
+        merged = metrics_pb2.Objects()
+        for frame in frames:
+            merged.MergeFrom(waymo_loader.dump_detection_output(*frame))
+        assert len(merged.objects) == 13
+        assert merged.objects[0].object.type == WaymoObjectClass.Vehicle.value
+        assert np.isclose(merged.objects[0].object.box.heading, self.objects[0].yaw)
+
+        with tempfile.TemporaryDirectory() as tempdir:
+            shards = dump_detection_shards(frames, tempdir, nworkers=2, shard_size=3)
+            assert len(shards) == 4
+
+            content = b""
+            for path in shards:
+                with open(path, "rb") as fin:
+                    content += fin.read()
+        assert metrics_pb2.Objects.FromString(content) == merged
+
+    def test_create_submission(self):
+        with tempfile.TemporaryDirectory() as tempdir:
+            # the fake create_submission concatenates its input files in order into the output file
+            exec_path = os.path.join(tempdir, "create_submission")
+            with open(exec_path, "w") as fout:
+                fout.write("#!%s\n" % sys.executable)
+                fout.write("import sys\n")
+                fout.write("args = dict(arg[2:].split('=', 1) for arg in sys.argv[1:])\n")
+                fout.write("with open(args['output_filename'], 'wb') as fout:\n")
+                fout.write("    for name in args['input_filenames'].split(','):\n")
+                fout.write("        fout.write(open(name, 'rb').read())\n")
+            os.chmod(exec_path, 0o755)
+
+            # results from two directories are merged across the directory boundary
+            result_paths, expected = [], b""
+            for d in range(2):
+                result_paths.append(os.path.join(tempdir, "result%d" % d))
+                os.makedirs(result_paths[-1])
+                for i in range(3):
+                    content = bytes([d * 16 + i]) * (i + 2)
+                    with open(os.path.join(result_paths[-1], "%d.bin" % i), "wb") as fout:
+                        fout.write(content)
+                    expected += content
+
+            output_path = os.path.join(tempdir, "output")
+            create_submission(exec_path, result_paths, output_path, "meta.txtpb", model_name="model", shard_bytes=4)
+            with tarfile.open(os.path.join(output_path, "model.tgz")) as tar:
+                member, = [m for m in tar.getmembers() if m.isfile() and m.name.split("/")[-1] == "model"]
+                assert tar.extractfile(member).read() == expected
+
 if __name__ == "__main__":
     TestKittiDataset().test_detection_output()
@@ -0,0 +1,465 @@
+import json
+import os
+import tempfile
+import threading
+import types
+import unittest
+from unittest import mock
+
+import numpy as np
+import torch
+
+from d3d import profiler
+
+class TestProfiler(unittest.TestCase):
+    def setUp(self):
+        profiler.reset()
+        profiler.enable(synchronize=False)
+
+    def tearDown(self):
+        profiler.disable()
+        profiler.reset()
+
+    def test_nested_scopes(self):
+        @profiler.profile()
+        def inner():
+            with profiler.scope("leaf"):
+                return 1
+
+        @profiler.scope("outer")
+        def outer():
+            return inner() + inner()
+
+        with profiler.scope("step"):
+            assert outer() == 2
+            with profiler.scope("load"):
+                pass
+        assert outer() == 2
+
+        stats = profiler.statistics()
+        name = inner.__qualname__
+        assert list(stats) == ["outer", "outer/" + name, "outer/%s/leaf" % name,
+                               "step", "step/load", "step/outer", "step/outer/" + name,
+                               "step/outer/%s/leaf" % name]
+        assert stats["step"].count == 1 and stats["outer"].count == 1
+        assert stats["outer/" + name].count == 2 and stats["step/outer/%s/leaf" % name].count == 2
+        assert stats["step"].total >= stats["step/outer"].total + stats["step/load"].total
+
+        # the table is indented by the depth of the scopes
+        lines = profiler.report().split("\n")
+        assert len(lines) == len(stats) + 1
+        assert lines[1].startswith("outer ") and lines[2].startswith("  " + name)
+        assert lines[3].startswith("    leaf")
+
+        # the stack is restored when an exception is raised in a scope
+        with self.assertRaises(RuntimeError):
+            with profiler.scope("failed"):
+                raise RuntimeError()
+        with profiler.scope("after"):
+            pass
+        assert "failed" in profiler.statistics() and "after" in profiler.statistics()
+
+    def test_threads(self):
+        barrier = threading.Barrier(2)
+        def work():
+            with profiler.scope("worker"):
+                barrier.wait() # the main thread is in its scope at the same time
+                with profiler.scope("task"):
+                    barrier.wait()
+
+        thread = threading.Thread(target=work)
+        with profiler.scope("main"):
+            thread.start()
+            barrier.wait()
+            with profiler.scope("task"):
+                barrier.wait()
+        thread.join()
+        assert list(profiler.statistics()) == ["main", "main/task", "worker", "worker/task"]
+
+    def test_statistics(self):
+        # scopes with duration 1, 2, ..., 100 seconds
+        ticks = [t for i in range(1, 101) for t in (1000 * i, 1000 * i + i)]
+        with mock.patch("d3d.profiler.time.perf_counter", side_effect=ticks):
+            for _ in range(100):
+                with profiler.scope("sleep"):
+                    pass
+
+        stats = profiler.statistics()["sleep"]
+        values = np.arange(1, 101)
+        assert stats.count == 100
+        assert np.isclose(stats.total, values.sum()) and np.isclose(stats.mean, values.mean())
+        assert np.isclose(stats.p50, 50.5) and np.isclose(stats.p90, 90.1) and np.isclose(stats.p99, 99.01)
+        assert stats.max == 100
+
+        profiler.reset()
+        assert profiler.statistics() == {}
+        assert len(profiler.report().split("\n")) == 1
+
+    def test_disabled(self):
+        profiler.disable()
+        calls = []
+
+        @profiler.profile("func")
+        def func(x, y=1):
+            calls.append(x)
+            return x + y
+
+        with mock.patch("d3d.profiler.time.perf_counter") as perf_counter, \
+             mock.patch("d3d.profiler._synchronize") as synchronize:
+            with profiler.scope("scope"):
+                assert func(1, y=2) == 3
+            perf_counter.assert_not_called()
+            synchronize.assert_not_called()
+        assert calls == [1] and func.__name__ == "func"
+        assert profiler.statistics() == {} and not profiler.is_enabled()
+
+        # a scope entered while disabled is not recorded when the profiler is enabled inside it
+        with profiler.scope("scope"):
+            profiler.enable(synchronize=False)
+        assert profiler.statistics() == {}
+
+    def test_synchronize(self):
+        profiler.enable(synchronize=True)
+        with mock.patch("torch.cuda.is_available", return_value=True), \
+             mock.patch("torch.cuda.is_initialized", return_value=False), \
+             mock.patch("torch.cuda.synchronize") as synchronize:
+            # CUDA is not synchronized if it's not used in the process
+            with profiler.scope("cpu"):
+                pass
+            assert profiler.tap_time("timer") == 0
+            assert profiler.tap_time("timer", report=False) >= 0
+            synchronize.assert_not_called()
+
+            with mock.patch("torch.cuda.is_initialized", return_value=True):
+                with profiler.scope("gpu"):
+                    pass
+                assert synchronize.call_count == 2
+
+        # tap_time works without CUDA and keeps the timer if not cleared
+        assert profiler.tap_time("timer") == 0
+        first = profiler.tap_time("timer", clear=False)
+        assert profiler.tap_time("timer") >= first >= 0
+        assert "timer" not in profiler._timers
+
+    def test_reentrant(self):
+        load = profiler.scope("load")
+
+        # the same scope object is entered recursively
+        def recurse(depth):
+            with load:
+                if depth > 0:
+                    recurse(depth - 1)
+        recurse(2)
+        stats = profiler.statistics()
+        assert list(stats) == ["load", "load/load", "load/load/load"]
+        assert stats["load"].total >= stats["load/load"].total >= stats["load/load/load"].total
+        assert profiler._stack() == []
+
+        # and from several threads at the same time
+        profiler.reset()
+        barrier = threading.Barrier(4)
+        def work():
+            with load:
+                barrier.wait()
+                with profiler.scope("decode"):
+                    barrier.wait()
+        threads = [threading.Thread(target=work) for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        stats = profiler.statistics()
+        assert list(stats) == ["load", "load/decode"]
+        assert stats["load"].count == 4 and stats["load/decode"].count == 4
+
+        # an entry while disabled is skipped, and its children are attached to its parent
+        profiler.reset()
+        with load:
+            profiler.disable()
+            with load:
+                profiler.enable(synchronize=False)
+                with profiler.scope("decode"):
+                    pass
+        assert list(profiler.statistics()) == ["load", "load/decode"]
+        assert profiler.statistics()["load"].count == 1
+
+class TestInstrument(unittest.TestCase):
+    def setUp(self):
+        profiler.reset()
+        profiler.enable(synchronize=False)
+
+    def tearDown(self):
+        profiler.disable()
+        profiler.reset()
+
+    def test_class(self):
+        class External:
+            def read(self):
+                return "external"
+        class Base(External):
+            def load(self):
+                return self.decode() + 1
+            def decode(self):
+                return 1
+            def _helper(self):
+                return 0
+            def __call__(self):
+                return self.load()
+        class Derived(Base):
+            def decode(self):
+                return 2
+        External.__module__ = "other"
+        Base.__module__ = "d3d.test"
+        read = External.read
+
+        profiler.instrument(Derived)
+        assert Derived()() == 3 and Base().load() == 2 and Derived().read() == "external"
+        assert Derived()._helper() == 0
+
+        # inherited methods are named by the class defining them, and classes outside d3d are skipped
+        assert list(profiler.statistics()) == ["Base.__call__", "Base.__call__/Base.load",
+            "Base.__call__/Base.load/Derived.decode", "Base.load", "Base.load/Base.decode"]
+        assert External.read is read
+        assert not hasattr(vars(Base)["_helper"], "_d3d_profiled")
+
+        # functions are not wrapped twice
+        load = vars(Base)["load"]
+        profiler.instrument(Derived, prefix="Again")
+        profiler.instrument(Base)
+        assert vars(Base)["load"] is load
+        profiler.reset()
+        Derived().load()
+        assert list(profiler.statistics()) == ["Base.load", "Base.load/Derived.decode"]
+
+        with self.assertRaises(ValueError):
+            profiler.instrument(Derived())
+
+    def test_module(self):
+        module = types.ModuleType("d3d_ops")
+        exec("from os.path import join\n"
+             "def op(x):\n    return x + 1\n"
+             "def _private(x):\n    return x\n"
+             "class Op:\n    def forward(self, x):\n        return op(x)\n", module.__dict__)
+        join, private = module.join, module._private
+
+        profiler.instrument(module)
+        profiler.instrument(module) # no effect for the instrumented functions
+        assert module.join is join and module._private is private
+        assert module.Op().forward(1) == 2
+        assert list(profiler.statistics()) == ["d3d_ops.Op.forward", "d3d_ops.Op.forward/d3d_ops.op"]
+
+        # the instrumented functions only call the original function when the profiler is disabled
+        profiler.reset()
+        profiler.disable()
+        with mock.patch("d3d.profiler.time.perf_counter") as perf_counter:
+            assert module.op(1) == 2 and module.Op().forward(2) == 3
+            perf_counter.assert_not_called()
+        assert profiler.statistics() == {}
+
+    def test_defaults(self):
+        import d3d.box
+        import d3d.math
+        import d3d.point
+        import d3d.voxel
+        from d3d.dataset.kitti.object import KittiObjectLoader
+        from d3d.dataset.nuscenes.loader import NuscenesObjectLoader
+        from d3d.dataset.waymo.loader import WaymoObjectLoader
+
+        with mock.patch("d3d.profiler.instrument") as instrument:
+            profiler.instrument_defaults()
+        targets = [call.args[0] for call in instrument.call_args_list]
+        assert targets == [d3d.box, d3d.math, d3d.point, d3d.voxel,
+            KittiObjectLoader, NuscenesObjectLoader, WaymoObjectLoader]
+
+        # the operators are named by their module
+        with mock.patch.dict(d3d.box.__dict__):
+            profiler.instrument(d3d.box)
+            boxes = torch.tensor([[0, 0, 2, 2, 0], [1, 1, 2, 2, 0]], dtype=torch.float)
+            d3d.box.box2d_iou(boxes, boxes, method="rbox")
+        assert "d3d.box.box2d_iou" in profiler.statistics()
+        assert not hasattr(d3d.box.box2d_iou, "_d3d_profiled")
+
+class TestTrace(unittest.TestCase):
+    def setUp(self):
+        profiler.reset()
+        profiler.enable(synchronize=False, trace=True)
+
+    def tearDown(self):
+        profiler.enable(synchronize=False, trace=False) # drop the buffer
+        profiler.disable()
+        profiler.reset()
+
+    @staticmethod
+    def spans(events):
+        return [event for event in events if event["ph"] == "X"]
+
+    def test_events(self):
+        stop = threading.Event()
+        def work():
+            with profiler.scope("worker"):
+                pass
+            stop.wait()
+        thread = threading.Thread(target=work, name="loader")
+        thread.start()
+
+        # the outer scope lasts from 10s to 12s and the inner one from 10.5s to 11s
+        with mock.patch("d3d.profiler.time.perf_counter", side_effect=[10, 10.5, 11, 12]):
+            with profiler.scope("step"):
+                with profiler.scope("load"):
+                    pass
+
+        try:
+            events = profiler.trace_events()
+        finally:
+            stop.set()
+            thread.join()
+
+        spans = self.spans(events)
+        assert [e["name"] for e in spans] == ["worker", "load", "step"]
+        assert [e["args"]["path"] for e in spans] == ["worker", "step/load", "step"]
+        worker, load, step = spans
+        assert load["ts"] == 10.5e6 and load["dur"] == 0.5e6
+        assert step["ts"] == 10e6 and step["dur"] == 2e6
+        assert all(e["pid"] == os.getpid() and e["cat"] == "d3d" for e in spans)
+        assert step["tid"] == threading.get_ident() and worker["tid"] == thread.ident
+
+        metadata = {(e["name"], e["tid"]): e["args"]["name"] for e in events if e["ph"] == "M"}
+        assert metadata[("thread_name", thread.ident)] == "loader"
+        assert metadata[("thread_name", threading.get_ident())] == threading.current_thread().name
+        assert metadata[("process_name", 0)].endswith("(%d)" % os.getpid())
+
+    def test_buffer(self):
+        # the oldest spans are dropped when the buffer is full
+        profiler.enable(synchronize=False, trace=True, trace_capacity=3)
+        for i in range(5):
+            with profiler.scope("s%d" % i):
+                pass
+        assert [e["name"] for e in self.spans(profiler.trace_events())] == ["s2", "s3", "s4"]
+        assert profiler.statistics()["s0"].count == 1 # statistics are kept
+
+        # the spans are kept when enabled again with the same capacity, and dropped if tracing is disabled
+        profiler.enable(synchronize=False, trace=True, trace_capacity=3)
+        assert len(self.spans(profiler.trace_events())) == 3
+        profiler.enable(synchronize=False, trace=False)
+        assert profiler.trace_events() == []
+        with profiler.scope("untraced"):
+            pass
+        profiler.enable(synchronize=False, trace=True)
+        assert self.spans(profiler.trace_events()) == []
+
+        profiler.reset()
+        assert self.spans(profiler.trace_events()) == []
+
+    def test_merge(self):
+        with tempfile.TemporaryDirectory() as tempdir:
+            paths = [os.path.join(tempdir, "trace%d.json" % i) for i in range(2)]
+            with profiler.scope("first"):
+                pass
+            profiler.save_trace(paths[0])
+            profiler.reset()
+            with profiler.scope("second"):
+                pass
+            profiler.save_trace(paths[1], events=profiler.trace_events()[:1])
+
+            output = os.path.join(tempdir, "merged.json")
+            profiler.merge_traces(paths, output)
+            with open(output) as fin:
+                merged = json.load(fin)
+            traces = []
+            for path in paths:
+                with open(path) as fin:
+                    traces.append(json.load(fin))
+
+        assert merged["displayTimeUnit"] == "ms"
+        assert merged["traceEvents"] == traces[0]["traceEvents"] + traces[1]["traceEvents"]
+        assert [e["name"] for e in self.spans(merged["traceEvents"])] == ["first", "second"]
+
+    @unittest.skipIf(not hasattr(os, "register_at_fork"), "fork is not supported")
+    def test_fork(self):
+        with profiler.scope("parent"):
+            pass
+
+        pid = os.fork()
+        if pid == 0: # spans of the parent are not exported again by the child
+            ok = False
+            try:
+                with profiler.scope("child"):
+                    pass
+                spans = self.spans(profiler.trace_events())
+                ok = [(e["name"], e["pid"]) for e in spans] == [("child", os.getpid())]
+            finally:
+                os._exit(0 if ok else 1)
+
+        _, status = os.waitpid(pid, 0)
+        assert os.WIFEXITED(status) and os.WEXITSTATUS(status) == 0
+        assert [e["name"] for e in self.spans(profiler.trace_events())] == ["parent"]
+
+@unittest.skipIf(profiler.TorchDispatchMode is None, "TorchDispatchMode is not supported")
+class TestMemoryTracker(unittest.TestCase):
+    @staticmethod
+    def groups(result):
+        return [(g.shape, g.dtype, g.count, g.nbytes) for g in result]
+
+    def test_tap(self):
+        tracker = profiler.MemoryTracker(python=False)
+        with tracker:
+            a = torch.zeros(10, 20)
+            b = [torch.ones(5, dtype=torch.int64) for _ in range(3)]
+            # views and outputs of in-place operators are not new tensors
+            v, t = a.view(200), a[0]
+            a.add_(1)
+            torch.mul(b[0], 2, out=b[1])
+            temp = torch.zeros(100)
+            del temp # released before the tap
+
+            result = tracker.tap("first")
+            assert self.groups(result.tensors_new) == [((10, 20), torch.float32, 1, 800),
+                                                       ((5,), torch.int64, 3, 120)]
+            assert result.tensors_released == []
+            assert all(g.site.startswith(__file__) for g in result.tensors_new)
+            assert "cuda" not in result or torch.cuda.is_initialized()
+
+            # tensors created before the tap are reported when released
+            del a, v, t, b[0]
+            c = torch.zeros(2)
+            result = tracker.tap("second")
+            assert self.groups(result.tensors_new) == [((2,), torch.float32, 1, 8)]
+            assert self.groups(result.tensors_released) == [((10, 20), torch.float32, 1, 800),
+                                                            ((5,), torch.int64, 1, 40)]
+            assert self.groups(tracker.live_tensors()) == [((5,), torch.int64, 2, 80), ((2,), torch.float32, 1, 8)]
+
+            summary = tracker.summary(result).split("\n")
+            assert summary[0] == "========== Memory growth of second =========="
+            assert summary[1] == "New tensors: 1 tensors, 0.00 MB"
+            assert summary[3] == "Released tensors: 2 tensors, 0.00 MB"
+
+            result = tracker.tap()
+            assert result.tensors_new == [] and result.tensors_released == []
+
+        # tensors are not recorded after the tracker is stopped
+        seq = tracker._seq
+        torch.zeros(3)
+        assert tracker._seq == seq
+
+    def test_python(self):
+        with profiler.MemoryTracker(tensors=False) as tracker:
+            data = [bytearray(1000) for _ in range(1000)]
+            result = tracker.tap()
+            assert result.python_diff >= 1e6 and result.python[0].size_diff >= 1e6
+            assert result.tensors_new == [] and result.tensors_released == []
+            del data
+            assert tracker.tap().python_diff <= -1e6
+
+    def test_tap_tensors(self):
+        from torch.utils._python_dispatch import _get_current_dispatch_mode
+        assert profiler.tap_tensors() == ([], [])
+        a = torch.zeros(7)
+        created, released = profiler.tap_tensors()
+        assert self.groups(created) == [((7,), torch.float32, 1, 28)] and released == []
+
+        # tracking is stopped with the last tap, and the dispatch mode is exited
+        del a
+        created, released = profiler.tap_tensors(stop=True)
+        assert created == [] and self.groups(released) == [((7,), torch.float32, 1, 28)]
+        assert profiler._tracker is None and _get_current_dispatch_mode() is None
+        assert profiler.tap_tensors(stop=True) == ([], [])